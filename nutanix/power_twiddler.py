@@ -1,8 +1,10 @@
 #!/usr/bin/python3
 
+import concurrent.futures
 import json
 import requests
 import sys
+import threading
 import time
 
 
@@ -12,6 +14,17 @@ urllib3.disable_warnings()
 
 BASE_URL = 'https://%s:9440'
 
+# How many VMs to change the power state of at once
+MAX_WORKERS = 16
+
+# How long to wait for a VM to reach the power state we asked for before
+# asking again, and then before giving up
+POWER_TIMEOUT = 60
+
+# Polling starts at POLL_INITIAL seconds apart, and doubles up to POLL_MAX
+POLL_INITIAL = 1
+POLL_MAX = 15
+
 
 class RestApiException(Exception):
     def __init__(self, status, body):
@@ -20,10 +33,44 @@ class RestApiException(Exception):
 
 
 class RestApi(object):
-    def __init__(self, hostname, username, password):
+    def __init__(self, hostname, username, password,
+                 max_workers=MAX_WORKERS):
         self.base_url = BASE_URL % hostname
         self.api_url = self.base_url + '/api/nutanix/v3'
-        self.session = self._get_session(username, password)
+        self.username = username
+        self.password = password
+
+        # requests doesn't promise that a Session is thread safe, so each
+        # thread gets its own
+        self.thread_state = threading.local()
+        self.sessions_lock = threading.Lock()
+        self.sessions = []
+
+        # Batches share one pool of threads, so we only ever have a session
+        # per pool thread (plus the caller's) however many batches we run
+        self.max_workers = max_workers
+        self.executor = None
+
+    @property
+    def session(self):
+        s = getattr(self.thread_state, 'session', None)
+        if s is None:
+            s = self._get_session(self.username, self.password)
+            self.thread_state.session = s
+            with self.sessions_lock:
+                self.sessions.append(s)
+        return s
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown()
+            self.executor = None
+
+        with self.sessions_lock:
+            sessions = self.sessions
+            self.sessions = []
+        for s in sessions:
+            s.close()
 
     def _get_session(self, username, password):
         s = requests.Session()
@@ -58,9 +105,9 @@ class RestApi(object):
                                        json={'kind': 'vm'})
 
     # Meta helper thingies
-    def set_power_state(self, vm_uuid, state):
+    def set_power_state(self, vm_uuid, state, force=False):
         vm_info = self.get_vm(vm_uuid)
-        if vm_info['spec']['resources']['power_state'] == state:
+        if vm_info['spec']['resources']['power_state'] == state and not force:
             return False
 
         del vm_info['status']
@@ -71,46 +118,85 @@ class RestApi(object):
     def is_powered_on(self, vm_uuid):
         return self.get_vm(vm_uuid)['spec']['resources']['power_state'] == 'ON'
 
+    def get_power_state(self, vm_uuid):
+        # The power state the VM is actually in, rather than the one we last
+        # asked for
+        vm_info = self.get_vm(vm_uuid)
+        status = vm_info.get('status', {}).get('resources', {})
+        if 'power_state' in status:
+            return status['power_state']
+        return vm_info['spec']['resources']['power_state']
+
+    def wait_for_power_state(self, vm_uuid, state, timeout=POWER_TIMEOUT):
+        # Poll until the VM is in state, backing off exponentially. Returns
+        # whether it got there in time, and how many times we polled.
+        deadline = time.time() + timeout
+        delay = POLL_INITIAL
+        polls = 0
+        while True:
+            polls += 1
+            if self.get_power_state(vm_uuid) == state:
+                return True, polls
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False, polls
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, POLL_MAX)
+
     # NOTE(mika): VMs don't always change power state when you ask them to.
     # So instead we have some poor man's retry logic to try and get them to
     # the state we want them to be in.
-    def batch_set_power_with_retry(self, uuids, state):
-        results = {}
-
-        # First attempt
-        for uuid in uuids:
-            if r.set_power_state(uuid, state):
-                results[uuid] = 'soft'
-            else:
-                results[uuid] = 'skip'
-
-        time.sleep(60)
-
-        # Test compliance
-        dirty = False
+    def set_power_with_retry(self, uuid, state, timeout=POWER_TIMEOUT):
+        start = time.time()
+        result = {'result': 'skip', 'polls': 0}
+
+        try:
+            # First attempt
+            if self.set_power_state(uuid, state):
+                result['result'] = 'soft'
+
+            # Test compliance
+            done, polls = self.wait_for_power_state(uuid, state,
+                                                    timeout=timeout)
+            result['polls'] += polls
+            if not done:
+                self.set_power_state(uuid, state, force=True)
+                result['result'] = 'hard'
+
+                # Verify
+                done, polls = self.wait_for_power_state(uuid, state,
+                                                        timeout=timeout)
+                result['polls'] += polls
+                if not done:
+                    result['result'] = 'fail'
+
+        except RestApiException as e:
+            result['result'] = 'error'
+            result['error'] = '%d: %s' % (e.status, e.body)
+        except requests.RequestException as e:
+            # Timeouts, connection resets and the like
+            result['result'] = 'error'
+            result['error'] = str(e)
+
+        result['seconds'] = time.time() - start
+        return result
+
+    # Each VM is changed and then polled on its own, so a batch takes about
+    # as long as its slowest VM rather than the sum of them. Returns a dict
+    # of uuid to a dict with the result (skip, soft, hard, fail or error),
+    # how many times we polled, and how many seconds the VM took.
+    def batch_set_power_with_retry(self, uuids, state, timeout=POWER_TIMEOUT):
+        if not self.executor:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_workers)
+
+        futures = {}
         for uuid in uuids:
-            actual = 'OFF'
-            if r.is_powered_on(uuid):
-                actual = 'ON'
-
-            if actual != state:
-                r.set_power_state(uuid, state)
-                results[uuid] = 'hard'
-                dirty = True
+            futures[uuid] = self.executor.submit(
+                self.set_power_with_retry, uuid, state, timeout=timeout)
 
-        # Verify
-        if dirty:
-            time.sleep(60)
-
-            for uuid in uuids:
-                actual = 'OFF'
-                if r.is_powered_on(uuid):
-                    actual = 'ON'
-
-                if actual != state:
-                    results[uuid] = 'fail'
-
-        return results
+        return {uuid: future.result() for uuid, future in futures.items()}
 
     def get_vdi_url(self, uuid):
         vm_info = self.get_vm(uuid)
@@ -128,64 +214,74 @@ class RestApi(object):
 
 if __name__ == '__main__':
     r = RestApi('192.168.10.30', sys.argv[1], sys.argv[2])
+    try:
+        # Discover basic cluster information
+        for cluster in r.get_clusters()['entities']:
+            print('Available cluster:')
+            print('    Name: %s' % cluster['spec']['name'])
+            print('    Version: %s' %
+                  cluster['spec']['resources']['config']['software_map']['NOS']['version'])
+
+        # Discover all VMs
+        for vm in r.get_vms()['entities']:
+            print()
+            print('VM %s (%s) owned by %s' % (
+                vm['metadata']['uuid'],
+                vm['spec']['name'],
+                vm['metadata'].get('owner_reference', {}).get('name')))
+            print('    vCPUs %dx%d, Memory %.02f MiB, powered %s'
+                  % (vm['spec']['resources']['num_sockets'],
+                     vm['spec']['resources']['num_vcpus_per_socket'],
+                     vm['spec']['resources']['memory_size_mib'],
+                     vm['spec']['resources']['power_state']))
+            for nic in vm['spec']['resources']['nic_list']:
+                print('    NIC: %s with MAC %s' %
+                      (nic['uuid'], nic['mac_address']))
+            for disk in vm['spec']['resources']['disk_list']:
+                print('    Disk: %s is %s MiB' %
+                      (disk['uuid'], disk.get('disk_size_mib', 0)))
+
+            if vm['spec']['name'] == 'mikal ubuntu':
+                ubuntu_vm_uuid = vm['metadata']['uuid']
+            if vm['spec']['name'] == 'mikal centos':
+                centos_vm_uuid = vm['metadata']['uuid']
+
+        # Fetch a VDI URL
+        print()
+        print('Ubuntu VDI: %s' % r.get_vdi_url(ubuntu_vm_uuid))
+        print()
+        print('Centos VDI: %s' % r.get_vdi_url(centos_vm_uuid))
 
-    # Discover basic cluster information
-    for cluster in r.get_clusters()['entities']:
-        print('Available cluster:')
-        print('    Name: %s' % cluster['spec']['name'])
-        print('    Version: %s' %
-              cluster['spec']['resources']['config']['software_map']['NOS']['version'])
-
-    # Discover all VMs
-    for vm in r.get_vms()['entities']:
+        # Validate power cycling
         print()
-        print('VM %s (%s) owned by %s' % (
-            vm['metadata']['uuid'],
-            vm['spec']['name'],
-            vm['metadata'].get('owner_reference', {}).get('name')))
-        print('    vCPUs %dx%d, Memory %.02f MiB, powered %s'
-              % (vm['spec']['resources']['num_sockets'],
-                 vm['spec']['resources']['num_vcpus_per_socket'],
-                 vm['spec']['resources']['memory_size_mib'],
-                 vm['spec']['resources']['power_state']))
-        for nic in vm['spec']['resources']['nic_list']:
-            print('    NIC: %s with MAC %s' %
-                  (nic['uuid'], nic['mac_address']))
-        for disk in vm['spec']['resources']['disk_list']:
-            print('    Disk: %s is %s MiB' %
-                  (disk['uuid'], disk.get('disk_size_mib', 0)))
-
-        if vm['spec']['name'] == 'mikal ubuntu':
-            ubuntu_vm_uuid = vm['metadata']['uuid']
-        if vm['spec']['name'] == 'mikal centos':
-            centos_vm_uuid = vm['metadata']['uuid']
-
-    # Fetch a VDI URL
-    print()
-    print('Ubuntu VDI: %s' % r.get_vdi_url(ubuntu_vm_uuid))
-    print()
-    print('Centos VDI: %s' % r.get_vdi_url(centos_vm_uuid))
-
-    # Validate power cycling
-    print()
-    print('---------------------------------------------')
-    print()
-
-    for count in range(5):
-        # Power on
-        results = r.batch_set_power_with_retry(
-            [ubuntu_vm_uuid, centos_vm_uuid], 'ON'
-        )
-        print('Pass %3d  ON: ubuntu = %s, centos = %s'
-              % (count, results[ubuntu_vm_uuid], results[centos_vm_uuid]))
-        time.sleep(60)
-
-        # Power off
-        results = r.batch_set_power_with_retry(
-            [ubuntu_vm_uuid, centos_vm_uuid], 'OFF'
-        )
-        print('Pass %3d OFF: ubuntu = %s, centos = %s'
-              % (count, results[ubuntu_vm_uuid], results[centos_vm_uuid]))
-        time.sleep(60)
-
-        print('-------------------')
+        print('---------------------------------------------')
+        print()
+
+        for count in range(5):
+            # Power on
+            results = r.batch_set_power_with_retry(
+                [ubuntu_vm_uuid, centos_vm_uuid], 'ON'
+            )
+            print('Pass %3d  ON: ubuntu = %s (%.1fs), centos = %s (%.1fs)'
+                  % (count,
+                     results[ubuntu_vm_uuid]['result'],
+                     results[ubuntu_vm_uuid]['seconds'],
+                     results[centos_vm_uuid]['result'],
+                     results[centos_vm_uuid]['seconds']))
+            time.sleep(60)
+
+            # Power off
+            results = r.batch_set_power_with_retry(
+                [ubuntu_vm_uuid, centos_vm_uuid], 'OFF'
+            )
+            print('Pass %3d OFF: ubuntu = %s (%.1fs), centos = %s (%.1fs)'
+                  % (count,
+                     results[ubuntu_vm_uuid]['result'],
+                     results[ubuntu_vm_uuid]['seconds'],
+                     results[centos_vm_uuid]['result'],
+                     results[centos_vm_uuid]['seconds']))
+            time.sleep(60)
+
+            print('-------------------')
+    finally:
+        r.close()
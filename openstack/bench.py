@@ -0,0 +1,148 @@
+#!/usr/bin/python3
+
+# Benchmark instance_summary.py end to end against mock_cloud.py. For each
+# number of projects we start a mock cloud, run the summary in a fresh
+# process, and measure:
+#
+#   - wall clock time for the whole run
+#   - the number of requests the mock cloud saw, by type
+#   - peak RSS of the summary process
+#
+# With --cached, each size is run a second time against the same cache
+# directory, to show what the token cache and server store save.
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+
+DEFAULT_PROJECTS = '10,1000,10000'
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def start_cloud(projects, servers, latency, keystone='v3'):
+    # Returns (process, auth url) once the mock cloud is listening
+    cloud = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, 'mock_cloud.py'),
+         '--projects', str(projects), '--servers', str(servers),
+         '--latency', str(latency), '--keystone', keystone],
+        stdout=subprocess.PIPE, text=True)
+    line = cloud.stdout.readline().strip()
+    if not line.startswith('OS_AUTH_URL='):
+        cloud.kill()
+        raise Exception('Mock cloud did not start: %s' % line)
+    return cloud, line.split('=', 1)[1]
+
+
+def cloud_stats(auth_url, reset=False):
+    base_url = auth_url.rsplit('/', 1)[0]
+    req = urllib.request.Request('%s/_stats' % base_url,
+                                 method='POST' if reset else 'GET')
+    with urllib.request.urlopen(req) as res:
+        return json.loads(res.read())
+
+
+def run_summary(auth_url, options):
+    # Run the summary with its output discarded, returning (seconds, peak
+    # RSS in MB). wait4() gives us the rusage of just this child.
+    env = dict(os.environ)
+    env.update({
+        'OS_AUTH_URL': auth_url,
+        'OS_USERNAME': 'admin',
+        'OS_PASSWORD': 'secret',
+        'OS_TENANT_NAME': 'project-0',
+        'OS_TENANT_ID': 'project-000000'
+    })
+
+    start = time.perf_counter()
+    summary = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, 'instance_summary.py')] + options,
+        stdout=subprocess.DEVNULL, env=env)
+    _, status, rusage = os.wait4(summary.pid, 0)
+    elapsed = time.perf_counter() - start
+    summary.returncode = os.waitstatus_to_exitcode(status)
+    if summary.returncode:
+        raise Exception('instance_summary.py failed with exit code %d'
+                        % summary.returncode)
+
+    # ru_maxrss is in kilobytes on Linux
+    return elapsed, rusage.ru_maxrss / 1024
+
+
+def run(project_counts, servers, latency, options, cached=False):
+    for projects in project_counts:
+        cloud, auth_url = start_cloud(projects, servers, latency)
+        cache_dir = tempfile.mkdtemp(prefix='instance-summary-bench-')
+        try:
+            runs = [('cold', ['--cache-dir', cache_dir] if cached
+                     else ['--no-cache'])]
+            if cached:
+                runs.append(('warm', ['--cache-dir', cache_dir]))
+
+            for name, extra in runs:
+                cloud_stats(auth_url, reset=True)
+                elapsed, rss = run_summary(auth_url, options + extra)
+                requests = cloud_stats(auth_url)
+                yield {
+                    'projects': projects,
+                    'servers': projects * servers,
+                    'run': name,
+                    'seconds': elapsed,
+                    'requests': sum(requests.values()),
+                    'requests_by_type': requests,
+                    'requests_per_second': sum(requests.values()) / elapsed,
+                    'peak_rss_mb': rss
+                }
+        finally:
+            cloud.terminate()
+            cloud.wait()
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark instance_summary.py against a mock cloud.')
+    parser.add_argument('--projects', default=DEFAULT_PROJECTS,
+                        help='Comma separated numbers of projects to test.')
+    parser.add_argument('--servers', type=int, default=10,
+                        help='Number of servers in each project.')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds the mock cloud waits before answering '
+                             'each request.')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--style', default='csv',
+                        help='Output style to ask for.')
+    parser.add_argument('--cached', action='store_true',
+                        help='Use a cache directory, and run each size twice '
+                             'to measure a warm cache too.')
+    parser.add_argument('--json', action='store_true',
+                        help='Emit one JSON object per run instead of a '
+                             'table.')
+    args = parser.parse_args()
+
+    options = ['--style', args.style, '--concurrency', str(args.concurrency)]
+    project_counts = [int(count) for count in args.projects.split(',')]
+
+    if not args.json:
+        print('%8s %9s %5s %9s %9s %9s %7s' % (
+            'Projects', 'Servers', 'Run', 'Seconds', 'Requests', 'Req/s',
+            'RSS MB'))
+
+    for result in run(project_counts, args.servers, args.latency, options,
+                      cached=args.cached):
+        if args.json:
+            print(json.dumps(result, sort_keys=True), flush=True)
+            continue
+
+        print('%8d %9d %5s %9.2f %9d %9.0f %7.1f' % (
+            result['projects'], result['servers'], result['run'],
+            result['seconds'], result['requests'],
+            result['requests_per_second'], result['peak_rss_mb']),
+            flush=True)
@@ -4,22 +4,457 @@
 # transitioning workloads.
 
 import argparse
+import array
+import atexit
+import bisect
+import collections
+import concurrent.futures
 import csv
-from io import StringIO
+import datetime
+import fcntl
+import hashlib
+import http.client
+import http.server
+import itertools
 import json
 import os
 from prettytable import PrettyTable
+import queue
+import re
+import signal
+import sqlite3
+import ssl
 import sys
+import tempfile
+import threading
+import time
 import urllib.error
-import urllib.request
+import urllib.parse
 
 
 args = None
 
+DEFAULT_CACHE_DIR = os.path.expanduser('~/.cache/instance-summary')
+
+# Cached tokens are treated as expired this many seconds before keystone
+# says they are, so they don't expire part way through a run
+TOKEN_EXPIRY_MARGIN = 600
+
+# Servers changed this many seconds before the last sync started are fetched
+# again, in case our clock and nova's disagree
+CHANGES_SINCE_MARGIN = 300
+
+# The number of servers to ask nova for at a time. Nova caps this at its
+# osapi_max_limit (1000 by default) anyway.
+DEFAULT_PAGE_SIZE = 1000
+
+# How often to refresh the inventory when serving metrics, in seconds
+DEFAULT_INTERVAL = 300
+
+
+class ConnectionPool(object):
+    # Keep-alive HTTP(S) connections shared between threads. Each request
+    # takes an idle connection to the right host (or opens a new one) and
+    # hands it back once the response has been read, so we're not paying
+    # for a TCP and TLS handshake on every call.
+    def __init__(self, max_idle=8, timeout=120):
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = collections.defaultdict(list)
+        self.ssl_context = ssl.create_default_context()
+
+    def _get(self, key):
+        with self.lock:
+            if self.idle[key]:
+                return self.idle[key].pop(), True
+
+        scheme, host, port = key
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(host, port,
+                                               timeout=self.timeout,
+                                               context=self.ssl_context)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=self.timeout)
+        return conn, False
+
+    def _put(self, key, conn):
+        with self.lock:
+            if len(self.idle[key]) < self.max_idle:
+                self.idle[key].append(conn)
+                return
+        conn.close()
+
+    def request(self, method, url, body=None, headers=None):
+        # Returns the response, its body, and how many times we had to
+        # retry on a fresh connection
+        parsed = urllib.parse.urlsplit(url)
+        key = (parsed.scheme, parsed.hostname, parsed.port)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+
+        retries = 0
+        while True:
+            conn, reused = self._get(key)
+            try:
+                conn.request(method, path, body=body, headers=headers or {})
+                res = conn.getresponse()
+                data = res.read()
+            except ConnectionError:
+                # The server can close an idle keep-alive connection at any
+                # time, so that's worth retrying on another connection
+                conn.close()
+                if reused:
+                    retries += 1
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+
+            if res.will_close:
+                conn.close()
+            else:
+                self._put(key, conn)
+            return res, data, retries
+
+    def close(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle.clear()
+
+
+pool = ConnectionPool()
+
+
+class RequestStats(object):
+    # Timing for every request we make, so when a report is slow we can see
+    # whether keystone, nova or we are to blame. Requests are grouped by
+    # endpoint, which is the method and the URL path with ids taken out, so
+    # every project's server listing counts as the same endpoint. Latencies
+    # go into a fixed set of buckets rather than being kept, so this costs
+    # about the same however many requests we make.
+    BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000,
+                  10000, 30000]
+
+    VERSION_RE = re.compile(r'^v[0-9]+(\.[0-9]+)*$')
+    ID_RE = re.compile(r'[0-9]')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def endpoint(self, method, url):
+        # This is cheap next to the request itself, so isn't cached
+        segments = []
+        for segment in urllib.parse.urlsplit(url).path.split('/'):
+            if (self.ID_RE.search(segment) and
+                    not self.VERSION_RE.match(segment)):
+                segment = '{id}'
+            segments.append(segment)
+        return '%s %s' % (method, '/'.join(segments))
+
+    def record(self, method, url, elapsed, sent, received, retries=0,
+               decode=0.0, status=None):
+        label = self.endpoint(method, url)
+        bucket = bisect.bisect_left(self.BUCKETS_MS, elapsed * 1000)
+        with self.lock:
+            stats = self.endpoints.get(label)
+            if not stats:
+                stats = {
+                    'requests': 0,
+                    'errors': 0,
+                    'retries': 0,
+                    'bytes_sent': 0,
+                    'bytes_received': 0,
+                    'seconds': 0.0,
+                    'max_seconds': 0.0,
+                    'decode_seconds': 0.0,
+                    'histogram': [0] * (len(self.BUCKETS_MS) + 1)
+                }
+                self.endpoints[label] = stats
+
+            stats['requests'] += 1
+            if status is not None and status >= 400:
+                stats['errors'] += 1
+            stats['retries'] += retries
+            stats['bytes_sent'] += sent
+            stats['bytes_received'] += received
+            stats['seconds'] += elapsed
+            stats['max_seconds'] = max(stats['max_seconds'], elapsed)
+            stats['decode_seconds'] += decode
+            stats['histogram'][bucket] += 1
+
+    def percentile(self, histogram, fraction):
+        # The upper bound of the bucket the percentile falls in, in
+        # milliseconds. The last bucket has no upper bound.
+        wanted = sum(histogram) * fraction
+        seen = 0
+        for bucket, count in enumerate(histogram):
+            seen += count
+            if count and seen >= wanted:
+                if bucket < len(self.BUCKETS_MS):
+                    return self.BUCKETS_MS[bucket]
+                return None
+        return None
+
+    def summary(self):
+        with self.lock:
+            endpoints = {label: dict(stats, histogram=list(stats['histogram']))
+                         for label, stats in self.endpoints.items()}
+
+        for stats in endpoints.values():
+            stats['p50_ms'] = self.percentile(stats['histogram'], 0.5)
+            stats['p90_ms'] = self.percentile(stats['histogram'], 0.9)
+            stats['p99_ms'] = self.percentile(stats['histogram'], 0.99)
+        return {
+            'buckets_ms': self.BUCKETS_MS,
+            'endpoints': endpoints
+        }
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=4, sort_keys=True)
+            f.write('\n')
+
+    def emit(self, out=sys.stderr):
+        def ms(value):
+            if value is None:
+                return '>%d' % self.BUCKETS_MS[-1]
+            return '<=%d' % value
+
+        pt = PrettyTable()
+        pt.field_names = ['endpoint', 'requests', 'errors', 'retries',
+                          'sent', 'received', 'seconds', 'mean ms', 'p50 ms',
+                          'p90 ms', 'p99 ms', 'max ms', 'decode ms']
+        endpoints = self.summary()['endpoints']
+        for label in sorted(endpoints,
+                            key=lambda label: -endpoints[label]['seconds']):
+            stats = endpoints[label]
+            pt.add_row([label, stats['requests'], stats['errors'],
+                        stats['retries'], stats['bytes_sent'],
+                        stats['bytes_received'], round(stats['seconds'], 2),
+                        round(stats['seconds'] * 1000 / stats['requests'], 1),
+                        ms(stats['p50_ms']), ms(stats['p90_ms']),
+                        ms(stats['p99_ms']),
+                        round(stats['max_seconds'] * 1000, 1),
+                        round(stats['decode_seconds'] * 1000, 1)])
+        out.write(str(pt) + '\n')
+        out.flush()
+
+
+request_stats = RequestStats()
+
+
+class TokenCache(object):
+    # Keystone tokens (and the service catalog) cached on disk, so each run
+    # doesn't have to authenticate once per project. Entries are keyed by
+    # the auth URL, user and scope, and kept until shortly before the token
+    # expires. Each entry has a lock file, so concurrent runs (and threads)
+    # wait for whoever is already fetching a token rather than all asking
+    # keystone for one. With no directory, nothing is cached.
+    def __init__(self, directory):
+        self.directory = directory
+        if self.directory:
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+
+    def _path(self, key):
+        key = [os.environ.get('OS_AUTH_URL'), os.environ.get('OS_USERNAME')] + list(key)
+        name = hashlib.sha256(json.dumps(key).encode()).hexdigest()
+        return os.path.join(self.directory, name)
+
+    @staticmethod
+    def _expired(expires_at):
+        if not expires_at:
+            return True
+        expires = datetime.datetime.fromisoformat(expires_at.replace('Z', '+00:00'))
+        if not expires.tzinfo:
+            expires = expires.replace(tzinfo=datetime.timezone.utc)
+        remaining = expires - datetime.datetime.now(datetime.timezone.utc)
+        return remaining.total_seconds() < TOKEN_EXPIRY_MARGIN
+
+    def get(self, key, fetch, fresh=False):
+        # fetch() returns (value, expires_at). With fresh, any cached value
+        # is ignored and replaced.
+        if not self.directory:
+            return fetch()[0]
+
+        path = self._path(key)
+        lock = os.open(path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            if not fresh:
+                try:
+                    with open(path) as f:
+                        entry = json.load(f)
+                    if not self._expired(entry['expires_at']):
+                        return entry['value']
+                except (OSError, ValueError, KeyError):
+                    pass
+
+            value, expires_at = fetch()
+            if not self._expired(expires_at):
+                # Write a new file and rename it into place, so readers
+                # never see half an entry
+                tmp = '%s.%d.tmp' % (path, threading.get_ident())
+                fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(fd, 'w') as f:
+                    json.dump({'value': value, 'expires_at': expires_at}, f)
+                os.replace(tmp, path)
+            return value
+        finally:
+            os.close(lock)
+
+
+token_cache = TokenCache(None)
+
+
+class FlavorCache(object):
+    # Most flavors are public, so every project sees the same ones. List
+    # them once per nova endpoint, and look up private flavors which weren't
+    # in that listing one at a time, as servers using them turn up.
+    def __init__(self):
+        # lock protects the dicts, and is never held while talking to nova.
+        # Each endpoint also has its own lock, held while listing its
+        # flavors.
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.listing_locks = collections.defaultdict(threading.Lock)
+
+    def lookup(self, token, service_url, tenant_id):
+        # Whoever gets here first lists the flavors, and everyone else using
+        # the same endpoint waits for that rather than listing them too
+        with self.lock:
+            listing_lock = self.listing_locks[service_url]
+
+        with listing_lock:
+            with self.lock:
+                flavors = self.endpoints.get(service_url)
+            if flavors is None:
+                flavors = {}
+                for flavor in getFlavors(token, service_url, tenant_id):
+                    flavors[flavor.get('id')] = flavor
+                with self.lock:
+                    self.endpoints[service_url] = flavors
+        return ProjectFlavors(self.lock, flavors, token, service_url,
+                              tenant_id)
+
+
+class ProjectFlavors(object):
+    # The flavors one project can see, fetching ones we don't know yet with
+    # the project's token. flavors is shared with other projects using the
+    # same endpoint, and lock protects it.
+    def __init__(self, lock, flavors, token, service_url, tenant_id):
+        self.lock = lock
+        self.flavors = flavors
+        self.token = token
+        self.service_url = service_url
+        self.tenant_id = tenant_id
+
+    def __getitem__(self, flavor_id):
+        with self.lock:
+            flavor = self.flavors.get(flavor_id)
+        if flavor is None:
+            try:
+                flavor = getFlavor(self.token, self.service_url,
+                                   self.tenant_id, flavor_id)
+            except urllib.error.HTTPError as e:
+                if e.code != 404:
+                    raise
+                flavor = {'id': flavor_id, 'deleted': True,
+                          'name': 'deleted flavor %s' % flavor_id,
+                          'vcpus': 0, 'ram': 0, 'disk': 0}
+            with self.lock:
+                self.flavors[flavor_id] = flavor
+        return flavor
+
+
+flavor_cache = FlavorCache()
+
+
+class ServerStore(object):
+    # A local copy of each project's servers, kept in sqlite. After the
+    # first full listing of a project, only servers which nova says have
+    # changed since the last sync are fetched. Deleted servers show up in
+    # those changes with a status of DELETED, and are removed.
+    def __init__(self, path):
+        # The connection is shared between threads, so all use of it is
+        # under the lock
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS servers ('
+            'endpoint TEXT, project TEXT, id TEXT, server TEXT, synced TEXT, '
+            'PRIMARY KEY (endpoint, project, id))')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS syncs ('
+            'endpoint TEXT, project TEXT, synced TEXT, '
+            'PRIMARY KEY (endpoint, project))')
+        self.db.commit()
+
+    def last_sync(self, endpoint, project):
+        with self.lock:
+            row = self.db.execute(
+                'SELECT synced FROM syncs WHERE endpoint = ? AND project = ?',
+                (endpoint, project)).fetchone()
+        return row[0] if row else None
+
+    def update(self, endpoint, project, servers, synced):
+        with self.lock:
+            for server in servers:
+                if server.get('status') == 'DELETED':
+                    self.db.execute(
+                        'DELETE FROM servers WHERE endpoint = ? AND '
+                        'project = ? AND id = ?',
+                        (endpoint, project, server.get('id')))
+                else:
+                    self.db.execute(
+                        'INSERT OR REPLACE INTO servers VALUES (?, ?, ?, ?, ?)',
+                        (endpoint, project, server.get('id'),
+                         json.dumps(server), synced))
+            self.db.commit()
+
+    def finish_sync(self, endpoint, project, synced, full):
+        # A full listing replaces whatever we had for the project, so forget
+        # servers it didn't include
+        with self.lock:
+            if full:
+                self.db.execute(
+                    'DELETE FROM servers WHERE endpoint = ? AND project = ? '
+                    'AND synced < ?', (endpoint, project, synced))
+            self.db.execute('INSERT OR REPLACE INTO syncs VALUES (?, ?, ?)',
+                            (endpoint, project, synced))
+            self.db.commit()
+
+    def servers(self, endpoint, project, page_size=DEFAULT_PAGE_SIZE):
+        # Yields pages of the project's servers, in id order
+        last_id = ''
+        while True:
+            with self.lock:
+                rows = self.db.execute(
+                    'SELECT id, server FROM servers WHERE endpoint = ? AND '
+                    'project = ? AND id > ? ORDER BY id LIMIT ?',
+                    (endpoint, project, last_id, page_size)).fetchall()
+            if not rows:
+                return
+            yield [json.loads(server) for _, server in rows]
+            last_id = rows[-1][0]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+server_store = None
+
 
 def _make_req(method, url, data, headers):
     if data:
-        posted = json.dumps(data, indent=4, sort_keys=True).encode()
+        posted = json.dumps(data).encode()
     else:
         posted = None
 
@@ -29,34 +464,42 @@ def _make_req(method, url, data, headers):
             print('    header: %s=%s' %(header, headers[header]))
 
         if data:
-            for line in posted.decode().split('\n'):
+            for line in json.dumps(data, indent=4, sort_keys=True).split('\n'):
                 print('    posted: %s' % line)
 
         print()
 
-    req = urllib.request.Request(url=url, method=method, data=posted,
-                                 headers=headers)
+    start = time.perf_counter()
+    res, body, retries = pool.request(method, url, posted, headers)
+    elapsed = time.perf_counter() - start
+    sent = len(posted) if posted else 0
 
-    try:
-        with urllib.request.urlopen(req) as res:
-            out = json.loads(res.read())
+    if res.status >= 400:
+        request_stats.record(method, url, elapsed, sent, len(body),
+                             retries=retries, status=res.status)
+        if args.verbose:
+            print('    result: code = %d' % res.status)
+            print('     error: reason = %s' % res.reason)
+            print()
+        raise urllib.error.HTTPError(url, res.status, res.reason, res.headers,
+                                     None)
 
-            if args.verbose:
-                print('    result: code = %d' % res.code)
-                for header in headers:
-                    print('    header: %s=%s' %(header, headers[header]))
-                for line in json.dumps(out, indent=4, sort_keys=True).split('\n'):
-                    print('  returned: %s' % line)
+    start = time.perf_counter()
+    out = json.loads(body)
+    request_stats.record(method, url, elapsed, sent, len(body),
+                         retries=retries, status=res.status,
+                         decode=time.perf_counter() - start)
 
-                print()
+    if args.verbose:
+        print('    result: code = %d' % res.status)
+        for header in headers:
+            print('    header: %s=%s' %(header, headers[header]))
+        for line in json.dumps(out, indent=4, sort_keys=True).split('\n'):
+            print('  returned: %s' % line)
 
-            return res.headers, out
-    except urllib.error.HTTPError as e:
-        if args.verbose:
-            print('    result: code = %d' % e.code)
-            print('     error: reason = %s' % e.reason)
-            print()
-        raise e
+        print()
+
+    return res.headers, out
 
 
 def getKeystoneVersion():
@@ -66,13 +509,21 @@ def getKeystoneVersion():
     return data.get('version').get('id')
 
 
-def getKeystoneV2Token(tenant=None):
-    headers = {'Content-Type': 'application/json'}
-    url = '%s/tokens' % os.environ.get('OS_AUTH_URL')
-
+def getKeystoneV2Token(tenant=None, fresh=False):
     if not tenant:
         tenant = os.environ.get('OS_TENANT_NAME')
 
+    def fetch():
+        token, catalog = _getKeystoneV2Token(tenant)
+        return [token, catalog], token.get('expires')
+
+    return token_cache.get(('v2', tenant), fetch, fresh=fresh)
+
+
+def _getKeystoneV2Token(tenant):
+    headers = {'Content-Type': 'application/json'}
+    url = '%s/tokens' % os.environ.get('OS_AUTH_URL')
+
     data = {
         'auth': {
             'tenantName': tenant,
@@ -87,7 +538,15 @@ def getKeystoneV2Token(tenant=None):
     return data.get('access').get('token'), data.get('access').get('serviceCatalog')
 
 
-def getKeystoneV3Token(scope=None):
+def getKeystoneV3Token(scope=None, fresh=False):
+    def fetch():
+        token, token_data = _getKeystoneV3Token(scope)
+        return [token, token_data], token_data.get('expires_at')
+
+    return token_cache.get(('v3', scope or 'system'), fetch, fresh=fresh)
+
+
+def _getKeystoneV3Token(scope):
     headers = {'Content-Type': 'application/json'}
     url = '%s/auth/tokens' % os.environ.get('OS_AUTH_URL')
     data = {
@@ -137,7 +596,15 @@ def getKeystoneV3Projects(token, user):
     return data.get('projects')
 
 
-def getKeystoneV3Catalog(token):
+def getKeystoneV3Catalog(token, expires_at=None):
+    # The catalog is cached for as long as the token used to look it up
+    def fetch():
+        return _getKeystoneV3Catalog(token), expires_at
+
+    return token_cache.get(('v3-catalog', ), fetch)
+
+
+def _getKeystoneV3Catalog(token):
     headers = {
         'Content-Type': 'application/json',
         'X-Auth-Token': token
@@ -182,21 +649,60 @@ def getFlavors(token, service_url, tenant=None):
     return data.get('flavors')
 
 
-def getServers(token, service_url, tenant=None):
+def getFlavor(token, service_url, tenant, flavor_id):
     headers = {
         'Content-Type': 'application/json',
         'Accept': 'application/json',
         'X-Auth-Token': token,
         'X-OpenStack-Nova-API-Version': '2.42',
     }
-    url = '%s/servers/detail' % service_url
+    url = '%s/flavors/%s' % (service_url, urllib.parse.quote(flavor_id))
     url = url % {'tenant_id': tenant}
 
     rhead, data = _make_req('GET', url, None, headers)
-    return data.get('servers')
+    return data.get('flavor')
+
+
+def describeFlavor(flavor):
+    if flavor.get('deleted'):
+        return flavor.get('name')
+    return '%(name)s: %(vcpus)s cpu, %(ram)s MiB RAM, %(disk)s GiB disk' % flavor
+
 
+def getServers(token, service_url, tenant=None, page_size=DEFAULT_PAGE_SIZE,
+               changes_since=None):
+    # Yields pages of servers. Nova returns at most limit servers per call,
+    # and includes a "next" link when there might be more, which we follow
+    # by passing the last server we saw as the marker. With changes_since,
+    # only servers changed since then are returned, including deleted ones.
+    headers = {
+        'Content-Type': 'application/json',
+        'Accept': 'application/json',
+        'X-Auth-Token': token,
+        'X-OpenStack-Nova-API-Version': '2.42',
+    }
+    url = '%s/servers/detail' % service_url
+    url = url % {'tenant_id': tenant}
 
-def summarizeServer(server_keys, server, flavors):
+    params = {'limit': page_size}
+    if changes_since:
+        params['changes-since'] = changes_since
+    while True:
+        rhead, data = _make_req(
+            'GET', '%s?%s' % (url, urllib.parse.urlencode(params)), None,
+            headers)
+        servers = data.get('servers')
+        if not servers:
+            return
+        yield servers
+
+        links = data.get('servers_links', [])
+        if not [link for link in links if link.get('rel') == 'next']:
+            return
+        params['marker'] = servers[-1].get('id')
+
+
+def summarizeServer(server_keys, server, flavor):
     summary = []
 
     for key in server_keys:
@@ -210,21 +716,323 @@ def summarizeServer(server_keys, server, flavors):
                 count += len(data[network])
             data = count
         elif key == 'flavor':
-            data = flavors[data]
+            data = describeFlavor(flavor)
 
         summary.append(data)
 
     return summary
 
 
+def syncServers(token, nova_url, tenant_id):
+    # Bring the local copy of the project's servers up to date, yielding
+    # pages of it. A full listing is yielded page by page as it arrives, so
+    # big projects still stream. Changes since the last sync have to be
+    # applied before we know what the project looks like, and then we yield
+    # from the local copy.
+    endpoint = nova_url % {'tenant_id': tenant_id}
+    started = (datetime.datetime.now(datetime.timezone.utc) -
+               datetime.timedelta(seconds=CHANGES_SINCE_MARGIN))
+    synced = started.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    changes_since = None
+    if not args.full_sync:
+        changes_since = server_store.last_sync(endpoint, tenant_id)
+
+    full = changes_since is None
+    for servers in getServers(token, nova_url, tenant_id,
+                              page_size=args.page_size,
+                              changes_since=changes_since):
+        server_store.update(endpoint, tenant_id, servers, synced)
+        if full:
+            yield servers
+    server_store.finish_sync(endpoint, tenant_id, synced, full=full)
+
+    if not full:
+        yield from server_store.servers(endpoint, tenant_id,
+                                        page_size=args.page_size)
+
+
+def summarizeProject(tenant, get_token, nova_url, token=None):
+    # Yields a list of (tenant name, server, flavor) for each page of
+    # servers. get_token(fresh) returns a token for the project, and is
+    # only called if we weren't given a token or it turns out to be stale.
+    def start(token):
+        flavors = flavor_cache.lookup(token, nova_url, tenant.get('id'))
+        if server_store:
+            pages = syncServers(token, nova_url, tenant.get('id'))
+        else:
+            pages = getServers(token, nova_url, tenant.get('id'),
+                               page_size=args.page_size)
+        return flavors, pages, next(pages, [])
+
+    try:
+        flavors, pages, first = start(token or get_token(False))
+    except urllib.error.HTTPError as e:
+        # A cached token may have been revoked since it was issued, so get
+        # a new one and try again
+        if e.code != 401:
+            raise
+        flavors, pages, first = start(get_token(True))
+
+    for servers in itertools.chain([first], pages):
+        yield [(tenant.get('name'), server,
+                flavors[server.get('flavor', {}).get('id')])
+               for server in servers]
+
+
+def summarizeV2Tenant(tenant):
+    def get_token(fresh):
+        token_data, endpoints = getKeystoneV2Token(tenant=tenant.get('name'),
+                                                   fresh=fresh)
+        return token_data.get('id')
+
+    # The same call gives us the catalog and a token, so use that token
+    # rather than asking for another
+    token_data, endpoints = getKeystoneV2Token(tenant=tenant.get('name'))
+    services = {}
+    for endpoint in endpoints:
+        name = endpoint.get('name')
+        services[name] = endpoint.get('endpoints')[0].get('publicURL')
+
+    yield from summarizeProject(tenant, get_token, services['nova'],
+                                token=token_data.get('id'))
+
+
+def summarizeV3Project(services, tenant):
+    def get_token(fresh):
+        ptoken, ptoken_data = getKeystoneV3Token(scope=tenant.get('id'),
+                                                 fresh=fresh)
+        return ptoken
+
+    yield from summarizeProject(tenant, get_token, services['nova'])
+
+
+def summarizeProjects(summarize, projects, *extra):
+    # Projects are independent of each other, so fetch them in parallel.
+    # Each page of rows is handed back as soon as it arrives, so rows from
+    # different projects are interleaved. The queue is bounded, which stops
+    # the workers from getting too far ahead of whoever is writing the rows
+    # out, so memory use stays flat however big the cloud is.
+    results = queue.Queue(maxsize=args.concurrency * 2)
+    stopping = threading.Event()
+    finished = object()
+
+    def put(item):
+        while not stopping.is_set():
+            try:
+                results.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def worker(tenant):
+        try:
+            for rows in summarize(*extra, tenant):
+                if stopping.is_set():
+                    return
+                put(rows)
+        except Exception as e:
+            put(e)
+        finally:
+            put(finished)
+
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=args.concurrency)
+    try:
+        remaining = 0
+        for tenant in projects:
+            executor.submit(worker, tenant)
+            remaining += 1
+
+        while remaining:
+            item = results.get()
+            if item is finished:
+                remaining -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield from item
+    finally:
+        # If we're stopping early, don't leave workers blocked on a full
+        # queue or starting new projects
+        stopping.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def collectServers(add):
+    # Calls add(tenant name, server, flavor) for every server we can see
+    auth_version = getKeystoneVersion()
+    if auth_version.startswith('v2'):
+        # Keystone v2 doesn't let us see all the user's projects without
+        # doing some manual work. Allow users to specify tenants on the
+        # command line and then iterate them.
+        if not args.tenants:
+            projects = [
+                {
+                    'name': os.environ.get('OS_TENANT_NAME'),
+                    'id': os.environ.get('OS_TENANT_ID')
+                }
+            ]
+        else:
+            projects = []
+            for spec in args.tenants.split(','):
+                name, id = spec.split('=')
+                projects.append({
+                    'name': name,
+                    'id': id
+                })
+
+        for tenant_name, server, flavor in summarizeProjects(
+                summarizeV2Tenant, projects):
+            add(tenant_name, server, flavor)
+
+    elif auth_version.startswith('v3'):
+        token, token_data = getKeystoneV3Token()
+        user_id = token_data.get('user').get('id')
+        try:
+            projects = getKeystoneV3Projects(token, user_id)
+        except urllib.error.HTTPError as e:
+            # As for project tokens, a cached token may have been revoked
+            if e.code != 401:
+                raise
+            token, token_data = getKeystoneV3Token(fresh=True)
+            projects = getKeystoneV3Projects(token, user_id)
+        services = getKeystoneV3Catalog(
+            token, expires_at=token_data.get('expires_at'))
+
+        for tenant_name, server, flavor in summarizeProjects(
+                summarizeV3Project, projects, services):
+            add(tenant_name, server, flavor)
+
+    else:
+        # Raised rather than exiting, so the exporter can carry on serving
+        # what it last had
+        raise Exception('Unknown auth version %s' % auth_version)
+
+
+class Aggregator(object):
+    # Rolls servers up into totals grouped by any combination of tenant,
+    # flavor, status and image. Rather than keeping rows, each server
+    # becomes one entry in a set of columns: numbers go into arrays, and
+    # the grouping columns hold small integer codes into a table of the
+    # distinct values seen. That keeps memory small for big clouds, and a
+    # rollup is a single pass over a few arrays.
+    DIMENSIONS = ['tenant', 'flavor', 'status', 'image']
+
+    def __init__(self, pricing=None):
+        self.pricing = pricing
+        self.values = {}
+        self.codes = {}
+        self.columns = {}
+        for dimension in self.DIMENSIONS:
+            self.values[dimension] = []
+            self.codes[dimension] = {}
+            self.columns[dimension] = array.array('L')
+
+        self.vcpus = array.array('q')
+        self.ram = array.array('q')
+        self.disk = array.array('q')
+        self.cost = array.array('d')
+
+    def _code(self, dimension, value):
+        code = self.codes[dimension].get(value)
+        if code is None:
+            code = len(self.values[dimension])
+            self.codes[dimension][value] = code
+            self.values[dimension].append(value)
+        return code
+
+    def price(self, flavor):
+        # The monthly price of one instance of a flavor. Flavors can be
+        # priced directly, and otherwise are priced by their resources.
+        if not self.pricing:
+            return 0.0
+        flavor_prices = self.pricing.get('flavors', {})
+        if flavor.get('name') in flavor_prices:
+            return float(flavor_prices[flavor.get('name')])
+        return (flavor.get('vcpus', 0) * self.pricing.get('vcpu', 0) +
+                flavor.get('ram', 0) / 1024 * self.pricing.get('ram_gib', 0) +
+                flavor.get('disk', 0) * self.pricing.get('disk_gib', 0))
+
+    def add(self, tenant, server, flavor):
+        image = server.get('image')
+        if type(image) == dict:
+            image = image.get('id')
+
+        self.columns['tenant'].append(self._code('tenant', tenant))
+        self.columns['flavor'].append(self._code('flavor', flavor.get('name')))
+        self.columns['status'].append(self._code('status',
+                                                 server.get('status')))
+        self.columns['image'].append(self._code('image',
+                                                image or 'boot from volume'))
+        self.vcpus.append(flavor.get('vcpus', 0))
+        self.ram.append(flavor.get('ram', 0))
+        self.disk.append(flavor.get('disk', 0))
+        self.cost.append(self.price(flavor))
+
+    def headers(self, group_by):
+        headers = group_by + ['instances', 'vcpus', 'ram_mib', 'disk_gib']
+        if self.pricing:
+            headers.append('monthly_cost')
+        return headers
+
+    def rollup(self, group_by):
+        # Returns rows of the group's values followed by its totals, biggest
+        # groups first
+        if len(group_by) == 1:
+            keys = self.columns[group_by[0]]
+        else:
+            keys = zip(*[self.columns[dimension] for dimension in group_by])
+
+        totals = collections.defaultdict(lambda: [0, 0, 0, 0, 0.0])
+        for key, vcpus, ram, disk, cost in zip(keys, self.vcpus, self.ram,
+                                               self.disk, self.cost):
+            total = totals[key]
+            total[0] += 1
+            total[1] += vcpus
+            total[2] += ram
+            total[3] += disk
+            total[4] += cost
+
+        rows = []
+        for key, total in totals.items():
+            if len(group_by) == 1:
+                key = (key, )
+            row = [self.values[dimension][code]
+                   for dimension, code in zip(group_by, key)]
+            row += total[:4]
+            if self.pricing:
+                row.append(round(total[4], 2))
+            rows.append(row)
+
+        rows.sort(key=lambda row: row[:len(group_by)])
+        rows.sort(key=lambda row: row[len(group_by):], reverse=True)
+        return rows
+
+
 class PrettyOut(object):
-    def __init__(self, style, headers):
+    # Tables need every row before they can be laid out, but csv and
+    # JSON lines output is written as each row arrives.
+    def __init__(self, style, headers, out=sys.stdout):
         self.style = style
         self.headers = headers
+        self.out = out
         self.rows = []
 
+        if self.style == 'csv':
+            self.csv_file = csv.writer(self.out, delimiter=',')
+            self.csv_file.writerow(self.headers)
+        elif self.style not in ('table', 'jsonl'):
+            raise Exception('Unknown output style %s' % self.style)
+
     def add(self, values):
-        self.rows.append(values)
+        if self.style == 'table':
+            self.rows.append(values)
+        elif self.style == 'csv':
+            self.csv_file.writerow(values)
+        else:
+            self.out.write(json.dumps(dict(zip(self.headers, values)),
+                                      sort_keys=True) + '\n')
 
     def emit(self):
         if self.style == 'table':
@@ -234,99 +1042,293 @@ class PrettyOut(object):
             for row in self.rows:
                 pt.add_row(row)
 
-            return str(pt)
-
-        elif self.style == 'csv':
-            f = StringIO()
-            csv_file = csv.writer(f, delimiter=',')
-            csv_file.writerow(self.headers)
-
-            for row in self.rows:
-                csv_file.writerow(row)
-
-            return f.getvalue()
-
-        else:
-            raise Exception('Unknown output style %s' % self.style)
+            self.out.write(str(pt) + '\n')
+        self.out.flush()
+
+
+class Exporter(object):
+    # Keeps the inventory in memory and serves it as Prometheus metrics. A
+    # refresh builds a new set of metrics off to the side and then swaps it
+    # in, so scrapes always see a complete snapshot and never wait on, or
+    # cause, calls to keystone and nova. Refreshes after the first only
+    # fetch servers which have changed, via the server store.
+    GROUP_BY = ['tenant', 'flavor', 'status']
+
+    def __init__(self, pricing=None):
+        self.pricing = pricing
+        self.inventory = ''
+        self.refreshes = 0
+        self.failures = 0
+        self.last_success = 0.0
+        self.last_duration = 0.0
+
+    @staticmethod
+    def _labels(names, values):
+        labels = []
+        for name, value in zip(names, values):
+            value = str(value).replace('\\', '\\\\').replace(
+                '"', '\\"').replace('\n', '\\n')
+            labels.append('%s="%s"' % (name, value))
+        return '{%s}' % ','.join(labels)
+
+    def render(self, aggregator):
+        metrics = [
+            ('openstack_instances', 'Number of instances.'),
+            ('openstack_instance_vcpus', 'Total vCPUs of instances.'),
+            ('openstack_instance_ram_mib', 'Total RAM of instances in MiB.'),
+            ('openstack_instance_disk_gib',
+             'Total root disk of instances in GiB.')
+        ]
+        if self.pricing:
+            metrics.append(('openstack_instance_monthly_cost',
+                            'Total monthly cost of instances.'))
+
+        rows = aggregator.rollup(self.GROUP_BY)
+        lines = []
+        for index, (name, description) in enumerate(metrics):
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s gauge' % name)
+            for row in rows:
+                lines.append('%s%s %s' % (
+                    name, self._labels(self.GROUP_BY, row),
+                    row[len(self.GROUP_BY) + index]))
+        return '\n'.join(lines) + '\n'
+
+    def refresh(self):
+        global flavor_cache
+
+        # Flavors can be changed or deleted between refreshes, so start
+        # with an empty cache each time
+        flavor_cache = FlavorCache()
+        aggregator = Aggregator(pricing=self.pricing)
+
+        start = time.time()
+        try:
+            collectServers(aggregator.add)
+        except Exception as e:
+            self.failures += 1
+            sys.stderr.write('Refresh failed, keeping the last inventory: '
+                             '%s\n' % e)
+            return
+        finally:
+            self.refreshes += 1
+            self.last_duration = time.time() - start
+
+        self.inventory = self.render(aggregator)
+        self.last_success = time.time()
+        if args.verbose:
+            print('Refreshed %d instances in %.2f seconds'
+                  % (len(aggregator.vcpus), self.last_duration))
+
+    def metrics(self):
+        lines = [
+            '# HELP instance_summary_refreshes_total Inventory refreshes.',
+            '# TYPE instance_summary_refreshes_total counter',
+            'instance_summary_refreshes_total %d' % self.refreshes,
+            '# HELP instance_summary_refresh_failures_total Inventory '
+            'refreshes which failed.',
+            '# TYPE instance_summary_refresh_failures_total counter',
+            'instance_summary_refresh_failures_total %d' % self.failures,
+            '# HELP instance_summary_last_success_timestamp_seconds When the '
+            'inventory was last refreshed.',
+            '# TYPE instance_summary_last_success_timestamp_seconds gauge',
+            'instance_summary_last_success_timestamp_seconds %.3f'
+            % self.last_success,
+            '# HELP instance_summary_refresh_duration_seconds How long the '
+            'last refresh took.',
+            '# TYPE instance_summary_refresh_duration_seconds gauge',
+            'instance_summary_refresh_duration_seconds %.3f'
+            % self.last_duration
+        ]
+
+        endpoints = request_stats.summary()['endpoints']
+        for name, key, kind, description in [
+                ('instance_summary_api_requests_total', 'requests', 'counter',
+                 'Requests made to keystone and nova.'),
+                ('instance_summary_api_errors_total', 'errors', 'counter',
+                 'Requests to keystone and nova which failed.'),
+                ('instance_summary_api_seconds_total', 'seconds', 'counter',
+                 'Time spent waiting for keystone and nova.')]:
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for label in sorted(endpoints):
+                lines.append('%s%s %s' % (
+                    name, self._labels(['endpoint'], [label]),
+                    endpoints[label][key]))
+
+        return self.inventory + '\n'.join(lines) + '\n'
+
+    def serve(self, address, interval):
+        exporter = self
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+
+                body = exporter.metrics().encode()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *log_args):
+                if args.verbose:
+                    super().log_message(format, *log_args)
+
+        server = http.server.ThreadingHTTPServer(address, MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        # Runs until we're interrupted or killed
+        try:
+            while True:
+                start = time.monotonic()
+                self.refresh()
+                time.sleep(max(0, interval - (time.monotonic() - start)))
+        finally:
+            server.shutdown()
+            server.server_close()
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--style', default='table',
-                        help='Output style. One of csv or table.')
+                        help=('Output style. One of csv, jsonl (one JSON '
+                              'object per line) or table. csv and jsonl are '
+                              'written as servers are fetched.'))
     parser.add_argument('--tenants',
                         help=('List of tenants to process, separated by commas. '
                               'This is used only for Keystone v2 authenticated users. '
                               'For example: foo=1234,bar=5687'))
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help=('Number of projects to fetch at once, which is '
+                              'also the most requests we will have in flight '
+                              'against keystone and nova.'))
+    parser.add_argument('--page-size', type=int, default=DEFAULT_PAGE_SIZE,
+                        help='Number of servers to request from nova at once.')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR,
+                        help=('Where to cache keystone tokens and the service '
+                              'catalog between runs (default: %s).'
+                              % DEFAULT_CACHE_DIR))
+    parser.add_argument('--no-cache', action='store_true',
+                        help=('Always authenticate and list every server, '
+                              'and do not cache anything between runs.'))
+    parser.add_argument('--full-sync', action='store_true',
+                        help=('List every server again, rather than just '
+                              'those which changed since the last run.'))
+    parser.add_argument('--group-by', action='append', default=[],
+                        help=('Instead of listing servers, total them up by '
+                              'one or more of %s, separated by commas. For '
+                              'example: --group-by tenant or --group-by '
+                              'tenant,flavor. Can be given more than once.'
+                              % ', '.join(Aggregator.DIMENSIONS)))
+    parser.add_argument('--pricing',
+                        help=('A JSON file of monthly prices, used to add a '
+                              'cost to each group. Keys are "vcpu", '
+                              '"ram_gib" and "disk_gib" for per resource '
+                              'prices, and "flavors" for a map of flavor '
+                              'name to price, which takes precedence.'))
+    parser.add_argument('--serve', type=int, metavar='PORT',
+                        help=('Run until killed, refreshing the inventory '
+                              'every --interval seconds, and serve Prometheus '
+                              'metrics on this port at /metrics. Scrapes are '
+                              'answered from the last refresh, and never call '
+                              'keystone or nova. --style and --group-by are '
+                              'ignored.'))
+    parser.add_argument('--listen', default='0.0.0.0',
+                        help='Address to serve metrics on.')
+    parser.add_argument('--interval', type=int, default=DEFAULT_INTERVAL,
+                        help=('Seconds between refreshes when serving '
+                              'metrics (default: %d).' % DEFAULT_INTERVAL))
+    parser.add_argument('--stats', action='store_true',
+                        help=('Print how long requests to each endpoint took '
+                              'to stderr when we exit.'))
+    parser.add_argument('--stats-file',
+                        help=('Write how long requests to each endpoint took '
+                              'to this file as JSON when we exit.'))
     parser.add_argument('--verbose',
                         help='increase output verbosity',
                         action='store_true')
 
     args = parser.parse_args()
+    pool = ConnectionPool(max_idle=args.concurrency)
+
+    # These run at exit even if we fail part way through, which is when
+    # the timings are most interesting
+    if args.stats:
+        atexit.register(request_stats.emit)
+    if args.stats_file:
+        atexit.register(request_stats.write_json, args.stats_file)
+    if not args.no_cache:
+        token_cache = TokenCache(args.cache_dir)
+        server_store = ServerStore(os.path.join(args.cache_dir,
+                                                'servers.sqlite'))
+
+    group_bys = []
+    for spec in args.group_by:
+        group_by = spec.split(',')
+        for dimension in group_by:
+            if dimension not in Aggregator.DIMENSIONS:
+                print('Unknown dimension to group by %s' % dimension)
+                sys.exit(1)
+        group_bys.append(group_by)
+
+    pricing = None
+    if args.pricing:
+        with open(args.pricing) as f:
+            pricing = json.load(f)
+
+    if args.serve:
+        # Exit cleanly when we're stopped, so temporary files are removed
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        if args.no_cache:
+            # Nothing is kept between runs, but within this one only the
+            # first refresh needs to authenticate and list every server
+            token_dir = tempfile.TemporaryDirectory(
+                prefix='instance-summary-')
+            token_cache = TokenCache(token_dir.name)
+            server_store = ServerStore(':memory:')
+
+        try:
+            Exporter(pricing).serve((args.listen, args.serve), args.interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            pool.close()
+            server_store.close()
+        sys.exit(0)
+
+    if group_bys:
+        aggregator = Aggregator(pricing=pricing)
+        add = aggregator.add
 
-    server_keys = ['id', 'name', 'flavor', 'image', 'status', 'addresses', 'tenant']
-    po = PrettyOut(args.style, server_keys)
-    server_keys = server_keys[:-1]
-
-    auth_version = getKeystoneVersion()
-    if auth_version.startswith('v2'):
-        # Keystone v2 doesn't let us see all the user's projects without
-        # doing some manual work. Allow users to specify tenants on the
-        # command line and then iterate them.
-        if not args.tenants:
-            projects = [
-                {
-                    'name': os.environ.get('OS_TENANT_NAME'),
-                    'id': os.environ.get('OS_TENANT_ID')
-                }
-            ]
-        else:
-            projects = []
-            for spec in args.tenants.split(','):
-                name, id = spec.split('=')
-                projects.append({
-                    'name': name,
-                    'id': id
-                })
-
-        for tenant in projects:
-            token_data, endpoints = getKeystoneV2Token(tenant=tenant.get('name'))
-            token = token_data.get('id')
-
-            services = {}
-            for endpoint in endpoints:
-                name = endpoint.get('name')
-                services[name] = endpoint.get('endpoints')[0].get('publicURL')
-
-            flavors = {}
-            for flavor in getFlavors(token, services['nova'], tenant.get('id')):
-                flavors[flavor.get('id')] = '%(name)s: %(vcpus)s cpu, %(ram)s MiB RAM, %(disk)s GiB disk' % flavor
-
-            for server in getServers(token, services['nova'], tenant.get('id')):
-                summary = summarizeServer(server_keys, server, flavors)
-                summary.append(tenant.get('name'))
-                po.add(summary)
-
-    elif auth_version.startswith('v3'):
-        token, token_data = getKeystoneV3Token()
-        user_id = token_data.get('user').get('id')
-        projects = getKeystoneV3Projects(token, user_id)
-        services = getKeystoneV3Catalog(token)
+    else:
+        server_keys = ['id', 'name', 'flavor', 'image', 'status', 'addresses', 'tenant']
+        po = PrettyOut(args.style, server_keys)
+        server_keys = server_keys[:-1]
 
-        for tenant in projects:
-            ptoken, ptoken_data = getKeystoneV3Token(scope=tenant.get('id'))
+        def add(tenant_name, server, flavor):
+            summary = summarizeServer(server_keys, server, flavor)
+            summary.append(tenant_name)
+            po.add(summary)
 
-            flavors = {}
-            for flavor in getFlavors(ptoken, services['nova'], tenant.get('id')):
-                flavors[flavor.get('id')] = '%(name)s: %(vcpus)s cpu, %(ram)s MiB RAM, %(disk)s GiB disk' % flavor
+    collectServers(add)
 
-            for server in getServers(ptoken, services['nova'], tenant.get('id')):
-                summary = summarizeServer(server_keys, server, flavors)
-                summary.append(tenant.get('name'))
-                po.add(summary)
+    pool.close()
+    if server_store:
+        server_store.close()
 
+    if group_bys:
+        for index, group_by in enumerate(group_bys):
+            if index and args.style != 'jsonl':
+                print()
+            po = PrettyOut(args.style, aggregator.headers(group_by))
+            for row in aggregator.rollup(group_by):
+                po.add(row)
+            po.emit()
     else:
-        print('Unknown auth version %s' % auth_version)
-        sys.exit(1)
-
-    print(po.emit())
\ No newline at end of file
+        po.emit()
\ No newline at end of file
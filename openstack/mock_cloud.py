@@ -0,0 +1,391 @@
+#!/usr/bin/python3
+
+# A stand in for keystone and nova, implementing just the calls
+# instance_summary.py makes, so it can be tested and benchmarked without a
+# real cloud. Projects, flavors and servers are generated from their index
+# rather than stored, so very large clouds are cheap to pretend to be.
+#
+# Keystone is at /v3 (or /v2.0 with --keystone v2), and nova at
+# /compute/v2.1/<tenant id>. GET /_stats returns request counts, and
+# POST /_stats/reset zeroes them.
+
+import argparse
+import collections
+import datetime
+import http.server
+import json
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+
+
+# Nova's default osapi_max_limit
+DEFAULT_MAX_LIMIT = 1000
+
+TOKEN_LIFETIME = datetime.timedelta(hours=12)
+
+
+class MockCloud(object):
+    def __init__(self, projects=10, servers=10, flavors=5,
+                 private_flavors=1, keystone='v3', latency=0.0,
+                 max_limit=DEFAULT_MAX_LIMIT):
+        self.projects = projects
+        self.servers = servers
+        self.flavors = flavors
+        self.private_flavors = private_flavors
+        self.keystone = keystone
+        self.latency = latency
+        self.max_limit = max_limit
+        self.base_url = None
+
+        # Everything was created when we started, so changes-since after
+        # that returns nothing
+        self.created = datetime.datetime.now(datetime.timezone.utc)
+
+        self.lock = threading.Lock()
+        self.tokens = set()
+        self.stats = collections.Counter()
+
+    def project(self, index):
+        return {
+            'id': 'project-%06d' % index,
+            'name': 'project-%d' % index,
+            'domain_id': 'default',
+            'enabled': True
+        }
+
+    def project_index(self, id_or_name):
+        # Projects are found by id, or by name for keystone v2
+        try:
+            index = int(id_or_name.split('-')[-1])
+        except ValueError:
+            return None
+        if index >= self.projects:
+            return None
+        if id_or_name not in (self.project(index)['id'],
+                              self.project(index)['name']):
+            return None
+        return index
+
+    def flavor(self, index):
+        # The last few flavors are private to project 0, so they only show
+        # up in its flavor listing
+        return {
+            'id': 'flavor-%d' % index,
+            'name': 'm1.size%d' % index,
+            'vcpus': 1 << (index % 6),
+            'ram': 512 << (index % 8),
+            'disk': 10 * (index + 1),
+            'os-flavor-access:is_public': index < self.flavors,
+            'links': []
+        }
+
+    def visible_flavors(self, project):
+        count = self.flavors
+        if project == 0:
+            count += self.private_flavors
+        return [self.flavor(index) for index in range(count)]
+
+    def server(self, project, index):
+        # Servers in every project but the first use a mix of public
+        # flavors, and project 0's servers also use its private ones
+        flavor_count = self.flavors
+        if project == 0:
+            flavor_count += self.private_flavors
+        timestamp = self.created.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+        return {
+            'id': 'server-%06d-%06d' % (project, index),
+            'name': 'vm-%d-%d' % (project, index),
+            'tenant_id': self.project(project)['id'],
+            'user_id': 'user-0',
+            'status': 'SHUTOFF' if index % 10 == 9 else 'ACTIVE',
+            'flavor': {'id': 'flavor-%d' % (index % flavor_count)},
+            'image': {'id': 'image-%d' % (index % 3)} if index % 4 else '',
+            'addresses': {
+                'private': [
+                    {'addr': '10.%d.%d.%d' % (project % 256, index // 256 % 256,
+                                              index % 256),
+                     'version': 4}
+                ]
+            },
+            'created': timestamp,
+            'updated': timestamp,
+            'metadata': {}
+        }
+
+    def issue_token(self):
+        token = uuid.uuid4().hex
+        with self.lock:
+            self.tokens.add(token)
+        expires = datetime.datetime.now(datetime.timezone.utc) + TOKEN_LIFETIME
+        return token, expires.strftime('%Y-%m-%dT%H:%M:%S.000000Z')
+
+    def valid_token(self, token):
+        with self.lock:
+            return token in self.tokens
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+
+class MockHandler(http.server.BaseHTTPRequestHandler):
+    # HTTP/1.1 so clients can keep connections alive
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    @property
+    def cloud(self):
+        return self.server.cloud
+
+    def send_json(self, code, data, headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length))
+
+    def handle_request(self, method):
+        url = urllib.parse.urlsplit(self.path)
+        path = url.path.rstrip('/').split('/')[1:]
+        query = dict(urllib.parse.parse_qsl(url.query))
+
+        if path[:1] == ['_stats']:
+            if method == 'POST':
+                with self.cloud.lock:
+                    self.cloud.stats.clear()
+            with self.cloud.lock:
+                stats = dict(self.cloud.stats)
+            return self.send_json(200, stats)
+
+        if self.cloud.latency:
+            time.sleep(self.cloud.latency)
+
+        if path[:1] == ['v3'] and self.cloud.keystone == 'v3':
+            return self.keystone_v3(method, path[1:])
+        if path[:1] == ['v2.0'] and self.cloud.keystone == 'v2':
+            return self.keystone_v2(method, path[1:])
+        if path[:2] == ['compute', 'v2.1'] and len(path) > 2:
+            return self.nova(method, path[2], path[3:], query)
+        return self.send_json(404, {'error': 'not found'})
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def authenticated(self):
+        if self.cloud.valid_token(self.headers.get('X-Auth-Token')):
+            return True
+        self.send_json(401, {'error': {'code': 401,
+                                       'message': 'Unauthorized'}})
+        return False
+
+    def keystone_v3(self, method, path):
+        cloud = self.cloud
+        if not path and method == 'GET':
+            cloud.count('keystone version')
+            return self.send_json(200, {'version': {'id': 'v3.14',
+                                                    'status': 'stable'}})
+
+        if path == ['auth', 'tokens'] and method == 'POST':
+            cloud.count('keystone token')
+            scope = self.read_json().get('auth', {}).get('scope', {})
+            token, expires_at = cloud.issue_token()
+            data = {
+                'expires_at': expires_at,
+                'user': {'id': 'user-0', 'name': 'admin'},
+                'methods': ['password']
+            }
+            if 'project' in scope:
+                index = cloud.project_index(scope['project'].get('id', ''))
+                if index is None:
+                    return self.send_json(401, {'error': 'unknown project'})
+                data['project'] = cloud.project(index)
+            return self.send_json(201, {'token': data},
+                                  headers={'X-Subject-Token': token})
+
+        if not self.authenticated():
+            return
+
+        if len(path) == 3 and path[0] == 'users' and path[2] == 'projects':
+            cloud.count('keystone projects')
+            return self.send_json(200, {'projects': [
+                cloud.project(index) for index in range(cloud.projects)]})
+
+        if path == ['services']:
+            cloud.count('keystone services')
+            return self.send_json(200, {'services': [
+                {'id': 'service-nova', 'name': 'nova', 'type': 'compute'},
+                {'id': 'service-keystone', 'name': 'keystone',
+                 'type': 'identity'}]})
+
+        if path == ['endpoints']:
+            cloud.count('keystone endpoints')
+            return self.send_json(200, {'endpoints': [
+                {'id': 'endpoint-nova', 'service_id': 'service-nova',
+                 'interface': 'public',
+                 'url': '%s/compute/v2.1/%%(tenant_id)s' % cloud.base_url},
+                {'id': 'endpoint-keystone', 'service_id': 'service-keystone',
+                 'interface': 'public', 'url': '%s/v3' % cloud.base_url}]})
+
+        return self.send_json(404, {'error': 'not found'})
+
+    def keystone_v2(self, method, path):
+        cloud = self.cloud
+        if not path and method == 'GET':
+            cloud.count('keystone version')
+            return self.send_json(200, {'version': {'id': 'v2.0',
+                                                    'status': 'stable'}})
+
+        if path == ['tokens'] and method == 'POST':
+            cloud.count('keystone token')
+            tenant_name = self.read_json().get('auth', {}).get('tenantName')
+            index = cloud.project_index(tenant_name or '')
+            if index is None:
+                return self.send_json(401, {'error': 'unknown tenant'})
+            tenant = cloud.project(index)
+
+            token, expires_at = cloud.issue_token()
+            return self.send_json(200, {'access': {
+                'token': {'id': token, 'expires': expires_at,
+                          'tenant': tenant},
+                'serviceCatalog': [
+                    {'name': 'nova', 'type': 'compute', 'endpoints': [
+                        {'publicURL': '%s/compute/v2.1/%s'
+                                      % (cloud.base_url, tenant['id'])}]}
+                ]}})
+
+        return self.send_json(404, {'error': 'not found'})
+
+    def nova(self, method, tenant_id, path, query):
+        cloud = self.cloud
+        project = cloud.project_index(tenant_id)
+        if project is None:
+            return self.send_json(404, {'error': 'unknown project'})
+        if method != 'GET':
+            return self.send_json(405, {'error': 'read only'})
+        if not self.authenticated():
+            return
+
+        if path == ['flavors', 'detail']:
+            cloud.count('nova flavors')
+            return self.send_json(200,
+                                  {'flavors': cloud.visible_flavors(project)})
+
+        if len(path) == 2 and path[0] == 'flavors':
+            cloud.count('nova flavor')
+            for flavor in cloud.visible_flavors(project):
+                if flavor['id'] == path[1]:
+                    return self.send_json(200, {'flavor': flavor})
+            return self.send_json(404, {'itemNotFound': {'code': 404}})
+
+        if path == ['servers', 'detail']:
+            cloud.count('nova servers')
+            return self.servers(project, query)
+
+        return self.send_json(404, {'error': 'not found'})
+
+    def servers(self, project, query):
+        cloud = self.cloud
+        limit = min(int(query.get('limit', cloud.max_limit)), cloud.max_limit)
+
+        start = 0
+        if 'marker' in query:
+            try:
+                _, marker_project, marker_index = query['marker'].split('-')
+                start = int(marker_index) + 1
+            except ValueError:
+                return self.send_json(400, {'badRequest': {
+                    'message': 'marker not found'}})
+            if int(marker_project) != project:
+                return self.send_json(400, {'badRequest': {
+                    'message': 'marker not found'}})
+
+        count = cloud.servers
+        if 'changes-since' in query:
+            since = datetime.datetime.fromisoformat(
+                query['changes-since'].replace('Z', '+00:00'))
+            if since > cloud.created:
+                count = 0
+
+        end = min(start + limit, count)
+        data = {'servers': [cloud.server(project, index)
+                            for index in range(start, end)]}
+        if end - start == limit and end < count:
+            data['servers_links'] = [{
+                'rel': 'next',
+                'href': '%s/compute/v2.1/%s/servers/detail?%s' % (
+                    cloud.base_url, cloud.project(project)['id'],
+                    urllib.parse.urlencode(
+                        {'limit': limit,
+                         'marker': data['servers'][-1]['id']}))}]
+        return self.send_json(200, data)
+
+
+class MockServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, cloud, verbose=False):
+        super().__init__(address, MockHandler)
+        self.cloud = cloud
+        self.verbose = verbose
+        host, port = self.server_address[:2]
+        cloud.base_url = 'http://%s:%d' % (host, port)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Pretend to be keystone and nova for instance_summary.py.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0,
+                        help='Port to listen on (default: any free port).')
+    parser.add_argument('--projects', type=int, default=10)
+    parser.add_argument('--servers', type=int, default=10,
+                        help='Number of servers in each project.')
+    parser.add_argument('--flavors', type=int, default=5,
+                        help='Number of public flavors.')
+    parser.add_argument('--private-flavors', type=int, default=1,
+                        help='Number of flavors private to the first project.')
+    parser.add_argument('--keystone', choices=['v2', 'v3'], default='v3')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds to wait before answering each request.')
+    parser.add_argument('--max-limit', type=int, default=DEFAULT_MAX_LIMIT,
+                        help='Most servers returned by one listing.')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Log each request.')
+    args = parser.parse_args()
+
+    cloud = MockCloud(projects=args.projects, servers=args.servers,
+                      flavors=args.flavors,
+                      private_flavors=args.private_flavors,
+                      keystone=args.keystone, latency=args.latency,
+                      max_limit=args.max_limit)
+    server = MockServer((args.host, args.port), cloud, verbose=args.verbose)
+
+    # The auth URL goes first on its own line, so scripts can wait for it
+    auth_path = '/v3' if args.keystone == 'v3' else '/v2.0'
+    print('OS_AUTH_URL=%s%s' % (cloud.base_url, auth_path), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    sys.exit(0)
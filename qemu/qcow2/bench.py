@@ -0,0 +1,190 @@
+#!/usr/bin/python3
+
+# Benchmark the parser against synthetic images from writer.py, so that
+# performance regressions show up as numbers. For each virtual size we
+# generate an image and then, in a fresh process so that peak RSS means
+# something, measure:
+#
+#   - parse time: opening the image and decoding the header and L1 table
+#   - walk throughput: streaming the full extent map (every L2 table)
+#   - read throughput: sequential reads and random 4 KiB reads through
+#     Qcow2Reader
+#   - peak RSS of the measuring process
+
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+
+from parser import Qcow2Image, EXTENT_NORMAL, EXTENT_COMPRESSED
+from reader import Qcow2Reader
+from writer import Qcow2Writer, parse_size
+
+
+DEFAULT_SIZES = '1G,16G,256G,1T,4T'
+RANDOM_READ_SIZE = 4096
+
+
+def _measure(path, read_bytes, random_reads, seed):
+    # Runs in a child process
+    result = {}
+
+    start = time.perf_counter()
+    with Qcow2Image(path) as image:
+        l1 = image.l1_table()
+        result['parse_seconds'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        extents = 0
+        allocated = []
+        for extent in image.extents(l1=l1):
+            extents += 1
+            if extent.kind in (EXTENT_NORMAL, EXTENT_COMPRESSED):
+                allocated.append((extent.virtual_offset, extent.length))
+        elapsed = time.perf_counter() - start
+        result['walk_seconds'] = elapsed
+        result['extents'] = extents
+        result['l2_tables'] = len(l1.allocated())
+        result['walk_clusters_per_second'] = image.cluster_count / elapsed
+        result['walk_l2_tables_per_second'] = len(l1.allocated()) / elapsed
+
+        reader = Qcow2Reader(image)
+        buf = bytearray(1024 * 1024)
+
+        # Sequential reads through allocated data
+        start = time.perf_counter()
+        done = 0
+        for offset, length in allocated:
+            reader.seek(offset)
+            while length > 0 and done < read_bytes:
+                count = reader.readinto(
+                    memoryview(buf)[:min(len(buf), length)])
+                done += count
+                length -= count
+            if done >= read_bytes:
+                break
+        elapsed = time.perf_counter() - start
+        result['sequential_read_bytes'] = done
+        result['sequential_read_mb_per_second'] = (
+            done / elapsed / 1024 / 1024 if elapsed else 0)
+
+        # Random small reads anywhere on the disk
+        rand = random.Random(seed)
+        small = bytearray(RANDOM_READ_SIZE)
+        start = time.perf_counter()
+        for _ in range(random_reads):
+            reader.seek(rand.randrange(0, image.virtual_size -
+                                       RANDOM_READ_SIZE,
+                                       RANDOM_READ_SIZE))
+            reader.readinto(small)
+        elapsed = time.perf_counter() - start
+        result['random_reads_per_second'] = (
+            random_reads / elapsed if elapsed else 0)
+        result['l2_cache_hits'] = reader.l2_cache_hits
+        result['l2_cache_misses'] = reader.l2_cache_misses
+        reader.close()
+
+    # ru_maxrss is in kilobytes on Linux
+    result['peak_rss_mb'] = (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+    return result
+
+
+def run(sizes, directory, density=0.01, compressed=0.0, snapshots=0,
+        cluster_bits=16, read_bytes=256 * 1024 * 1024, random_reads=2000,
+        seed=0, keep=False):
+    # A spawned (not forked) worker per image, so peak RSS isn't inherited
+    # from the process which generated the image
+    context = multiprocessing.get_context('spawn')
+
+    for size in sizes:
+        path = os.path.join(directory, f'bench-{size}.qcow2')
+        start = time.perf_counter()
+        Qcow2Writer(path, size, cluster_bits=cluster_bits, density=density,
+                    compressed=compressed, snapshots=snapshots,
+                    seed=seed).write()
+        generate_seconds = time.perf_counter() - start
+
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=1, mp_context=context) as pool:
+            result = pool.submit(_measure, path, read_bytes, random_reads,
+                                 seed).result()
+
+        result['virtual_size'] = size
+        result['image_size'] = os.path.getsize(path)
+        result['generate_seconds'] = generate_seconds
+        if not keep:
+            os.unlink(path)
+        yield result
+
+
+def _human(size):
+    for unit in ['', 'K', 'M', 'G', 'T']:
+        if size < 1024:
+            return f'{size:.0f}{unit}'
+        size /= 1024
+    return f'{size:.0f}P'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the qcow2 parser on synthetic images.')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                        help='Comma separated virtual sizes to test.')
+    parser.add_argument('--density', type=float, default=0.01,
+                        help='Fraction of each disk to allocate.')
+    parser.add_argument('--compressed', type=float, default=0.0,
+                        help='Fraction of data clusters to compress.')
+    parser.add_argument('--snapshots', type=int, default=0)
+    parser.add_argument('--cluster-bits', type=int, default=16)
+    parser.add_argument('--read-mb', type=int, default=256,
+                        help='Megabytes to read sequentially per image.')
+    parser.add_argument('--random-reads', type=int, default=2000)
+    parser.add_argument('--dir', default=None,
+                        help='Where to write images (default: a temporary '
+                             'directory).')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep the generated images.')
+    parser.add_argument('--json', action='store_true',
+                        help='Emit one JSON object per size instead of a '
+                             'table.')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    directory = args.dir or tempfile.mkdtemp(prefix='qcow2-bench-')
+    sizes = [parse_size(size) for size in args.sizes.split(',')]
+
+    if not args.json:
+        print(f'{"Size":>6} {"Extents":>9} {"Parse ms":>9} {"Walk s":>8} '
+              f'{"Mclust/s":>9} {"Seq MB/s":>9} {"Rand IOPS":>10} '
+              f'{"RSS MB":>7}')
+
+    try:
+        for result in run(sizes, directory, density=args.density,
+                          compressed=args.compressed,
+                          snapshots=args.snapshots,
+                          cluster_bits=args.cluster_bits,
+                          read_bytes=args.read_mb * 1024 * 1024,
+                          random_reads=args.random_reads, seed=args.seed,
+                          keep=args.keep):
+            if args.json:
+                print(json.dumps(result, sort_keys=True), flush=True)
+                continue
+
+            print(f'{_human(result["virtual_size"]):>6} '
+                  f'{result["extents"]:>9} '
+                  f'{result["parse_seconds"] * 1000:>9.2f} '
+                  f'{result["walk_seconds"]:>8.3f} '
+                  f'{result["walk_clusters_per_second"] / 1e6:>9.1f} '
+                  f'{result["sequential_read_mb_per_second"]:>9.1f} '
+                  f'{result["random_reads_per_second"]:>10.0f} '
+                  f'{result["peak_rss_mb"]:>7.1f}', flush=True)
+    finally:
+        if not args.dir and not args.keep:
+            shutil.rmtree(directory, ignore_errors=True)
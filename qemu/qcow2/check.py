@@ -0,0 +1,325 @@
+#!/usr/bin/python3
+
+# A qemu-img check style consistency checker for qcow2 images. We work out
+# how many times each host cluster is referenced by the image metadata (the
+# header, L1 / L2 tables, refcount structures and snapshots) and compare that
+# with the refcounts stored on disk. Clusters with a refcount higher than
+# their references are leaked, which wastes space but is otherwise harmless.
+# Clusters with a refcount lower than their references are corrupt, as
+# freeing them would free data which is still in use.
+#
+# Both the L2 walk and the refcount block comparison are split into chunks
+# which run in a process pool. Each worker opens its own mapping of the image.
+
+import argparse
+import array
+import concurrent.futures
+import itertools
+import operator
+import os
+import sys
+
+from parser import Qcow2Image
+
+
+# The default number of chunks per worker process, which is a trade off
+# between load balancing and the overhead of handing work around
+CHUNKS_PER_WORKER = 4
+
+ONE = array.array('Q', [1])
+ZERO = array.array('Q', [0])
+
+
+class CheckResult:
+    def __init__(self):
+        self.leaks = []
+        self.corruptions = []
+        self.errors = []
+
+    def print(self):
+        for cluster, refcount, references in self.corruptions:
+            print(f'ERROR cluster {cluster} refcount={refcount} '
+                  f'reference={references}')
+        for cluster, refcount, references in self.leaks:
+            print(f'Leaked cluster {cluster} refcount={refcount} '
+                  f'reference={references}')
+        for error in self.errors:
+            print(f'ERROR {error}')
+
+        if not self.leaks and not self.corruptions and not self.errors:
+            print('No errors were found on the image.')
+        else:
+            print()
+            print(f'{len(self.corruptions) + len(self.errors)} errors were '
+                  f'found on the image.')
+            print(f'{len(self.leaks)} leaked clusters were found on the '
+                  f'image.')
+
+    def exit_code(self):
+        # The same exit codes as qemu-img check
+        if self.corruptions or self.errors:
+            return 2
+        if self.leaks:
+            return 3
+        return 0
+
+
+def _chunks(items, jobs):
+    size = max(1, len(items) // (jobs * CHUNKS_PER_WORKER))
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _check_host_offset(image, offset, what):
+    if offset & (image.cluster_size - 1):
+        return f'{what} offset {offset} is not cluster aligned'
+    if offset >= image.mm.max_size:
+        return f'{what} offset {offset} is beyond the end of the image file'
+    return None
+
+
+def _check_end(image, offset, length, what):
+    # For things which start inside the image file, whether they also end
+    # inside it. Only the part inside the file is counted as referenced.
+    end = offset + length
+    if end > image.mm.max_size:
+        return (f'{what} at offset {offset} runs {end - image.mm.max_size} '
+                f'bytes past the end of the image file')
+    return None
+
+
+def _walk_l2_tables(path, l2_offsets):
+    # Worker: return the host cluster runs referenced by data in the given
+    # L2 tables, as a flattened array of (first cluster, cluster count)
+    runs = array.array('Q')
+    errors = []
+
+    with Qcow2Image(path) as image:
+        cluster_bits = image.cluster_bits
+        cluster_size = image.cluster_size
+        for l2_offset in l2_offsets:
+            # Every cluster with a host offset is referenced, even if it
+            # reads as zeros or none of its subclusters are allocated
+            l2 = image.l2_table(l2_offset)
+            for host_offset, count in l2.host_clusters():
+                error = _check_host_offset(image, host_offset,
+                                           f'L2 table {l2_offset} data')
+                if error:
+                    errors.append(error)
+                    continue
+                error = _check_end(image, host_offset, count * cluster_size,
+                                   f'L2 table {l2_offset} data')
+                if error:
+                    errors.append(error)
+
+                runs.append(host_offset >> cluster_bits)
+                runs.append(count)
+
+            # Compressed data is byte aligned and may straddle clusters. The
+            # whole of every sector it touches is referenced.
+            for index, host_offset, length in l2.compressed_descriptors():
+                if host_offset >= image.mm.max_size:
+                    errors.append(f'L2 table {l2_offset} compressed data '
+                                  f'offset {host_offset} is beyond the end '
+                                  f'of the image file')
+                    continue
+                error = _check_end(image, host_offset, length,
+                                   f'L2 table {l2_offset} compressed data')
+                if error:
+                    errors.append(error)
+                first = host_offset >> cluster_bits
+                last = (host_offset + length - 1) >> cluster_bits
+                runs.append(first)
+                runs.append(last - first + 1)
+
+    return runs, errors
+
+
+def _compare_refcount_blocks(path, blocks):
+    # Worker: compare refcount blocks with expected reference counts. blocks
+    # is a list of (refcount table index, block offset, expected counts for
+    # the clusters covered by the block). The expected counts stop at the
+    # end of the image file, and clusters past that are expected to have a
+    # refcount of zero.
+    leaks = []
+    corruptions = []
+
+    with Qcow2Image(path) as image:
+        per_block = image.refcount_block_entries
+        for table_index, block_offset, expected in blocks:
+            if block_offset:
+                refcounts = array.array('Q', image.refcount_block(block_offset))
+            else:
+                refcounts = ZERO * len(expected)
+
+            covered = len(expected)
+            if (refcounts[:covered] == expected and
+                    not any(refcounts[covered:])):
+                continue
+
+            first_cluster = table_index * per_block
+            for index, (refcount, references) in enumerate(
+                    itertools.zip_longest(refcounts, expected, fillvalue=0)):
+                if refcount > references:
+                    leaks.append((first_cluster + index, refcount, references))
+                elif refcount < references:
+                    corruptions.append(
+                        (first_cluster + index, refcount, references))
+
+    return leaks, corruptions
+
+
+def check(path, jobs=None):
+    if not jobs:
+        jobs = os.cpu_count()
+    result = CheckResult()
+
+    with Qcow2Image(path) as image:
+        cluster_bits = image.cluster_bits
+        cluster_size = image.cluster_size
+        host_clusters = (image.mm.max_size + cluster_size - 1) >> cluster_bits
+        expected = array.array('Q', [0]) * host_clusters
+
+        def reference(offset, length, what):
+            error = _check_host_offset(image, offset, what)
+            if error:
+                result.errors.append(error)
+                return
+            error = _check_end(image, offset, length, what)
+            if error:
+                result.errors.append(error)
+            first = offset >> cluster_bits
+            last = (offset + max(length, 1) - 1) >> cluster_bits
+            for cluster in range(first, min(last, host_clusters - 1) + 1):
+                expected[cluster] += 1
+
+        # The header, and the metadata it points at directly
+        reference(0, cluster_size, 'header')
+        reference(image.refcount_table_offset,
+                  image.refcount_table_clusters * cluster_size,
+                  'refcount table')
+        refcount_table = image.refcount_table()
+        for table_index, block_offset in enumerate(refcount_table):
+            if block_offset:
+                reference(block_offset, cluster_size,
+                          f'refcount block {table_index}')
+
+        l1_tables = [(image.l1_table_offset, image.l1_size)]
+        snapshots = image.snapshots()
+        if snapshots:
+            last = snapshots[-1]
+            reference(image.snapshots_offset,
+                      (last.entry_offset + last.entry_length -
+                       image.snapshots_offset),
+                      'snapshot table')
+            for snapshot in snapshots:
+                l1_tables.append((snapshot.l1_table_offset, snapshot.l1_size))
+
+        # Persistent bitmaps: the directory, each bitmap table, and the data
+        # clusters the tables point to
+        bitmaps = image.bitmaps()
+        if bitmaps:
+            extension = image.bitmaps_extension
+            reference(extension['directory_offset'],
+                      extension['directory_size'], 'bitmap directory')
+            for bitmap in bitmaps:
+                reference(bitmap.table_offset, bitmap.table_size * 8,
+                          f'bitmap {bitmap.name} table')
+                _, offsets = image.bitmap_table(bitmap)
+                for offset in offsets:
+                    if offset:
+                        reference(offset, cluster_size,
+                                  f'bitmap {bitmap.name} data')
+
+        # L1 tables, and the L2 tables they point to. A L2 table shared
+        # between several L1 tables is referenced (and walked) once for each.
+        l2_offsets = []
+        for l1_table_offset, l1_size in l1_tables:
+            if not l1_size:
+                continue
+            reference(l1_table_offset, l1_size * 8, 'L1 table')
+            l1 = image.l1_table(l1_table_offset, l1_size)
+            for l1_index in l1.allocated():
+                l2_offset = l1.offsets[l1_index]
+                error = _check_host_offset(image, l2_offset,
+                                           f'L1 entry {l1_index} L2 table')
+                if error:
+                    result.errors.append(error)
+                    continue
+                reference(l2_offset, cluster_size, 'L2 table')
+                l2_offsets.append(l2_offset)
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            # Data clusters
+            futures = [pool.submit(_walk_l2_tables, path, chunk)
+                       for chunk in _chunks(l2_offsets, jobs)]
+            for future in futures:
+                runs, errors = future.result()
+                result.errors.extend(errors)
+                for i in range(0, len(runs), 2):
+                    first = runs[i]
+                    last = min(first + runs[i + 1], host_clusters)
+                    if last - first == 1:
+                        expected[first] += 1
+                    elif last > first:
+                        # Update the whole run with slice operations rather
+                        # than a cluster at a time. Usually nothing else
+                        # references the run, so it's all ones.
+                        counts = expected[first:last]
+                        if any(counts):
+                            counts = array.array('Q', map(
+                                operator.add, counts,
+                                itertools.repeat(1, last - first)))
+                        else:
+                            counts = ONE * (last - first)
+                        expected[first:last] = counts
+
+            # Compare against the refcount blocks. Referenced clusters
+            # outside the range covered by the refcount table have a refcount
+            # of zero, which is also a corruption.
+            per_block = image.refcount_block_entries
+            blocks = []
+            block_count = max(len(refcount_table),
+                              (host_clusters + per_block - 1) // per_block)
+            for table_index in range(block_count):
+                block_offset = 0
+                if table_index < len(refcount_table):
+                    block_offset = refcount_table[table_index]
+
+                # Most slots of a big refcount table have no block and cover
+                # only clusters past the end of the file, so skip those
+                # before slicing anything
+                first = table_index * per_block
+                if not block_offset and first >= host_clusters:
+                    continue
+                if (block_offset and
+                        block_offset + cluster_size > image.mm.max_size):
+                    # Already reported, and there's nothing to compare with
+                    continue
+                block_expected = expected[first:first + per_block]
+                if not block_offset and not any(block_expected):
+                    continue
+                blocks.append((table_index, block_offset, block_expected))
+
+            futures = [pool.submit(_compare_refcount_blocks, path, chunk)
+                       for chunk in _chunks(blocks, jobs)]
+            for future in futures:
+                leaks, corruptions = future.result()
+                result.leaks.extend(leaks)
+                result.corruptions.extend(corruptions)
+
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Check the refcounts of a qcow2 image for consistency.')
+    parser.add_argument('image')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='Number of worker processes (default: one per '
+                             'CPU).')
+    args = parser.parse_args()
+
+    result = check(args.image, jobs=args.jobs)
+    result.print()
+    sys.exit(result.exit_code())
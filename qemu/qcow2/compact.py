@@ -0,0 +1,502 @@
+#!/usr/bin/python3
+
+# Rewrite a qcow2 image into a new, defragmented file. Long lived images end
+# up with their L2 tables and data clusters scattered all over the host file,
+# so a sequential read of the guest disk turns into random I/O on the host.
+# The new image has all of its metadata together at the start of the file,
+# followed by the data clusters in virtual disk order and then the
+# compressed clusters, also in virtual order. Only clusters which something
+# references are copied, so leaked clusters are dropped, as are the host
+# clusters of preallocated zero clusters.
+#
+# Internal snapshots are kept, with their data laid out after the active
+# image's (in the virtual order of the first snapshot which uses it).
+# Persistent bitmaps are dropped, as qemu-img convert does by default. The
+# backing file reference is kept as is.
+#
+# Data is copied with pwritev() straight from the mapping of the source
+# image, so the new file is written sequentially in large batches without
+# copying the data in python.
+
+import argparse
+import array
+import os
+import struct
+import sys
+import time
+
+from parser import (
+    Qcow2Image, FormatError, COPIED_FLAG, COMPRESSED_SECTOR_SIZE,
+    COMPRESSED_FLAG, EXTENSION_BACKING_FORMAT, ZERO_FLAG,
+    INCOMPATIBLE_EXTENDED_L2)
+from writer import (
+    HEADER_FORMAT, HEADER_LENGTH, INCOMPATIBLE_COMPRESSION_TYPE, encode_be64,
+    encode_refcounts)
+
+
+# Data is written in batches of up to this many bytes
+COPY_BATCH_SIZE = 64 * 1024 * 1024
+
+# ... and of up to this many separate source ranges
+COPY_BATCH_RANGES = min(1024, os.sysconf('SC_IOV_MAX'))
+
+# Incompatible feature bit 2 means data lives in a separate file, which we
+# don't handle
+INCOMPATIBLE_EXTERNAL_DATA_FILE = 1 << 2
+
+
+class CompactStats:
+    def __init__(self):
+        self.old_size = 0
+        self.new_size = 0
+        self.l2_tables = 0
+        self.data_clusters = 0
+        self.compressed_clusters = 0
+        self.dropped_zero_clusters = 0
+        self.old_data_runs = 0
+        self.new_data_runs = 0
+
+
+class Compactor:
+    def __init__(self, source, output):
+        # source is an open Qcow2Image
+        self.image = source
+        self.output = output
+        self.stats = CompactStats()
+
+        image = source
+        if image.crypt_method:
+            raise FormatError('Encrypted images are not supported')
+        if image.incompatible_features & INCOMPATIBLE_EXTERNAL_DATA_FILE:
+            raise FormatError('Images with external data files are not '
+                              'supported')
+
+        self.cluster_size = image.cluster_size
+        self.cluster_bits = image.cluster_bits
+        self.words = image.l2_entry_size // 8
+
+    def _l1_tables(self):
+        # (L1 table, snapshot or None) for the active image and then each
+        # snapshot
+        image = self.image
+        tables = [(image.l1_table(), None)]
+        for snapshot in image.snapshots():
+            tables.append((image.l1_table(snapshot.l1_table_offset,
+                                          snapshot.l1_size), snapshot))
+        return tables
+
+    def _keep_host(self, l2, index):
+        # Whether a normal L2 entry's host cluster holds any data we need
+        if l2.extended:
+            return bool(l2.allocation_bitmaps[index])
+        return not l2.zero[index]
+
+    def _clusters(self, length):
+        return (length + self.cluster_size - 1) >> self.cluster_bits
+
+    def _plan(self):
+        # First pass: work out what needs copying. L2 tables, data clusters
+        # and compressed clusters are each numbered in the order they are
+        # first used, which is virtual disk order for the active image.
+        # References are counted at the same time, the same way check.py
+        # counts them, so the source image's refcounts (which might be stale
+        # if it is dirty) are never used.
+        self.l1_tables = self._l1_tables()
+
+        self.l2_order = []
+        self.l2_refs = {}
+        for l1, _ in self.l1_tables:
+            for l1_index in l1.allocated():
+                l2_offset = l1.offsets[l1_index]
+                if l2_offset not in self.l2_refs:
+                    self.l2_refs[l2_offset] = 0
+                    self.l2_order.append(l2_offset)
+                self.l2_refs[l2_offset] += 1
+
+        # old host offset -> index of the cluster in the new data area
+        self.data_index = {}
+        self.data_refcounts = array.array('Q')
+        # old compressed offset -> [offset in the new compressed area,
+        # length, references]
+        self.compressed = {}
+
+        next_host = None
+        for l2_offset in self.l2_order:
+            l2 = self.image.l2_table(l2_offset)
+            refs = self.l2_refs[l2_offset]
+            for index in [i for i, entry in enumerate(l2.raw) if entry]:
+                if l2.compressed[index]:
+                    host_offset, length = l2.compressed_descriptor(index)
+                    entry = self.compressed.get(host_offset)
+                    if entry is None:
+                        entry = [None, length, 0]
+                        self.compressed[host_offset] = entry
+                    entry[2] += refs
+                    continue
+
+                host_offset = l2.offsets[index]
+                if not host_offset:
+                    continue
+                if not self._keep_host(l2, index):
+                    self.stats.dropped_zero_clusters += 1
+                    continue
+
+                data_index = self.data_index.get(host_offset)
+                if data_index is None:
+                    data_index = len(self.data_refcounts)
+                    self.data_index[host_offset] = data_index
+                    self.data_refcounts.append(0)
+                    if host_offset != next_host:
+                        self.stats.old_data_runs += 1
+                    next_host = host_offset + self.cluster_size
+                self.data_refcounts[data_index] += refs
+
+        self._plan_compressed()
+        self.stats.l2_tables = len(self.l2_order)
+        self.stats.data_clusters = len(self.data_refcounts)
+        self.stats.new_data_runs = 1 if self.data_refcounts else 0
+
+    def _plan_compressed(self):
+        # A compressed descriptor's length is rounded up to the end of a 512
+        # byte sector, so the ranges of neighbouring compressed clusters
+        # overlap and the real end of each one isn't known without
+        # decompressing it. Instead, overlapping ranges are merged into spans
+        # which are copied as a whole, in the order each span is first used.
+        spans = []
+        for host_offset in sorted(self.compressed):
+            end = host_offset + self.compressed[host_offset][1]
+            if spans and host_offset <= spans[-1][1]:
+                spans[-1][1] = max(spans[-1][1], end)
+            else:
+                spans.append([host_offset, end])
+
+        span_of = {}
+        index = 0
+        for host_offset in sorted(self.compressed):
+            while host_offset >= spans[index][1]:
+                index += 1
+            span_of[host_offset] = spans[index]
+
+        # (source offset, length) of each span, in the new order
+        self.compressed_spans = []
+        span_base = {}
+        self.compressed_bytes = 0
+        for host_offset, entry in self.compressed.items():
+            start, end = span_of[host_offset]
+            if start not in span_base:
+                span_base[start] = self.compressed_bytes
+                self.compressed_spans.append((start, end - start))
+                self.compressed_bytes += end - start
+            entry[0] = span_base[start] + host_offset - start
+
+    def _layout(self):
+        # Second pass: assign host clusters. The header, L1 tables, snapshot
+        # table, L2 tables and refcount structures all go together at the
+        # start of the file, then the data, then the compressed data.
+        self.next_cluster = 1
+
+        def allocate(count):
+            offset = self.next_cluster << self.cluster_bits
+            self.next_cluster += count
+            return offset
+
+        self.l1_offsets = []
+        for l1, _ in self.l1_tables:
+            if len(l1):
+                self.l1_offsets.append(allocate(self._clusters(len(l1) * 8)))
+            else:
+                self.l1_offsets.append(0)
+
+        # Snapshot entries are copied as is, apart from the L1 table offset
+        # at the very start of each
+        self.snapshot_table = bytearray()
+        for (_, snapshot), l1_offset in zip(self.l1_tables[1:],
+                                            self.l1_offsets[1:]):
+            entry = bytearray(self.image.mm.view(snapshot.entry_offset,
+                                                 snapshot.entry_length))
+            struct.pack_into('>Q', entry, 0, l1_offset)
+            self.snapshot_table += entry
+        self.snapshots_offset = 0
+        if self.snapshot_table:
+            self.snapshots_offset = allocate(
+                self._clusters(len(self.snapshot_table)))
+
+        self.l2_offsets = {}
+        for l2_offset in self.l2_order:
+            self.l2_offsets[l2_offset] = allocate(1)
+
+        # The refcount structures cover themselves as well as the data after
+        # them, so grow them until they are big enough
+        data_clusters = len(self.data_refcounts)
+        compressed_clusters = self._clusters(self.compressed_bytes)
+        per_block = self.image.refcount_block_entries
+        blocks = 0
+        table_clusters = 1
+        while True:
+            total = (self.next_cluster + table_clusters + blocks +
+                     data_clusters + compressed_clusters)
+            needed_blocks = (total + per_block - 1) // per_block
+            needed_table = max(1, self._clusters(needed_blocks * 8))
+            if needed_blocks == blocks and needed_table == table_clusters:
+                break
+            blocks = needed_blocks
+            table_clusters = needed_table
+
+        self.refcount_table_offset = allocate(table_clusters)
+        self.refcount_table_clusters = table_clusters
+        self.refcount_block_offsets = [allocate(1) for _ in range(blocks)]
+        self.data_base = allocate(data_clusters)
+        self.compressed_base = allocate(compressed_clusters)
+        self.stats.compressed_clusters = compressed_clusters
+
+    def _refcounts(self):
+        refcounts = array.array('Q', [0]) * self.next_cluster
+        cluster_bits = self.cluster_bits
+
+        def reference(offset, length, count=1):
+            for cluster in range(offset >> cluster_bits,
+                                 ((offset + length - 1) >> cluster_bits) + 1):
+                refcounts[cluster] += count
+
+        reference(0, 1)
+        for (l1, _), l1_offset in zip(self.l1_tables, self.l1_offsets):
+            if l1_offset:
+                reference(l1_offset, len(l1) * 8)
+        if self.snapshot_table:
+            reference(self.snapshots_offset, len(self.snapshot_table))
+        for l2_offset, new_offset in self.l2_offsets.items():
+            reference(new_offset, 1, self.l2_refs[l2_offset])
+
+        # Everything from the refcount table up to the data is refcount
+        # structures
+        for cluster in range(self.refcount_table_offset >> cluster_bits,
+                             self.data_base >> cluster_bits):
+            refcounts[cluster] += 1
+
+        first = self.data_base >> cluster_bits
+        for index, count in enumerate(self.data_refcounts):
+            refcounts[first + index] += count
+
+        for new_offset, length, refs in self.compressed.values():
+            reference(self.compressed_base + new_offset, length, refs)
+
+        return refcounts
+
+    def _new_l2_table(self, l2_offset, refcounts):
+        l2 = self.image.l2_table(l2_offset)
+        words = self.words
+        cluster_bits = self.cluster_bits
+        offset_bits = 62 - (cluster_bits - 8)
+        entries = array.array('Q', [0]) * (len(l2) * words)
+
+        # Subcluster bitmaps are kept as they are
+        if l2.extended:
+            entries[1::2] = array.array(
+                'Q', [(zero << 32) | allocation for allocation, zero in
+                      zip(l2.allocation_bitmaps, l2.zero_bitmaps)])
+
+        for index in [i for i, entry in enumerate(l2.raw) if entry]:
+            if l2.compressed[index]:
+                host_offset, _ = l2.compressed_descriptor(index)
+                new_offset, length, _ = self.compressed[host_offset]
+                new_offset += self.compressed_base
+                sectors = (((new_offset + length - 1) //
+                            COMPRESSED_SECTOR_SIZE) -
+                           (new_offset // COMPRESSED_SECTOR_SIZE))
+                entries[index * words] = (COMPRESSED_FLAG |
+                                          (sectors << offset_bits) |
+                                          new_offset)
+                continue
+
+            descriptor = 0
+            if l2.zero[index]:
+                descriptor = ZERO_FLAG
+            elif l2.offsets[index] and self._keep_host(l2, index):
+                descriptor = self.data_base + (
+                    self.data_index[l2.offsets[index]] << cluster_bits)
+                if refcounts[descriptor >> cluster_bits] == 1:
+                    descriptor |= COPIED_FLAG
+            entries[index * words] = descriptor
+
+        return encode_be64(entries)
+
+    def _write_batched(self, fd, offset, pieces):
+        # Write buffers to consecutive offsets, gathered into large pwritev()
+        # calls
+        batch = []
+        batch_bytes = 0
+
+        def flush():
+            nonlocal offset, batch_bytes
+            while batch:
+                written = os.pwritev(fd, batch, offset)
+                offset += written
+                # Short writes can leave us part way through a buffer
+                while batch and written >= len(batch[0]):
+                    written -= len(batch.pop(0))
+                if batch and written:
+                    batch[0] = memoryview(batch[0])[written:]
+            batch_bytes = 0
+
+        for piece in pieces:
+            batch.append(piece)
+            batch_bytes += len(piece)
+            if (batch_bytes >= COPY_BATCH_SIZE or
+                    len(batch) >= COPY_BATCH_RANGES):
+                flush()
+        flush()
+        return offset
+
+    def _source_range(self, offset, length):
+        # Views of the source mapping. The file can be shorter than the
+        # clusters which are referenced from it if their tails were never
+        # written, and that reads as zeros.
+        available = max(0, min(length, self.image.mm.max_size - offset))
+        if available:
+            yield self.image.mm.view(offset, available)
+        if available < length:
+            yield bytes(length - available)
+
+    def _data_pieces(self):
+        # Clusters which are also contiguous in the source are copied as one
+        # range
+        cluster_size = self.cluster_size
+        run_start = None
+        run_length = 0
+        for host_offset in self.data_index:
+            if (host_offset == (run_start or 0) + run_length and
+                    run_length < COPY_BATCH_SIZE):
+                run_length += cluster_size
+                continue
+            if run_length:
+                yield from self._source_range(run_start, run_length)
+            run_start = host_offset
+            run_length = cluster_size
+        if run_length:
+            yield from self._source_range(run_start, run_length)
+
+    def _compressed_pieces(self):
+        for host_offset, length in self.compressed_spans:
+            yield from self._source_range(host_offset, length)
+
+    def _header(self):
+        image = self.image
+
+        # The dirty and corrupt bits don't apply to the new image, and
+        # neither do any compatible or autoclear features
+        incompatible = image.incompatible_features & (
+            INCOMPATIBLE_COMPRESSION_TYPE | INCOMPATIBLE_EXTENDED_L2)
+
+        extensions = b''
+        if image.backing_file and image.backing_format:
+            format = image.backing_format.encode()
+            extensions += struct.pack('>II', EXTENSION_BACKING_FORMAT,
+                                      len(format))
+            extensions += format + bytes(-len(format) % 8)
+        extensions += struct.pack('>II', 0, 0)
+
+        backing_file = b''
+        backing_file_offset = 0
+        if image.backing_file:
+            backing_file = image.backing_file.encode()
+            backing_file_offset = HEADER_LENGTH + len(extensions)
+
+        header = struct.pack(
+            HEADER_FORMAT, b'QFI\xfb', 3, backing_file_offset,
+            len(backing_file), self.cluster_bits, image.virtual_size, 0,
+            image.l1_size, self.l1_offsets[0], self.refcount_table_offset,
+            self.refcount_table_clusters, len(self.l1_tables) - 1,
+            self.snapshots_offset, incompatible, 0, 0, image.refcount_order,
+            HEADER_LENGTH, image.compression_type)
+        header += extensions + backing_file
+        if len(header) > self.cluster_size:
+            raise FormatError('Header does not fit in the first cluster')
+        return header
+
+    def compact(self):
+        self.stats.old_size = self.image.mm.max_size
+        self._plan()
+        self._layout()
+        refcounts = self._refcounts()
+        self.stats.new_size = self.next_cluster << self.cluster_bits
+
+        fd = os.open(self.output, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                     0o644)
+        try:
+            os.ftruncate(fd, self.stats.new_size)
+
+            # The L2 tables are consecutive, so they go out in big batches
+            # too
+            if self.l2_order:
+                self._write_batched(
+                    fd, self.l2_offsets[self.l2_order[0]],
+                    (self._new_l2_table(l2_offset, refcounts)
+                     for l2_offset in self.l2_order))
+
+            for (l1, _), l1_offset in zip(self.l1_tables, self.l1_offsets):
+                entries = array.array('Q', [0]) * len(l1)
+                for l1_index in l1.allocated():
+                    offset = self.l2_offsets[l1.offsets[l1_index]]
+                    if refcounts[offset >> self.cluster_bits] == 1:
+                        offset |= COPIED_FLAG
+                    entries[l1_index] = offset
+                if l1_offset:
+                    os.pwrite(fd, encode_be64(entries), l1_offset)
+
+            if self.snapshot_table:
+                os.pwrite(fd, self.snapshot_table, self.snapshots_offset)
+
+            per_block = self.image.refcount_block_entries
+            os.pwrite(fd, encode_be64(self.refcount_block_offsets),
+                      self.refcount_table_offset)
+            if self.refcount_block_offsets:
+                self._write_batched(
+                    fd, self.refcount_block_offsets[0],
+                    (encode_refcounts(
+                        refcounts[first:first + per_block].tolist(),
+                        self.image.refcount_order)
+                     for first in range(0, len(refcounts), per_block)))
+
+            self._write_batched(fd, self.data_base, self._data_pieces())
+            self._write_batched(fd, self.compressed_base,
+                                self._compressed_pieces())
+
+            # The header goes last, so an interrupted compaction doesn't
+            # leave something which looks like a valid image
+            os.pwrite(fd, self._header(), 0)
+        finally:
+            os.close(fd)
+
+        return self.stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Rewrite a qcow2 image with its metadata together at the '
+                    'start and its data in virtual disk order, dropping '
+                    'leaked clusters.')
+    parser.add_argument('source', help='The image to compact.')
+    parser.add_argument('output', help='Where to write the new image.')
+    args = parser.parse_args()
+
+    if os.path.exists(args.output) and os.path.samefile(args.source,
+                                                        args.output):
+        print('The output must be a different file to the source')
+        sys.exit(1)
+
+    start = time.time()
+    with Qcow2Image(args.source) as image:
+        if image.bitmaps():
+            print(f'Dropping {len(image.bitmaps())} persistent bitmaps')
+        stats = Compactor(image, args.output).compact()
+
+    print(f'Compacted {args.source} in {time.time() - start:.02f} seconds')
+    print(f'    Old size: {stats.old_size} bytes')
+    print(f'    New size: {stats.new_size} bytes')
+    print(f'    L2 tables: {stats.l2_tables}')
+    print(f'    Data clusters copied: {stats.data_clusters}')
+    print(f'    Compressed clusters: {stats.compressed_clusters}')
+    print(f'    Preallocated zero clusters dropped: '
+          f'{stats.dropped_zero_clusters}')
+    print(f'    Data runs: {stats.old_data_runs} before, '
+          f'{stats.new_data_runs} after')
@@ -0,0 +1,438 @@
+#!/usr/bin/python3
+
+# Work out how much storage a deduplicating backend would save on a set of
+# images. Every allocated data cluster of every image (and of their backing
+# files) is hashed, and the digests go into a sqlite index. We then count how
+# many clusters are duplicates within one image, within a backing chain, and
+# across unrelated chains.
+#
+# A cluster here is a host data cluster, so data shared between snapshots of
+# one image (which qcow2 already stores once) is only counted once. Compressed
+# clusters are hashed after decompression, as a backend would see them. The
+# hashing happens in a process pool, straight from each worker's mapping of
+# the image. The index is keyed on each image's path, size and mtime, so
+# images which haven't changed aren't hashed again on the next run.
+
+import argparse
+import array
+import concurrent.futures
+import hashlib
+import os
+import sqlite3
+import sys
+import time
+
+from parser import Qcow2Chain, Qcow2Image, RawImage
+
+
+DEFAULT_INDEX = os.path.expanduser('~/.cache/qcow2-dedup.sqlite')
+
+# blake2b is the fastest of the strong hashes in hashlib, and 16 bytes is
+# plenty to make accidental collisions irrelevant
+DIGEST_SIZE = 16
+
+# The default number of chunks per worker process, as in check.py
+CHUNKS_PER_WORKER = 4
+
+# Raw backing files, and runs of qcow2 data clusters, are hashed in pieces
+# of at most this many clusters
+RAW_CHUNK_CLUSTERS = 4096
+
+
+def _digest(data, pad=0):
+    hasher = hashlib.blake2b(data, digest_size=DIGEST_SIZE)
+    if pad:
+        hasher.update(bytes(pad))
+    return hasher.digest()
+
+
+def _hash_clusters(path, ranges, compressed):
+    # Worker: hash the data clusters in some (start, end) ranges of host
+    # offsets, and some (host offset, length) compressed clusters. Returns
+    # (host offsets, concatenated digests). Host clusters past the end of
+    # the file read as zeros.
+    host_offsets = array.array('Q')
+    digests = bytearray()
+
+    with Qcow2Image(path) as image:
+        cluster_size = image.cluster_size
+        file_size = image.mm.max_size
+        for start, end in ranges:
+            for host_offset in range(start, end, cluster_size):
+                length = max(0, min(cluster_size, file_size - host_offset))
+                if length:
+                    data = image.mm.view(host_offset, length)
+                    try:
+                        digests += _digest(data, cluster_size - length)
+                    finally:
+                        data.release()
+                else:
+                    digests += _digest(b'', cluster_size)
+                host_offsets.append(host_offset)
+
+        for host_offset, length in compressed:
+            data = image.decompress(host_offset, length)
+            digests += _digest(data, cluster_size - len(data))
+            host_offsets.append(host_offset)
+
+    return host_offsets, bytes(digests)
+
+
+def _merge_runs(runs, cluster_size):
+    # Turn (host offset, count) runs, which may overlap where snapshots
+    # share clusters, into sorted disjoint (start, end) ranges of at most
+    # RAW_CHUNK_CLUSTERS clusters
+    merged = []
+    for first, count in sorted(runs):
+        end = first + count * cluster_size
+        if merged and first <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([first, end])
+
+    step = cluster_size * RAW_CHUNK_CLUSTERS
+    return [(offset, min(offset + step, end))
+            for start, end in merged
+            for offset in range(start, end, step)]
+
+
+def _hash_raw_range(path, start, end, cluster_size):
+    # Worker: hash a range of a raw backing file in cluster sized pieces
+    host_offsets = array.array('Q')
+    digests = bytearray()
+    with RawImage(path) as image:
+        for offset in range(start, end, cluster_size):
+            length = min(cluster_size, end - offset)
+            data = image.mm.view(offset, length)
+            try:
+                digests += _digest(data, cluster_size - length)
+            finally:
+                data.release()
+            host_offsets.append(offset)
+    return host_offsets, bytes(digests)
+
+
+def _chunks(items, jobs):
+    size = max(1, len(items) // (jobs * CHUNKS_PER_WORKER))
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class DedupIndex:
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.executescript(
+            'CREATE TABLE IF NOT EXISTS images ('
+            '    id INTEGER PRIMARY KEY, path TEXT UNIQUE, size INTEGER, '
+            '    mtime_ns INTEGER, cluster_size INTEGER, '
+            '    complete INTEGER);'
+            'CREATE TABLE IF NOT EXISTS clusters ('
+            '    image_id INTEGER, host_offset INTEGER, digest BLOB, '
+            '    PRIMARY KEY (image_id, host_offset)) WITHOUT ROWID;'
+            'CREATE INDEX IF NOT EXISTS clusters_digest ON clusters (digest);')
+
+    def image(self, path, cluster_size):
+        # Returns (image id, up to date). An image which has changed since
+        # it was hashed has its old digests thrown away.
+        st = os.stat(path)
+        row = self.db.execute(
+            'SELECT id, size, mtime_ns, cluster_size, complete FROM images '
+            'WHERE path = ?', (path, )).fetchone()
+        if row and row[1:] == (st.st_size, st.st_mtime_ns, cluster_size, 1):
+            return row[0], True
+
+        if row:
+            image_id = row[0]
+            self.db.execute('DELETE FROM clusters WHERE image_id = ?',
+                            (image_id, ))
+            self.db.execute(
+                'UPDATE images SET size = ?, mtime_ns = ?, cluster_size = ?, '
+                'complete = 0 WHERE id = ?',
+                (st.st_size, st.st_mtime_ns, cluster_size, image_id))
+        else:
+            image_id = self.db.execute(
+                'INSERT INTO images (path, size, mtime_ns, cluster_size, '
+                'complete) VALUES (?, ?, ?, ?, 0)',
+                (path, st.st_size, st.st_mtime_ns, cluster_size)).lastrowid
+        self.db.commit()
+        return image_id, False
+
+    def add(self, image_id, host_offsets, digests):
+        self.db.executemany(
+            'INSERT OR IGNORE INTO clusters VALUES (?, ?, ?)',
+            ((image_id, host_offset,
+              digests[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE])
+             for i, host_offset in enumerate(host_offsets)))
+
+    def complete(self, image_id):
+        self.db.execute('UPDATE images SET complete = 1 WHERE id = ?',
+                        (image_id, ))
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+class DedupReport:
+    def __init__(self):
+        self.images = 0
+        self.chains = 0
+        self.clusters = 0
+        self.bytes = 0
+        self.zero_clusters = 0
+        self.unique_per_image = 0
+        self.unique_per_chain = 0
+        self.unique = 0
+        self.unique_bytes = 0
+        self.top_digests = []
+        self.per_image = []
+
+    def print(self):
+        def clusters(count):
+            if not self.clusters:
+                return f'{count} clusters'
+            return f'{count} clusters ({count * 100 / self.clusters:.1f}%)'
+
+        print(f'Images: {self.images} in {self.chains} backing chains')
+        print(f'Allocated data: {self.clusters} clusters, {self.bytes} bytes')
+        print(f'Zero filled: {clusters(self.zero_clusters)}')
+        print(f'Unique: {clusters(self.unique)}')
+        print()
+        print('Duplicates removed by deduplicating...')
+        print(f'    ... within each image: '
+              f'{clusters(self.clusters - self.unique_per_image)}')
+        print(f'    ... within each backing chain: '
+              f'{clusters(self.unique_per_image - self.unique_per_chain)}')
+        print(f'    ... across backing chains: '
+              f'{clusters(self.unique_per_chain - self.unique)}')
+        saved = self.bytes - self.unique_bytes
+        percent = saved * 100 / self.bytes if self.bytes else 0
+        print(f'A deduplicating backend would save {saved} bytes '
+              f'({percent:.1f}%)')
+
+        if self.top_digests:
+            print()
+            print('Most duplicated clusters:')
+            for digest, count, images in self.top_digests:
+                print(f'    ... {digest.hex()} {count} times in {images} '
+                      f'images')
+
+        if self.per_image:
+            print()
+            print(f'{"Clusters":>12} {"Unique":>12} {"Shared":>12} Image')
+            for path, total, unique, shared in self.per_image:
+                print(f'{total:>12} {unique:>12} {shared:>12} {path}')
+
+
+class DedupAnalysis:
+    def __init__(self, paths, index_path=DEFAULT_INDEX, jobs=None,
+                 follow_backing=True):
+        self.paths = paths
+        self.index = DedupIndex(index_path)
+        self.jobs = jobs or os.cpu_count()
+        self.follow_backing = follow_backing
+
+        # image path -> chain number, where images which share any backing
+        # file end up in the same chain
+        self.chains = {}
+        self.cluster_sizes = {}
+        self.raw = set()
+        self.hashed = 0
+        self.reused = 0
+
+    def _find_images(self):
+        groups = []
+        for path in self.paths:
+            if self.follow_backing:
+                source = Qcow2Chain(path)
+            else:
+                source = Qcow2Image(path)
+            with source:
+                layers = source.layers if self.follow_backing else [source]
+                members = {}
+                for layer in layers:
+                    cluster_size = getattr(layer, 'cluster_size', None)
+                    members[os.path.realpath(layer.path)] = cluster_size
+
+            # Merge with any chain which shares a file with this one
+            merged = [group for group in groups if group.keys() & members]
+            for group in merged:
+                members.update(group)
+                groups.remove(group)
+            groups.append(members)
+
+        for number, members in enumerate(groups):
+            # Raw backing files are hashed in pieces the size of the largest
+            # clusters in their chain
+            default = max([size for size in members.values() if size],
+                          default=1 << 16)
+            for path, cluster_size in members.items():
+                self.chains[path] = number
+                if cluster_size is None:
+                    self.raw.add(path)
+                    cluster_size = default
+                self.cluster_sizes[path] = cluster_size
+
+    def _hash_image(self, pool, path, image_id):
+        cluster_size = self.cluster_sizes[path]
+        futures = []
+        if path in self.raw:
+            file_size = os.path.getsize(path)
+            step = cluster_size * RAW_CHUNK_CLUSTERS
+            for start in range(0, file_size, step):
+                futures.append(pool.submit(
+                    _hash_raw_range, path, start,
+                    min(start + step, file_size), cluster_size))
+        else:
+            with Qcow2Image(path) as image:
+                # Every L2 table of the active image and of each snapshot
+                l2_offsets = set()
+                l1_tables = [(image.l1_table_offset, image.l1_size)]
+                for snapshot in image.snapshots():
+                    l1_tables.append((snapshot.l1_table_offset,
+                                      snapshot.l1_size))
+                for l1_table_offset, l1_size in l1_tables:
+                    if not l1_size:
+                        continue
+                    l1 = image.l1_table(l1_table_offset, l1_size)
+                    for l1_index in l1.allocated():
+                        l2_offsets.add(l1.offsets[l1_index])
+
+                # Snapshots share data clusters, and usually L2 tables too.
+                # Work out the distinct host clusters here so that each is
+                # hashed (and counted) once, however many tables refer to
+                # it. The L2 tables are small next to the data.
+                runs = []
+                compressed = {}
+                for l2_offset in sorted(l2_offsets):
+                    l2 = image.l2_table(l2_offset)
+                    runs.extend(l2.host_clusters())
+                    for _, host_offset, length in l2.compressed_descriptors():
+                        compressed[host_offset] = length
+
+            for chunk in _chunks(_merge_runs(runs, cluster_size), self.jobs):
+                futures.append(pool.submit(_hash_clusters, path, chunk, []))
+            for chunk in _chunks(sorted(compressed.items()), self.jobs):
+                futures.append(pool.submit(_hash_clusters, path, [], chunk))
+
+        for future in concurrent.futures.as_completed(futures):
+            host_offsets, digests = future.result()
+            self.index.add(image_id, host_offsets, digests)
+            self.hashed += len(host_offsets)
+        self.index.complete(image_id)
+
+    def run(self, top=5, per_image=False):
+        self._find_images()
+
+        image_ids = {}
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.jobs) as pool:
+            for path in sorted(self.chains):
+                image_id, up_to_date = self.index.image(
+                    path, self.cluster_sizes[path])
+                if up_to_date:
+                    self.reused += 1
+                else:
+                    self._hash_image(pool, path, image_id)
+                image_ids[path] = image_id
+
+        return self._report(image_ids, top=top, per_image=per_image)
+
+    def _report(self, image_ids, top=5, per_image=False):
+        db = self.index.db
+        db.execute('CREATE TEMPORARY TABLE IF NOT EXISTS run '
+                   '(image_id INTEGER PRIMARY KEY, chain INTEGER, '
+                   'cluster_size INTEGER)')
+        db.execute('DELETE FROM run')
+        db.executemany('INSERT INTO run VALUES (?, ?, ?)', (
+            (image_id, self.chains[path], self.cluster_sizes[path])
+            for path, image_id in image_ids.items()))
+
+        report = DedupReport()
+        report.images = len(image_ids)
+        report.chains = len(set(self.chains.values()))
+
+        report.clusters, report.bytes = db.execute(
+            'SELECT COUNT(*), COALESCE(SUM(cluster_size), 0) FROM clusters '
+            'JOIN run USING (image_id)').fetchone()
+
+        zero_digests = [_digest(b'', size) for size in
+                        set(self.cluster_sizes.values())]
+        report.zero_clusters = db.execute(
+            f'SELECT COUNT(*) FROM clusters JOIN run USING (image_id) '
+            f'WHERE digest IN ({",".join("?" * len(zero_digests))})',
+            zero_digests).fetchone()[0]
+
+        report.unique_per_image = db.execute(
+            'SELECT COUNT(*) FROM (SELECT DISTINCT image_id, digest '
+            'FROM clusters JOIN run USING (image_id))').fetchone()[0]
+        report.unique_per_chain = db.execute(
+            'SELECT COUNT(*) FROM (SELECT DISTINCT chain, digest '
+            'FROM clusters JOIN run USING (image_id))').fetchone()[0]
+        report.unique, report.unique_bytes = db.execute(
+            'SELECT COUNT(*), COALESCE(SUM(cluster_size), 0) FROM '
+            '(SELECT DISTINCT digest, cluster_size '
+            'FROM clusters JOIN run USING (image_id))').fetchone()
+
+        report.top_digests = db.execute(
+            f'SELECT digest, COUNT(*), COUNT(DISTINCT image_id) AS images '
+            f'FROM clusters JOIN run USING (image_id) '
+            f'WHERE digest NOT IN ({",".join("?" * len(zero_digests))}) '
+            f'GROUP BY digest HAVING COUNT(*) > 1 '
+            f'ORDER BY COUNT(*) DESC LIMIT ?',
+            zero_digests + [top]).fetchall()
+
+        if per_image:
+            paths = {image_id: path for path, image_id in image_ids.items()}
+            for image_id, total, unique in db.execute(
+                    'SELECT image_id, COUNT(*), COUNT(DISTINCT digest) '
+                    'FROM clusters JOIN run USING (image_id) '
+                    'GROUP BY image_id').fetchall():
+                shared = db.execute(
+                    'SELECT COUNT(*) FROM clusters AS c WHERE image_id = ? '
+                    'AND EXISTS (SELECT 1 FROM clusters AS o JOIN run '
+                    'USING (image_id) WHERE o.digest = c.digest AND '
+                    'o.image_id != c.image_id)', (image_id, )).fetchone()[0]
+                report.per_image.append((paths[image_id], total, unique,
+                                         shared))
+        return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Estimate the savings from deduplicating the clusters of '
+                    'some qcow2 images.')
+    parser.add_argument('images', nargs='+')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='Number of worker processes (default: one per '
+                             'CPU).')
+    parser.add_argument('--index', default=DEFAULT_INDEX,
+                        help=f'Index of cluster digests (default: '
+                             f'{DEFAULT_INDEX}).')
+    parser.add_argument('--no-backing', action='store_true',
+                        help='Do not include backing files.')
+    parser.add_argument('--per-image', action='store_true',
+                        help='Also show a breakdown for each image.')
+    parser.add_argument('--top', type=int, default=5,
+                        help='Show this many of the most duplicated '
+                             'clusters.')
+    args = parser.parse_args()
+
+    start = time.time()
+    analysis = DedupAnalysis(args.images, index_path=args.index,
+                             jobs=args.jobs,
+                             follow_backing=not args.no_backing)
+    try:
+        report = analysis.run(top=args.top, per_image=args.per_image)
+    finally:
+        analysis.index.close()
+
+    report.print()
+    print()
+    print(f'Hashed {analysis.hashed} clusters in {time.time() - start:.02f} '
+          f'seconds, {analysis.reused} images were already in the index',
+          file=sys.stderr)
@@ -0,0 +1,209 @@
+#!/usr/bin/python3
+
+# Convert a qcow2 image (and its backing chain) to a sparse raw image,
+# without needing qemu-img. Only allocated data is written. Zero and
+# unallocated ranges are left as holes in the output, so tools using
+# SEEK_HOLE / SEEK_DATA (cp --sparse, tar -S, ...) see the same layout as the
+# guest. Uncompressed data is copied with copy_file_range() where the kernel
+# supports it, so it never passes through python at all.
+
+import argparse
+import concurrent.futures
+import os
+import threading
+import time
+
+from parser import (
+    Qcow2Chain, Qcow2Image, EXTENT_NORMAL, EXTENT_COMPRESSED)
+from reader import Qcow2Reader
+
+
+# Large extents are split into pieces of this size, so that one huge extent
+# doesn't leave the rest of the worker pool idle
+EXPORT_CHUNK_SIZE = 64 * 1024 * 1024
+
+
+class ExportStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.copied = 0
+        self.decompressed = 0
+        self.holes = 0
+        self.copy_file_range = 0
+        self.fallback_writes = 0
+
+    def add(self, **kwargs):
+        with self.lock:
+            for key, value in kwargs.items():
+                setattr(self, key, getattr(self, key) + value)
+
+
+class Exporter:
+    def __init__(self, source, output, jobs=None):
+        # source is an open Qcow2Chain or Qcow2Image
+        self.source = source
+        self.output = output
+        self.jobs = jobs or min(32, (os.cpu_count() or 1) * 2)
+        self.stats = ExportStats()
+        self.thread_state = threading.local()
+        self.readers_lock = threading.Lock()
+        self.readers = []
+
+        if isinstance(source, Qcow2Chain):
+            self.layers = source.layers
+            self.extents = source.extent_map()
+        else:
+            self.layers = [source]
+            self.extents = (extent + (0, ) for extent in source.extents())
+
+    def _chunks(self):
+        # Yield (virtual offset, length, kind, layer, host offset) for each
+        # piece of work. Ranges which read as zeros produce no work at all.
+        for virtual_offset, length, host_offset, kind, layer in self.extents:
+            if kind not in (EXTENT_NORMAL, EXTENT_COMPRESSED):
+                self.stats.add(holes=length)
+                continue
+
+            for start in range(0, length, EXPORT_CHUNK_SIZE):
+                chunk_length = min(EXPORT_CHUNK_SIZE, length - start)
+                chunk_host = None
+                if host_offset is not None:
+                    chunk_host = host_offset + start
+                yield (virtual_offset + start, chunk_length, kind, layer,
+                       chunk_host)
+
+    def _pwrite_all(self, fd, data, offset):
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+
+    def _copy_normal(self, fd, virtual_offset, length, layer, host_offset):
+        image = self.layers[layer]
+        src_fd = image.file.fileno()
+
+        done = 0
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while done < length:
+                    copied = os.copy_file_range(
+                        src_fd, fd, length - done, host_offset + done,
+                        virtual_offset + done)
+                    if copied == 0:
+                        break
+                    done += copied
+                self.stats.add(copy_file_range=done)
+            except OSError:
+                # Not supported between these files (for example across
+                # filesystems on older kernels), fall back to writing from
+                # the mapping
+                pass
+
+        if done < length:
+            source = image.mm.view(host_offset + done, length - done)
+            try:
+                self._pwrite_all(fd, source, virtual_offset + done)
+            finally:
+                source.release()
+            self.stats.add(fallback_writes=length - done)
+        self.stats.add(copied=length)
+
+    def _reader(self):
+        # Readers cache decoded tables and aren't thread safe, so each
+        # worker thread gets its own
+        reader = getattr(self.thread_state, 'reader', None)
+        if reader is None:
+            reader = Qcow2Reader(self.source)
+            self.thread_state.reader = reader
+            with self.readers_lock:
+                self.readers.append(reader)
+        return reader
+
+    def _close_readers(self):
+        # Only safe once the worker threads are done with them
+        with self.readers_lock:
+            readers = self.readers
+            self.readers = []
+        for reader in readers:
+            reader.close()
+
+    def _copy_compressed(self, fd, virtual_offset, length):
+        reader = self._reader()
+        reader.seek(virtual_offset)
+        buf = bytearray(min(length, EXPORT_CHUNK_SIZE))
+        done = 0
+        while done < length:
+            view = memoryview(buf)[:min(len(buf), length - done)]
+            count = reader.readinto(view)
+            self._pwrite_all(fd, view[:count], virtual_offset + done)
+            done += count
+        self.stats.add(decompressed=length)
+
+    def _export_chunk(self, fd, chunk):
+        virtual_offset, length, kind, layer, host_offset = chunk
+        if kind == EXTENT_NORMAL:
+            self._copy_normal(fd, virtual_offset, length, layer, host_offset)
+        else:
+            self._copy_compressed(fd, virtual_offset, length)
+
+    def export(self):
+        # Start from an empty file of the right size, which is one big hole
+        fd = os.open(self.output, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, self.source.virtual_size)
+
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.jobs) as pool:
+                futures = set()
+                for chunk in self._chunks():
+                    futures.add(pool.submit(self._export_chunk, fd, chunk))
+
+                    # Keep the queue bounded, so we don't hold the whole map
+                    # of a huge image as pending work
+                    if len(futures) >= self.jobs * 4:
+                        finished, futures = concurrent.futures.wait(
+                            futures,
+                            return_when=concurrent.futures.FIRST_COMPLETED)
+                        for future in finished:
+                            future.result()
+
+                for future in concurrent.futures.as_completed(futures):
+                    future.result()
+
+            os.fsync(fd)
+        finally:
+            # Leaving the with block above waited for the pool to shut down
+            self._close_readers()
+            os.close(fd)
+        return self.stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Convert a qcow2 image to a sparse raw image.')
+    parser.add_argument('image')
+    parser.add_argument('output')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='Number of copy threads.')
+    parser.add_argument('--no-backing', action='store_true',
+                        help='Export only the top image, treating '
+                             'unallocated clusters as zeros.')
+    args = parser.parse_args()
+
+    if args.no_backing:
+        source = Qcow2Image(args.image)
+    else:
+        source = Qcow2Chain(args.image)
+
+    start = time.time()
+    with source:
+        stats = Exporter(source, args.output, jobs=args.jobs).export()
+    elapsed = time.time() - start
+
+    print(f'Exported {stats.copied + stats.decompressed} bytes of data in '
+          f'{elapsed:.02f} seconds')
+    print(f'    ... {stats.copy_file_range} bytes with copy_file_range')
+    print(f'    ... {stats.fallback_writes} bytes written from the mapping')
+    print(f'    ... {stats.decompressed} bytes decompressed')
+    print(f'    ... {stats.holes} bytes left as holes')
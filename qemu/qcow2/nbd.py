@@ -0,0 +1,718 @@
+#!/usr/bin/python3
+
+# A read only NBD (network block device) server for qcow2 images, so that
+# tools which speak NBD (nbd-client, qemu-io, nbdinfo, nbdcopy, ...) can read
+# a guest disk without qemu-nbd. Only the fixed newstyle handshake is
+# supported, along with structured replies and the base:allocation metadata
+# context for block status queries.
+#
+# The protocol runs on one asyncio event loop, and the work of mapping and
+# decompressing reads, and building the extent map for block status, runs in
+# a thread pool so one slow request doesn't stall every client. Clients can
+# pipeline requests: each read or block status request runs as its own task,
+# up to MAX_IN_FLIGHT per client, and replies are sent as they are ready,
+# which need not be the order the requests arrived in. Read replies are
+# written straight from the image mapping (or from a cached decompressed
+# cluster) without copying the data in python, and with structured replies
+# unallocated and zero ranges are sent as holes rather than as zeros. Block
+# status comes from the extent map without reading any guest data.
+#
+# The protocol is documented at
+# https://github.com/NetworkBlockDevice/nbd/blob/master/doc/proto.md
+
+import argparse
+import asyncio
+import concurrent.futures
+import os
+import struct
+import sys
+import threading
+
+from parser import (
+    Qcow2Chain, Qcow2Image, ExtentMap, ChainExtent, FormatError, OutOfBounds,
+    EXTENT_ZERO, EXTENT_UNALLOCATED)
+from reader import Qcow2Reader
+
+
+NBD_DEFAULT_PORT = 10809
+
+# Handshake
+NBDMAGIC = 0x4e42444d41474943
+IHAVEOPT = 0x49484156454f5054
+REPLY_MAGIC = 0x3e889045565a9
+
+NBD_FLAG_FIXED_NEWSTYLE = 1 << 0
+NBD_FLAG_NO_ZEROES = 1 << 1
+NBD_FLAG_C_FIXED_NEWSTYLE = 1 << 0
+NBD_FLAG_C_NO_ZEROES = 1 << 1
+
+NBD_OPT_EXPORT_NAME = 1
+NBD_OPT_ABORT = 2
+NBD_OPT_LIST = 3
+NBD_OPT_STARTTLS = 5
+NBD_OPT_INFO = 6
+NBD_OPT_GO = 7
+NBD_OPT_STRUCTURED_REPLY = 8
+NBD_OPT_LIST_META_CONTEXT = 9
+NBD_OPT_SET_META_CONTEXT = 10
+
+NBD_REP_ACK = 1
+NBD_REP_SERVER = 2
+NBD_REP_INFO = 3
+NBD_REP_META_CONTEXT = 4
+NBD_REP_ERR_UNSUP = (1 << 31) + 1
+NBD_REP_ERR_POLICY = (1 << 31) + 2
+NBD_REP_ERR_INVALID = (1 << 31) + 3
+NBD_REP_ERR_UNKNOWN = (1 << 31) + 6
+NBD_REP_ERR_TOO_BIG = (1 << 31) + 9
+
+NBD_INFO_EXPORT = 0
+NBD_INFO_NAME = 1
+NBD_INFO_BLOCK_SIZE = 3
+
+# Transmission
+NBD_FLAG_HAS_FLAGS = 1 << 0
+NBD_FLAG_READ_ONLY = 1 << 1
+NBD_FLAG_SEND_DF = 1 << 7
+NBD_FLAG_CAN_MULTI_CONN = 1 << 8
+
+REQUEST_MAGIC = 0x25609513
+SIMPLE_REPLY_MAGIC = 0x67446698
+STRUCTURED_REPLY_MAGIC = 0x668e33ef
+
+NBD_CMD_READ = 0
+NBD_CMD_WRITE = 1
+NBD_CMD_DISC = 2
+NBD_CMD_FLUSH = 3
+NBD_CMD_TRIM = 4
+NBD_CMD_WRITE_ZEROES = 6
+NBD_CMD_BLOCK_STATUS = 7
+
+NBD_CMD_FLAG_DF = 1 << 2
+NBD_CMD_FLAG_REQ_ONE = 1 << 3
+
+NBD_REPLY_FLAG_DONE = 1 << 0
+NBD_REPLY_TYPE_NONE = 0
+NBD_REPLY_TYPE_OFFSET_DATA = 1
+NBD_REPLY_TYPE_OFFSET_HOLE = 2
+NBD_REPLY_TYPE_BLOCK_STATUS = 5
+NBD_REPLY_TYPE_ERROR = (1 << 15) + 1
+
+NBD_STATE_HOLE = 1 << 0
+NBD_STATE_ZERO = 1 << 1
+
+NBD_EPERM = 1
+NBD_EIO = 5
+NBD_EINVAL = 22
+
+BASE_ALLOCATION = 'base:allocation'
+BASE_ALLOCATION_CONTEXT_ID = 1
+
+OPTION_HEADER = struct.Struct('>QII')
+OPTION_REPLY_HEADER = struct.Struct('>QIII')
+REQUEST_HEADER = struct.Struct('>IHHQQI')
+SIMPLE_REPLY_HEADER = struct.Struct('>IIQ')
+STRUCTURED_REPLY_HEADER = struct.Struct('>IHHQI')
+
+# We refuse options with more data than this, there's no sensible reason for
+# a client to send that much
+MAX_OPTION_LENGTH = 64 * 1024
+
+# The largest read we'll serve in one request, which we advertise as the
+# maximum block size
+MAX_REQUEST_LENGTH = 32 * 1024 * 1024
+
+# Block status replies describe at most this many extents, and no single
+# extent longer than fits in the 32 bit length field
+MAX_BLOCK_STATUS_EXTENTS = 1024
+MAX_BLOCK_STATUS_LENGTH = 0xffffffff & ~0xfff
+
+# The number of requests from one client we work on at once. Beyond that we
+# stop reading requests until one finishes.
+MAX_IN_FLIGHT = 16
+
+ZEROES = bytes(1024 * 1024)
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class Export:
+    def __init__(self, name, source):
+        # source is an open Qcow2Chain or Qcow2Image. Readers cache decoded
+        # tables and aren't thread safe, so each worker thread gets its own,
+        # shared by every client whose requests it runs.
+        self.name = name
+        self.source = source
+        self.size = source.virtual_size
+        self.thread_state = threading.local()
+        self.lock = threading.Lock()
+        self.readers = []
+        self._extent_map = None
+
+        image = source.layers[0] if isinstance(source, Qcow2Chain) else source
+        self.preferred_block_size = min(image.cluster_size,
+                                        MAX_REQUEST_LENGTH)
+
+    def reader(self):
+        reader = getattr(self.thread_state, 'reader', None)
+        if reader is None:
+            reader = Qcow2Reader(self.source)
+            self.thread_state.reader = reader
+            with self.lock:
+                self.readers.append(reader)
+        return reader
+
+    def close(self):
+        # Only safe once the worker threads are done with the readers
+        with self.lock:
+            readers = self.readers
+            self.readers = []
+        for reader in readers:
+            reader.close()
+
+    def extent_map(self):
+        # Walking every L2 table of a big image takes a while, so only do it
+        # if a client asks for block status. For chains the readers need
+        # the same map, so the first read builds it too.
+        if isinstance(self.source, Qcow2Chain):
+            return self.source.extent_map()
+
+        with self.lock:
+            if self._extent_map is None:
+                self._extent_map = ExtentMap(
+                    ChainExtent(*extent, 0)
+                    for extent in self.source.extents())
+            return self._extent_map
+
+    def read_segments(self, offset, length):
+        # Work out all of the pieces of a read, merging neighbouring pieces
+        # which read as zeros. Runs in a worker thread. The views returned
+        # are of the mapping or of immutable decompressed clusters, so stay
+        # valid after this thread moves on to other requests.
+        segments = []
+        for segment in self.reader().read_segments(offset, length):
+            if (segment[2] is None and segments and
+                    segments[-1][2] is None):
+                segments[-1] = (segments[-1][0],
+                                segments[-1][1] + segment[1], None)
+            else:
+                segments.append(segment)
+        return segments
+
+    def block_status(self, offset, length, max_extents):
+        # Return a list of (length, flags) covering the range starting at
+        # offset, merging neighbouring extents with the same flags
+        extent_map = self.extent_map()
+        end = offset + length
+        index = extent_map.find(offset)
+        out = []
+
+        while offset < end and index < len(extent_map):
+            extent = extent_map[index]
+            extent_end = min(extent.virtual_offset + extent.length, end)
+            flags = 0
+            if extent.kind in (EXTENT_ZERO, EXTENT_UNALLOCATED):
+                flags = NBD_STATE_HOLE | NBD_STATE_ZERO
+
+            count = extent_end - offset
+            if out and out[-1][1] == flags:
+                count += out[-1][0]
+                out.pop()
+            while count > MAX_BLOCK_STATUS_LENGTH:
+                out.append((MAX_BLOCK_STATUS_LENGTH, flags))
+                count -= MAX_BLOCK_STATUS_LENGTH
+            out.append((count, flags))
+
+            if len(out) > max_extents:
+                return out[:max_extents]
+            offset = extent_end
+            index += 1
+        return out
+
+
+class NbdConnection:
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.no_zeroes = False
+        self.structured_replies = False
+        self.meta_context_export = None
+
+        # Requests run as separate tasks, and each reply is written whole
+        # while holding the write lock so replies never interleave
+        self.write_lock = asyncio.Lock()
+        self.in_flight = asyncio.Semaphore(MAX_IN_FLIGHT)
+        self.requests = set()
+
+    # Handshake
+
+    async def _read_option(self):
+        magic, option, length = OPTION_HEADER.unpack(
+            await self.reader.readexactly(OPTION_HEADER.size))
+        if magic != IHAVEOPT:
+            raise ProtocolError(f'Bad option magic {magic:#x}')
+        if length > MAX_OPTION_LENGTH:
+            raise ProtocolError(f'Option {option} is too long ({length} '
+                                f'bytes)')
+        data = await self.reader.readexactly(length)
+        return option, data
+
+    def _option_reply(self, option, reply_type, data=b''):
+        self.writer.write(OPTION_REPLY_HEADER.pack(
+            REPLY_MAGIC, option, reply_type, len(data)))
+        if data:
+            self.writer.write(data)
+
+    def _parse_name(self, data, offset=0):
+        # A 32 bit length, followed by a UTF-8 string
+        if len(data) < offset + 4:
+            raise ValueError('Truncated name')
+        length, = struct.unpack_from('>I', data, offset)
+        offset += 4
+        if len(data) < offset + length:
+            raise ValueError('Truncated name')
+        return data[offset:offset + length].decode('utf-8'), offset + length
+
+    def _transmission_flags(self):
+        flags = (NBD_FLAG_HAS_FLAGS | NBD_FLAG_READ_ONLY |
+                 NBD_FLAG_CAN_MULTI_CONN)
+        if self.structured_replies:
+            flags |= NBD_FLAG_SEND_DF
+        return flags
+
+    def _info(self, option, data):
+        # NBD_OPT_INFO and NBD_OPT_GO
+        try:
+            name, offset = self._parse_name(data)
+            if len(data) < offset + 2:
+                raise ValueError('Truncated information requests')
+            count, = struct.unpack_from('>H', data, offset)
+            offset += 2
+            if len(data) != offset + count * 2:
+                raise ValueError('Bad information request count')
+            requests = struct.unpack_from(f'>{count}H', data, offset)
+        except ValueError as e:
+            self._option_reply(option, NBD_REP_ERR_INVALID, str(e).encode())
+            return None
+
+        export = self.server.find_export(name)
+        if not export:
+            self._option_reply(option, NBD_REP_ERR_UNKNOWN,
+                               f'No export named {name!r}'.encode())
+            return None
+
+        self._option_reply(option, NBD_REP_INFO, struct.pack(
+            '>HQH', NBD_INFO_EXPORT, export.size,
+            self._transmission_flags()))
+        if NBD_INFO_NAME in requests:
+            self._option_reply(option, NBD_REP_INFO, struct.pack(
+                '>H', NBD_INFO_NAME) + export.name.encode('utf-8'))
+        if NBD_INFO_BLOCK_SIZE in requests:
+            self._option_reply(option, NBD_REP_INFO, struct.pack(
+                '>HIII', NBD_INFO_BLOCK_SIZE, 1, export.preferred_block_size,
+                MAX_REQUEST_LENGTH))
+        self._option_reply(option, NBD_REP_ACK)
+        return export
+
+    def _meta_context(self, option, data):
+        # NBD_OPT_LIST_META_CONTEXT and NBD_OPT_SET_META_CONTEXT. The only
+        # context we know about is base:allocation.
+        if option == NBD_OPT_SET_META_CONTEXT and not self.structured_replies:
+            self._option_reply(option, NBD_REP_ERR_INVALID,
+                               b'Structured replies have not been negotiated')
+            return
+
+        try:
+            name, offset = self._parse_name(data)
+            if len(data) < offset + 4:
+                raise ValueError('Truncated query count')
+            count, = struct.unpack_from('>I', data, offset)
+            offset += 4
+            queries = []
+            for _ in range(count):
+                query, offset = self._parse_name(data, offset)
+                queries.append(query)
+            if offset != len(data):
+                raise ValueError('Trailing data after queries')
+        except ValueError as e:
+            self._option_reply(option, NBD_REP_ERR_INVALID, str(e).encode())
+            return
+
+        export = self.server.find_export(name)
+        if not export:
+            self._option_reply(option, NBD_REP_ERR_UNKNOWN,
+                               f'No export named {name!r}'.encode())
+            return
+
+        if option == NBD_OPT_SET_META_CONTEXT:
+            self.meta_context_export = None
+            selected = BASE_ALLOCATION in queries
+        else:
+            # Listing with no queries, or with just the namespace, lists
+            # everything
+            selected = (not queries or BASE_ALLOCATION in queries or
+                        'base:' in queries)
+
+        if selected:
+            self._option_reply(option, NBD_REP_META_CONTEXT, struct.pack(
+                '>I', BASE_ALLOCATION_CONTEXT_ID) + BASE_ALLOCATION.encode())
+            if option == NBD_OPT_SET_META_CONTEXT:
+                self.meta_context_export = export
+        self._option_reply(option, NBD_REP_ACK)
+
+    async def negotiate(self):
+        # Returns the export the client chose, or None if the client went
+        # away without choosing one
+        self.writer.write(struct.pack(
+            '>QQH', NBDMAGIC, IHAVEOPT,
+            NBD_FLAG_FIXED_NEWSTYLE | NBD_FLAG_NO_ZEROES))
+        client_flags, = struct.unpack(
+            '>I', await self.reader.readexactly(4))
+        if not client_flags & NBD_FLAG_C_FIXED_NEWSTYLE:
+            raise ProtocolError('Client does not support fixed newstyle '
+                                'negotiation')
+        if client_flags & ~(NBD_FLAG_C_FIXED_NEWSTYLE | NBD_FLAG_C_NO_ZEROES):
+            raise ProtocolError(f'Unknown client flags {client_flags:#x}')
+        self.no_zeroes = bool(client_flags & NBD_FLAG_C_NO_ZEROES)
+
+        while True:
+            option, data = await self._read_option()
+
+            if option == NBD_OPT_EXPORT_NAME:
+                # There's no way to report an error here other than hanging
+                # up
+                export = self.server.find_export(data.decode('utf-8'))
+                if not export:
+                    return None
+                self.writer.write(struct.pack(
+                    '>QH', export.size, self._transmission_flags()))
+                if not self.no_zeroes:
+                    self.writer.write(bytes(124))
+                return export
+
+            elif option == NBD_OPT_ABORT:
+                self._option_reply(option, NBD_REP_ACK)
+                await self.writer.drain()
+                return None
+
+            elif option == NBD_OPT_LIST:
+                if data:
+                    self._option_reply(option, NBD_REP_ERR_INVALID)
+                else:
+                    for export in self.server.exports.values():
+                        name = export.name.encode('utf-8')
+                        self._option_reply(
+                            option, NBD_REP_SERVER,
+                            struct.pack('>I', len(name)) + name)
+                    self._option_reply(option, NBD_REP_ACK)
+
+            elif option in (NBD_OPT_INFO, NBD_OPT_GO):
+                export = self._info(option, data)
+                if export and option == NBD_OPT_GO:
+                    return export
+
+            elif option == NBD_OPT_STRUCTURED_REPLY:
+                if data:
+                    self._option_reply(option, NBD_REP_ERR_INVALID)
+                else:
+                    self.structured_replies = True
+                    self._option_reply(option, NBD_REP_ACK)
+
+            elif option in (NBD_OPT_LIST_META_CONTEXT,
+                            NBD_OPT_SET_META_CONTEXT):
+                self._meta_context(option, data)
+
+            elif option == NBD_OPT_STARTTLS:
+                self._option_reply(option, NBD_REP_ERR_POLICY,
+                                   b'TLS is not supported')
+
+            else:
+                self._option_reply(option, NBD_REP_ERR_UNSUP)
+
+            await self.writer.drain()
+
+    # Transmission
+
+    def _simple_reply(self, handle, error=0):
+        self.writer.write(SIMPLE_REPLY_HEADER.pack(
+            SIMPLE_REPLY_MAGIC, error, handle))
+
+    def _structured_reply(self, handle, reply_type, payload_length,
+                          done=True):
+        self.writer.write(STRUCTURED_REPLY_HEADER.pack(
+            STRUCTURED_REPLY_MAGIC, NBD_REPLY_FLAG_DONE if done else 0,
+            reply_type, handle, payload_length))
+
+    def _error(self, handle, error, message=''):
+        if self.structured_replies:
+            message = message.encode('utf-8')
+            self._structured_reply(handle, NBD_REPLY_TYPE_ERROR,
+                                   6 + len(message))
+            self.writer.write(struct.pack('>IH', error, len(message)))
+            self.writer.write(message)
+        else:
+            self._simple_reply(handle, error)
+
+    def _write_zeroes(self, length):
+        while length > 0:
+            count = min(length, len(ZEROES))
+            self.writer.write(memoryview(ZEROES)[:count])
+            length -= count
+
+    async def _read(self, export, handle, flags, offset, length):
+        # Work out all of the pieces first, so that errors are reported
+        # before we've started sending a reply
+        segments = await self.server.run(export.read_segments, offset, length)
+        async with self.write_lock:
+            self._send_read(handle, flags, offset, length, segments)
+
+    def _send_read(self, handle, flags, offset, length, segments):
+        if not self.structured_replies or flags & NBD_CMD_FLAG_DF:
+            # One contiguous block of data
+            if self.structured_replies:
+                self._structured_reply(handle, NBD_REPLY_TYPE_OFFSET_DATA,
+                                       8 + length)
+                self.writer.write(struct.pack('>Q', offset))
+            else:
+                self._simple_reply(handle)
+            for _, count, view in segments:
+                if view is None:
+                    self._write_zeroes(count)
+                else:
+                    self.writer.write(view)
+            return
+
+        if not segments:
+            self._structured_reply(handle, NBD_REPLY_TYPE_NONE, 0)
+            return
+
+        for index, (start, count, view) in enumerate(segments):
+            done = index == len(segments) - 1
+            if view is None:
+                self._structured_reply(handle, NBD_REPLY_TYPE_OFFSET_HOLE,
+                                       12, done=done)
+                self.writer.write(struct.pack('>QI', start, count))
+            else:
+                self._structured_reply(handle, NBD_REPLY_TYPE_OFFSET_DATA,
+                                       8 + count, done=done)
+                self.writer.write(struct.pack('>Q', start))
+                self.writer.write(view)
+
+    async def _block_status(self, export, handle, flags, offset, length):
+        if self.meta_context_export is not export:
+            async with self.write_lock:
+                self._error(handle, NBD_EINVAL,
+                            'No metadata context has been negotiated')
+            return
+
+        max_extents = MAX_BLOCK_STATUS_EXTENTS
+        if flags & NBD_CMD_FLAG_REQ_ONE:
+            max_extents = 1
+        extents = await self.server.run(export.block_status, offset, length,
+                                        max_extents)
+
+        payload = bytearray(struct.pack('>I', BASE_ALLOCATION_CONTEXT_ID))
+        for extent in extents:
+            payload += struct.pack('>II', *extent)
+        async with self.write_lock:
+            self._structured_reply(handle, NBD_REPLY_TYPE_BLOCK_STATUS,
+                                   len(payload))
+            self.writer.write(payload)
+
+    async def _request(self, export, command, handle, flags, offset, length):
+        try:
+            if command == NBD_CMD_READ:
+                await self._read(export, handle, flags, offset, length)
+            else:
+                await self._block_status(export, handle, flags, offset,
+                                         length)
+        except (FormatError, OutOfBounds, OSError) as e:
+            async with self.write_lock:
+                self._error(handle, NBD_EIO, str(e))
+
+        # Only waits if the client isn't keeping up with our replies
+        await self.writer.drain()
+
+    def _request_done(self, task):
+        self.requests.discard(task)
+        self.in_flight.release()
+        if not task.cancelled() and task.exception():
+            # Something we didn't expect, so give up on the client rather
+            # than leave it waiting for a reply
+            print(f'Dropping client: {task.exception()}', file=sys.stderr)
+            self.writer.close()
+
+    async def _reply(self, reply, *args):
+        # Replies to requests handled in transmit() itself
+        async with self.write_lock:
+            reply(*args)
+        await self.writer.drain()
+
+    async def transmit(self, export):
+        try:
+            await self._transmit(export)
+        finally:
+            # If the client went away there's nobody to reply to
+            for task in list(self.requests):
+                task.cancel()
+            await asyncio.gather(*self.requests, return_exceptions=True)
+
+    async def _transmit(self, export):
+        while True:
+            magic, flags, command, handle, offset, length = \
+                REQUEST_HEADER.unpack(
+                    await self.reader.readexactly(REQUEST_HEADER.size))
+            if magic != REQUEST_MAGIC:
+                raise ProtocolError(f'Bad request magic {magic:#x}')
+
+            if command == NBD_CMD_DISC:
+                # Finish what the client has already asked for first
+                await asyncio.gather(*self.requests, return_exceptions=True)
+                return
+
+            if command == NBD_CMD_WRITE:
+                # We have to consume the payload even though we won't write
+                # it
+                remaining = length
+                while remaining > 0:
+                    chunk = await self.reader.read(min(remaining, 1 << 20))
+                    if not chunk:
+                        raise asyncio.IncompleteReadError(b'', remaining)
+                    remaining -= len(chunk)
+
+            if command in (NBD_CMD_WRITE, NBD_CMD_TRIM, NBD_CMD_WRITE_ZEROES):
+                await self._reply(self._error, handle, NBD_EPERM,
+                                  'The export is read only')
+            elif command == NBD_CMD_FLUSH:
+                await self._reply(self._simple_reply, handle)
+            elif command not in (NBD_CMD_READ, NBD_CMD_BLOCK_STATUS):
+                await self._reply(self._error, handle, NBD_EINVAL,
+                                  f'Unsupported command {command}')
+            elif offset + length > export.size:
+                await self._reply(
+                    self._error, handle, NBD_EINVAL,
+                    'Request extends beyond the end of the export')
+            elif command == NBD_CMD_READ and length > MAX_REQUEST_LENGTH:
+                await self._reply(self._error, handle, NBD_EINVAL,
+                                  f'Reads are limited to '
+                                  f'{MAX_REQUEST_LENGTH} bytes')
+            elif command == NBD_CMD_BLOCK_STATUS and not length:
+                await self._reply(self._error, handle, NBD_EINVAL,
+                                  'Zero length block status')
+            else:
+                await self.in_flight.acquire()
+                task = asyncio.create_task(self._request(
+                    export, command, handle, flags, offset, length))
+                self.requests.add(task)
+                task.add_done_callback(self._request_done)
+
+    async def run(self):
+        try:
+            export = await self.negotiate()
+            if export:
+                await self.writer.drain()
+                await self.transmit(export)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # The client went away
+            pass
+        except (ProtocolError, UnicodeDecodeError) as e:
+            print(f'Dropping client: {e}', file=sys.stderr)
+        finally:
+            self.writer.close()
+
+
+class NbdServer:
+    def __init__(self, exports, jobs=None):
+        # exports is a list of Export objects. The first is also served to
+        # clients which ask for the default (empty) export name. jobs is
+        # the number of threads reading from the images.
+        self.exports = {export.name: export for export in exports}
+        self.default = exports[0]
+        self.connections = set()
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+
+    def run(self, function, *args):
+        # Run blocking image work in the thread pool
+        return asyncio.get_running_loop().run_in_executor(
+            self.pool, function, *args)
+
+    def find_export(self, name):
+        if not name:
+            return self.default
+        return self.exports.get(name)
+
+    async def _handle_client(self, reader, writer):
+        task = asyncio.current_task()
+        self.connections.add(task)
+        try:
+            await NbdConnection(self, reader, writer).run()
+        finally:
+            self.connections.discard(task)
+
+    async def serve(self, host=None, port=NBD_DEFAULT_PORT, socket_path=None):
+        if socket_path:
+            server = await asyncio.start_unix_server(
+                self._handle_client, path=socket_path)
+        else:
+            server = await asyncio.start_server(
+                self._handle_client, host=host, port=port)
+
+        for sock in server.sockets:
+            print(f'Serving {", ".join(self.exports)} on '
+                  f'{sock.getsockname()}', flush=True)
+
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            # Make sure no connection still holds slices of an image mapping
+            # when the images are closed
+            for task in list(self.connections):
+                task.cancel()
+            await asyncio.gather(*self.connections, return_exceptions=True)
+            self.pool.shutdown(wait=True)
+            if socket_path:
+                os.unlink(socket_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Serve qcow2 images read only over NBD.')
+    parser.add_argument('images', nargs='+',
+                        help='Images to export. Each is exported under its '
+                             'file name, and the first is also the default '
+                             'export.')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=NBD_DEFAULT_PORT)
+    parser.add_argument('--socket', default=None,
+                        help='Listen on this unix domain socket instead of '
+                             'TCP.')
+    parser.add_argument('--no-backing', action='store_true',
+                        help='Do not read through to backing files.')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='Number of threads reading from the images.')
+    args = parser.parse_args()
+
+    sources = []
+    exports = []
+    try:
+        for path in args.images:
+            if args.no_backing:
+                source = Qcow2Image(path)
+            else:
+                source = Qcow2Chain(path)
+            sources.append(source.__enter__())
+            exports.append(Export(os.path.basename(path), source))
+
+        asyncio.run(NbdServer(exports, jobs=args.jobs).serve(
+            host=args.host, port=args.port, socket_path=args.socket))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for export in exports:
+            export.close()
+        for source in sources:
+            source.__exit__(None, None, None)
@@ -2,11 +2,27 @@
 
 # A plaything qcow2 implementation. Format documentation is at
 # https://gitlab.com/qemu-project/qemu/-/blob/master/docs/interop/qcow2.txt
+#
+# This file is both a library (see Qcow2Image) and a command line tool. Run
+# it with --help for the available commands.
 
+import argparse
+import array
+import bisect
+import collections
+import datetime
+import json
 import mmap
 import os
 import struct
 import sys
+import threading
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 class OutOfBounds(Exception):
@@ -18,13 +34,14 @@ class FormatError(Exception):
 
 
 class MMapHelper:
-    def __init__(self, fd):
+    def __init__(self, fd, access=mmap.ACCESS_DEFAULT):
         self.fd = fd
+        self.access = access
 
     def __enter__(self):
         self.st = os.fstat(self.fd)
         self.max_size = self.st.st_size
-        self.mmap = mmap.mmap(self.fd, 0)
+        self.mmap = mmap.mmap(self.fd, 0, access=self.access)
         self.offset = 0
         return self
 
@@ -36,6 +53,61 @@ class MMapHelper:
             raise OutOfBounds()
         return struct.unpack_from(format, self.mmap, offset=offset)
 
+    def view(self, offset, length):
+        # A zero copy window onto the mapping. Callers must release the view
+        # (or let it go out of scope) before the helper is closed.
+        if offset < 0 or offset + length > self.max_size:
+            raise OutOfBounds()
+        return memoryview(self.mmap)[offset:offset + length]
+
+
+# How much of the file a header only open reads to start with. The header,
+# its extensions and the backing file name almost always fit in this, and the
+# rest of the first cluster is only read if they don't.
+HEADER_READ_SIZE = 4096
+
+
+class PreadHelper:
+    # The same interface as MMapHelper, but only the first cluster of the
+    # file is ever read, with pread() rather than by mapping the whole file.
+    # This is much cheaper for images on network storage when all we want
+    # is the header. Until the cluster size is known, limit is only as big
+    # as the header.
+
+    def __init__(self, fd, limit=HEADER_READ_SIZE):
+        self.fd = fd
+        self.limit = limit
+
+    def __enter__(self):
+        self.st = os.fstat(self.fd)
+        self.max_size = self.st.st_size
+        self.buffer = os.pread(self.fd, min(self.limit, HEADER_READ_SIZE), 0)
+        return self
+
+    def __exit__(self, *args):
+        self.buffer = b''
+
+    def _fill(self, end):
+        if end > self.max_size:
+            raise OutOfBounds()
+        if end > self.limit:
+            raise OutOfBounds(f'Only the first {self.limit} bytes are read '
+                              f'in header only mode')
+        if end > len(self.buffer):
+            want = min(self.limit, max(end, len(self.buffer) * 2))
+            self.buffer += os.pread(self.fd, want - len(self.buffer),
+                                    len(self.buffer))
+
+    def unpack_from(self, format, length, offset):
+        self._fill(offset + length)
+        return struct.unpack_from(format, self.buffer, offset=offset)
+
+    def view(self, offset, length):
+        if offset < 0:
+            raise OutOfBounds()
+        self._fill(offset + length)
+        return memoryview(self.buffer)[offset:offset + length]
+
 
 class MMapSequenceReader:
     def __init__(self, mm, offset=0):
@@ -75,164 +147,1741 @@ feature_type_to_string = {
 }
 
 
-with (
-    open(sys.argv[1], 'r+b') as f,
-    MMapHelper(f.fileno()) as mm
-):
-    with MMapSequenceReader(mm, offset=0) as first_cluster:
-        magic, version = first_cluster.unpack('>4sI')
-        if magic != b'QFI\xfb':
-            raise FormatError(f'This is not a qcow2 file (magic {magic})!')
-        if version not in [2, 3]:
-            raise FormatError(f'Unknown version: {version}')
-        print(f'qcow2 version: {version}')
-        print()
+# Names for the feature bits defined by the specification, for images which
+# don't have a feature name table. Indexed by feature type and then bit.
+known_feature_names = {
+    0: {0: 'dirty bit', 1: 'corrupt bit', 2: 'external data file',
+        3: 'compression type', 4: 'extended L2 entries'},
+    1: {0: 'lazy refcounts'},
+    2: {0: 'bitmaps extension', 1: 'raw external data'}
+}
 
-        bf_path_offset, bf_path_size = first_cluster.unpack('>QI')
-        print(f'Backing path offset: {bf_path_offset}')
-        print(f'Backing path size: {bf_path_size}')
-        if bf_path_offset != 0:
-            with MMapSequenceReader(mm, offset=0) as backing_path_reader:
-                (bf_path, ) = backing_path_reader.unpack(f'{bf_path_size}s')
-                print(f'Backing path: {bf_path}')
-        print()
 
+EXTENSION_BACKING_FORMAT = 0xe2792aca
+EXTENSION_FEATURE_NAMES = 0x6803f857
+EXTENSION_BITMAPS = 0x23852875
+
+# Autoclear feature bit 0 says the bitmaps extension is consistent. An older
+# qemu which doesn't know about bitmaps clears it when it writes the image.
+AUTOCLEAR_BITMAPS = 1
+
+BITMAP_FLAG_IN_USE = 1 << 0
+BITMAP_FLAG_AUTO = 1 << 1
+BITMAP_TYPE_DIRTY_TRACKING = 1
+
+# Bitmap table entries hold a data cluster offset in bits 9 - 55. If there is
+# no data cluster, bit 0 says whether the range is all ones or all zeros.
+BITMAP_TABLE_ALL_ONES = 1
+
+# Bits 9 - 55 of L1 and L2 entries are the host offset of a cluster. Bit 63
+# is the "copied" flag, which means the refcount of the cluster is exactly
+# one and it may be written in place.
+OFFSET_MASK = 0x00fffffffffffe00
+COPIED_FLAG = 1 << 63
+L1_RESERVED_MASK = 0x7f000000000001ff
+
+# Bit 62 of a L2 entry marks a compressed cluster, and bit 0 of a standard
+# cluster descriptor means the cluster reads as zeros (v3 only).
+COMPRESSED_FLAG = 1 << 62
+ZERO_FLAG = 1
+
+# Incompatible feature bit 4 means L2 entries are 128 bits long: the usual
+# cluster descriptor, followed by a bitmap which splits the cluster into 32
+# subclusters. Bits 0 - 31 of the bitmap say which subclusters are
+# allocated, and bits 32 - 63 which subclusters read as zeros. Bit 0 of the
+# descriptor is reserved in this case.
+INCOMPATIBLE_EXTENDED_L2 = 1 << 4
+SUBCLUSTERS_PER_CLUSTER = 32
+ALL_SUBCLUSTERS = (1 << SUBCLUSTERS_PER_CLUSTER) - 1
+
+# Compressed cluster descriptors are sized in 512 byte sectors
+COMPRESSED_SECTOR_SIZE = 512
+
+# Refcount table entries hold the offset of a refcount block in bits 9 - 63
+REFCOUNT_TABLE_OFFSET_MASK = 0xfffffffffffffe00
+
+
+# Kinds of extent in an allocation map
+EXTENT_NORMAL = 'normal'
+EXTENT_ZERO = 'zero'
+EXTENT_COMPRESSED = 'compressed'
+EXTENT_UNALLOCATED = 'unallocated'
+
+
+# A run of virtual disk with the same allocation state. host_offset is only
+# set for normal extents, where the data is contiguous in the host file.
+Extent = collections.namedtuple(
+    'Extent', ['virtual_offset', 'length', 'host_offset', 'kind'])
+
+
+# Translation tables used to pull individual bits out of a strided slice of
+# big endian table entries without a python level loop per entry.
+_TOP_BIT = bytes(b >> 7 for b in range(256))
+_CLEAR_LOW_BIT = bytes(b & 0xfe for b in range(256))
+_SECOND_BIT = bytes((b >> 6) & 1 for b in range(256))
+_LOW_BIT = bytes(b & 1 for b in range(256))
+
+
+def decode_be64(buf):
+    # Decode a buffer of big endian 64 bit integers in one operation. The
+    # result is an array.array, which is about as compact as python gets.
+    out = array.array('Q')
+    out.frombytes(buf)
+    if sys.byteorder == 'little':
+        out.byteswap()
+    return out
+
+
+# The array type code for unsigned 32 bit integers on this platform
+_UINT32 = 'I' if array.array('I').itemsize == 4 else 'L'
+
+
+def decode_be32(buf):
+    out = array.array(_UINT32)
+    out.frombytes(buf)
+    if sys.byteorder == 'little':
+        out.byteswap()
+    return out
+
+
+def decode_table_offsets(buf):
+    # Given the raw bytes of a L1 (or standard L2) table, return an array of
+    # the offsets in bits 9 - 55 of each entry. Rather than masking each entry
+    # we zero the relevant bytes of every entry at once with extended slice
+    # assignment, and then decode the lot.
+    count = len(buf) // 8
+    masked = bytearray(buf)
+    zeros = bytes(count)
+    masked[0::8] = zeros
+    masked[7::8] = zeros
+    masked[6::8] = masked[6::8].translate(_CLEAR_LOW_BIT)
+    return decode_be64(masked)
+
+
+def decode_table_copied_flags(buf):
+    # One byte per entry, 1 if the copied flag (bit 63) is set
+    return bytes(buf[0::8]).translate(_TOP_BIT)
+
+
+def decode_table_compressed_flags(buf):
+    # One byte per entry, 1 if the compressed flag (bit 62) is set
+    return bytes(buf[0::8]).translate(_SECOND_BIT)
+
+
+def decode_table_zero_flags(buf):
+    # One byte per entry, 1 if bit 0 of the entry is set
+    return bytes(buf[7::8]).translate(_LOW_BIT)
+
+
+def split_extended_entries(buf):
+    # Split the raw bytes of a table of extended L2 entries into the cluster
+    # descriptors and the subcluster bitmaps, each packed as a table of 8 byte
+    # entries so the usual decoders work on them
+    count = len(buf) // 16
+    descriptors = bytearray(count * 8)
+    bitmaps = bytearray(count * 8)
+    for j in range(8):
+        descriptors[j::8] = buf[j::16]
+        bitmaps[j::8] = buf[8 + j::16]
+    return descriptors, bitmaps
+
+
+def decode_subcluster_bitmaps(bitmaps):
+    # Given packed 8 byte subcluster bitmaps, return arrays of the 32 bit
+    # allocation and zero masks of each entry. The zero mask is the most
+    # significant half of an entry, so it comes first in each 8 bytes.
+    count = len(bitmaps) // 8
+    zero = bytearray(count * 4)
+    allocation = bytearray(count * 4)
+    for j in range(4):
+        zero[j::4] = bitmaps[j::8]
+        allocation[j::4] = bitmaps[4 + j::8]
+    return decode_be32(allocation), decode_be32(zero)
+
+
+def decode_refcount_table_offsets(buf):
+    # Like decode_table_offsets, but the top byte is part of the offset
+    masked = bytearray(buf)
+    masked[7::8] = bytes(len(buf) // 8)
+    masked[6::8] = masked[6::8].translate(_CLEAR_LOW_BIT)
+    return decode_be64(masked)
+
+
+# For sub-byte refcounts, _SUBBYTE_TABLES[order][j] extracts the j'th entry
+# from each byte. Entries are packed starting with the least significant
+# bits of a byte.
+_SUBBYTE_TABLES = {
+    order: [
+        bytes((b >> (j << order)) & ((1 << (1 << order)) - 1)
+              for b in range(256))
+        for j in range(8 >> order)
+    ]
+    for order in range(3)
+}
+
+_REFCOUNT_ARRAY_TYPES = {
+    4: 'H',
+    5: 'I',
+    6: 'Q'
+}
+
+
+def decode_refcounts(buf, refcount_order):
+    # Decode a refcount block into an array indexed by cluster, in bulk.
+    # refcount_order is log2 of the width of a refcount in bits, and may be
+    # anything from 0 (1 bit) to 6 (64 bits).
+    if refcount_order < 3:
+        per_byte = 8 >> refcount_order
+        out = bytearray(len(buf) * per_byte)
+        for j, table in enumerate(_SUBBYTE_TABLES[refcount_order]):
+            out[j::per_byte] = bytes(buf).translate(table)
+        return array.array('B', out)
+
+    if refcount_order == 3:
+        return array.array('B', buf)
+
+    if refcount_order not in _REFCOUNT_ARRAY_TYPES:
+        raise FormatError(f'Invalid refcount order: {refcount_order}')
+
+    out = array.array(_REFCOUNT_ARRAY_TYPES[refcount_order])
+    if out.itemsize != 1 << (refcount_order - 3):
+        raise FormatError(f'No native type for refcount order '
+                          f'{refcount_order} on this platform')
+    out.frombytes(buf)
+    if sys.byteorder == 'little':
+        out.byteswap()
+    return out
+
+
+def decode_compressed_descriptor(entry, cluster_bits):
+    # A compressed cluster descriptor holds a byte offset in the low bits, and
+    # above that the number of additional 512 byte sectors the compressed
+    # data touches. Returns (host offset, length of compressed data).
+    offset_bits = 62 - (cluster_bits - 8)
+    offset = entry & ((1 << offset_bits) - 1)
+    sectors = ((entry >> offset_bits) & ((1 << (cluster_bits - 8)) - 1)) + 1
+    return offset, (sectors * COMPRESSED_SECTOR_SIZE -
+                    (offset & (COMPRESSED_SECTOR_SIZE - 1)))
+
+
+def decompress_cluster(data, compression_type, cluster_size):
+    # Compressed data is padded out to a sector, so the decompressors have
+    # to cope with trailing junk after the end of the stream
+    if compression_type == 0:
+        # Raw deflate, with no zlib header
+        return zlib.decompressobj(-15).decompress(data, cluster_size)
+
+    if compression_type == 1:
+        if not zstandard:
+            raise FormatError('zstd compressed clusters require the '
+                              'zstandard module')
+        return zstandard.ZstdDecompressor().decompressobj().decompress(
+            data)[:cluster_size]
+
+    raise FormatError(f'Unknown compression type: {compression_type}')
+
+
+_CLEAR_TOP_BIT = bytes(b & 0x7f for b in range(256))
+_NONZERO = bytes(1 if b else 0 for b in range(256))
+_NOT_ALL_ONES = bytes(0 if b == 0xff else 1 for b in range(256))
+
+
+def bitmap_runs(data):
+    # Yield (first bit, count) for each run of set bits in a bitmap. Bits
+    # are numbered from the least significant bit of the first byte. Zero
+    # bytes and all ones bytes are skipped with C level searches, so only
+    # bytes at the edges of runs are looked at bit by bit.
+    data = bytes(data)
+    nonzero = data.translate(_NONZERO)
+    not_all_ones = data.translate(_NOT_ALL_ONES)
+
+    run_start = None
+    byte = nonzero.find(1)
+    while byte != -1:
+        value = data[byte]
+        for bit in range(8):
+            if (value >> bit) & 1:
+                if run_start is None:
+                    run_start = byte * 8 + bit
+            elif run_start is not None:
+                yield run_start, byte * 8 + bit - run_start
+                run_start = None
+
+        if run_start is not None:
+            byte = not_all_ones.find(1, byte + 1)
+        else:
+            byte = nonzero.find(1, byte + 1)
+
+    if run_start is not None:
+        yield run_start, len(data) * 8 - run_start
+
+
+def decode_table_descriptors(buf):
+    # L1 or L2 entries without the copied flag, which is the only part of an
+    # entry that legitimately differs between a snapshot and the active
+    # image for a shared table or cluster
+    masked = bytearray(buf)
+    masked[0::8] = masked[0::8].translate(_CLEAR_TOP_BIT)
+    return decode_be64(masked)
+
+
+def decode_extended_table_descriptors(buf):
+    # The same for extended L2 entries, where only the first half of each
+    # entry has a copied flag
+    masked = bytearray(buf)
+    masked[0::16] = masked[0::16].translate(_CLEAR_TOP_BIT)
+    return decode_be64(masked)
+
+
+# Tables are compared in blocks of this many entries, and only blocks which
+# differ are compared entry by entry
+DIFF_BLOCK_ENTRIES = 64
+
+
+def differing_indexes(a, b):
+    # Yield the indexes at which two equal length arrays differ. Slice
+    # comparisons run in C, so mostly identical tables are cheap.
+    for start in range(0, len(a), DIFF_BLOCK_ENTRIES):
+        end = start + DIFF_BLOCK_ENTRIES
+        if a[start:end] == b[start:end]:
+            continue
+        for index in range(start, min(end, len(a))):
+            if a[index] != b[index]:
+                yield index
+
+
+def coalesce_extents(extents):
+    # Merge adjacent extents of the same kind. Normal extents are only merged
+    # if they are also contiguous in the host file.
+    current = None
+    for extent in extents:
+        if current is None:
+            current = extent
+            continue
+
+        if (extent.kind == current.kind and
+                extent.virtual_offset == (current.virtual_offset +
+                                          current.length) and
+                (current.host_offset is None or
+                 extent.host_offset == (current.host_offset +
+                                        current.length))):
+            current = current._replace(length=current.length + extent.length)
+        else:
+            yield current
+            current = extent
+
+    if current is not None:
+        yield current
+
+
+class L1Table:
+    def __init__(self, raw, offsets, copied):
+        # raw, offsets: array.array('Q'); copied: bytes of 0 / 1 per entry
+        self.raw = raw
+        self.offsets = offsets
+        self.copied = copied
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def allocated(self):
+        # Indexes of L1 entries which point to a L2 table
+        return [i for i, offset in enumerate(self.offsets) if offset]
+
+    def reserved_bits(self):
+        # (index, value) for entries with reserved bits set, which should
+        # never happen in a valid image
+        return [(i, e & L1_RESERVED_MASK) for i, e in enumerate(self.raw)
+                if e & L1_RESERVED_MASK]
+
+
+class L2Table:
+    def __init__(self, buf, cluster_size, count, extended=False):
+        # Only the first count entries are decoded, which matters for the
+        # last L2 table of an image whose size isn't a multiple of the
+        # amount of disk one L2 table covers. Extended entries have their
+        # subcluster bitmaps decoded into allocation and zero masks, and
+        # everything else works on the descriptor half of each entry.
+        self.cluster_size = cluster_size
+        self.cluster_bits = cluster_size.bit_length() - 1
+        self.extended = extended
+        if extended:
+            buf, bitmaps = split_extended_entries(buf[:count * 16])
+            self.allocation_bitmaps, self.zero_bitmaps = \
+                decode_subcluster_bitmaps(bitmaps)
+            self.subclusters = SUBCLUSTERS_PER_CLUSTER
+        else:
+            buf = buf[:count * 8]
+            self.allocation_bitmaps = None
+            self.zero_bitmaps = None
+            self.subclusters = 1
+        self.subcluster_size = cluster_size // self.subclusters
+
+        self.raw = decode_be64(buf)
+        self.offsets = decode_table_offsets(buf)
+        self.compressed = decode_table_compressed_flags(buf)
+        if extended:
+            self.zero = bytes(len(self.raw))
+        else:
+            self.zero = decode_table_zero_flags(buf)
+
+    def __len__(self):
+        return len(self.raw)
+
+    def kind(self, index, subcluster=0):
+        # The kind of a cluster, or for extended entries of one of its
+        # subclusters
+        if self.compressed[index]:
+            return EXTENT_COMPRESSED
+        if self.extended:
+            return self.subcluster_run(index, subcluster)[0]
+        if self.zero[index]:
+            return EXTENT_ZERO
+        if self.offsets[index]:
+            return EXTENT_NORMAL
+        return EXTENT_UNALLOCATED
+
+    def subcluster_run(self, index, subcluster):
+        # Returns (kind, count) where count is the number of subclusters of
+        # entry index, starting at subcluster, which are of that kind. A
+        # standard entry is one big subcluster. Runs are found with bit
+        # tricks on the masks rather than by looking at each subcluster.
+        if self.compressed[index]:
+            return EXTENT_COMPRESSED, self.subclusters - subcluster
+        if not self.extended:
+            return self.kind(index), 1
+
+        allocation = self.allocation_bitmaps[index]
+        zero = self.zero_bitmaps[index]
+        if allocation & zero:
+            raise FormatError(f'L2 entry {index} has subclusters which are '
+                              f'both allocated and zero')
+
+        if (allocation >> subcluster) & 1:
+            if not self.offsets[index]:
+                raise FormatError(f'L2 entry {index} has allocated '
+                                  f'subclusters but no cluster')
+            kind = EXTENT_NORMAL
+            bits = allocation >> subcluster
+        elif (zero >> subcluster) & 1:
+            kind = EXTENT_ZERO
+            bits = zero >> subcluster
+        else:
+            kind = EXTENT_UNALLOCATED
+            bits = (~(allocation | zero) & ALL_SUBCLUSTERS) >> subcluster
+
+        # The number of trailing one bits
+        count = (bits ^ (bits + 1)).bit_length() - 1
+        return kind, min(count, self.subclusters - subcluster)
+
+    def compressed_descriptor(self, index):
+        return decode_compressed_descriptor(self.raw[index], self.cluster_bits)
+
+    def compressed_descriptors(self):
+        # Yield (index, host offset, length) for each compressed entry. The
+        # flag bytes are searched in C, so tables with few (or no) compressed
+        # clusters are cheap.
+        index = self.compressed.find(1)
+        while index != -1:
+            yield (index, ) + self.compressed_descriptor(index)
+            index = self.compressed.find(1, index + 1)
+
+    def host_clusters(self):
+        # Yield (host offset, count) for runs of contiguous host clusters
+        # referenced by this table. Unlike runs(), this includes clusters
+        # which are allocated but read as zeros (preallocated zero clusters,
+        # or clusters with no allocated subclusters). Compressed clusters
+        # are left to compressed_descriptors().
+        cluster_size = self.cluster_size
+        compressed = self.compressed
+        run_host = None
+        run_count = 0
+        next_host = None
+        for index, host in enumerate(self.offsets):
+            if not host or compressed[index]:
+                continue
+            if host == next_host:
+                run_count += 1
+                next_host += cluster_size
+                continue
+            if run_host is not None:
+                yield run_host, run_count
+            run_host = host
+            run_count = 1
+            next_host = host + cluster_size
+        if run_host is not None:
+            yield run_host, run_count
+
+    def runs(self, virtual_base):
+        # Yield extents for this table, with runs of entries already merged.
+        # This is the hot loop of a full image walk, so it avoids attribute
+        # lookups and function calls per entry.
+        if self.extended:
+            yield from self._extended_runs(virtual_base)
+            return
+
+        cluster_size = self.cluster_size
+        count = len(self.raw)
+
+        if self.raw.count(0) == count:
+            yield Extent(virtual_base, count * cluster_size, None,
+                         EXTENT_UNALLOCATED)
+            return
+
+        offsets = self.offsets
+        compressed = self.compressed
+        zero = self.zero
+
+        run_start = 0
+        run_kind = None
+        run_host = None
+        next_host = None
+        for index in range(count):
+            host = None
+            if compressed[index]:
+                kind = EXTENT_COMPRESSED
+            elif zero[index]:
+                kind = EXTENT_ZERO
+            elif offsets[index]:
+                host = offsets[index]
+                kind = EXTENT_NORMAL
+            else:
+                kind = EXTENT_UNALLOCATED
+
+            if kind is run_kind and (host is None or host == next_host):
+                if host is not None:
+                    next_host += cluster_size
+                continue
+
+            if run_kind is not None:
+                yield Extent(virtual_base + run_start * cluster_size,
+                             (index - run_start) * cluster_size, run_host,
+                             run_kind)
+            run_start = index
+            run_kind = kind
+            run_host = host
+            next_host = host + cluster_size if host else None
+
+        yield Extent(virtual_base + run_start * cluster_size,
+                     (count - run_start) * cluster_size, run_host, run_kind)
+
+    def _extended_runs(self, virtual_base):
+        # Like runs(), but at subcluster granularity. Entries whose
+        # subclusters are all the same are handled whole, and only mixed
+        # entries are split up.
+        cluster_size = self.cluster_size
+        subcluster_size = self.subcluster_size
+        count = len(self.raw)
+
+        if (self.raw.count(0) == count and
+                self.allocation_bitmaps.count(0) == count and
+                self.zero_bitmaps.count(0) == count):
+            yield Extent(virtual_base, count * cluster_size, None,
+                         EXTENT_UNALLOCATED)
+            return
+
+        offsets = self.offsets
+        compressed = self.compressed
+        allocation_bitmaps = self.allocation_bitmaps
+        zero_bitmaps = self.zero_bitmaps
+
+        def pieces():
+            for index in range(count):
+                base = virtual_base + index * cluster_size
+                allocation = allocation_bitmaps[index]
+                zero = zero_bitmaps[index]
+                if compressed[index]:
+                    yield Extent(base, cluster_size, None, EXTENT_COMPRESSED)
+                elif allocation == ALL_SUBCLUSTERS and offsets[index]:
+                    yield Extent(base, cluster_size, offsets[index],
+                                 EXTENT_NORMAL)
+                elif not allocation and zero == ALL_SUBCLUSTERS:
+                    yield Extent(base, cluster_size, None, EXTENT_ZERO)
+                elif not allocation and not zero:
+                    yield Extent(base, cluster_size, None,
+                                 EXTENT_UNALLOCATED)
+                else:
+                    subcluster = 0
+                    while subcluster < SUBCLUSTERS_PER_CLUSTER:
+                        kind, run = self.subcluster_run(index, subcluster)
+                        host = None
+                        if kind == EXTENT_NORMAL:
+                            host = (offsets[index] +
+                                    subcluster * subcluster_size)
+                        yield Extent(base + subcluster * subcluster_size,
+                                     run * subcluster_size, host, kind)
+                        subcluster += run
+
+        yield from coalesce_extents(pieces())
+
+
+class Snapshot:
+    def __init__(self, image, offset):
+        self.entry_offset = offset
         (
-            cluster_bits, virtual_size, crypt_method, layer1_size,
-            layer1_offset, refcount_table_offset, refcount_table_clusters,
-            snapshots_count, snapshots_offset
-        ) = first_cluster.unpack('>IQIIQQIIQ')
-
-        crypt_method_str = crypt_method_to_string.get(crypt_method, 'unknown')
-        cluster_size = pow(2, cluster_bits)
-        print(f'Cluster bits: {cluster_bits} ({cluster_size} bytes per cluster)')
-        print(f'Virtual size: {virtual_size}')
-        print(f'Encryption method: {crypt_method_str}')
-        print()
+            self.l1_table_offset, self.l1_size, id_size, name_size,
+            self.date_sec, self.date_nsec, self.vm_clock_nsec,
+            self.vm_state_size, extra_data_size
+        ) = image.mm.unpack_from('>QIHHIIQII', 40, offset)
 
-        print(f'Number of layer 1 entries: {layer1_size}')
-        print(f'Layer 1 table offset: {layer1_offset} (cluster '
-              f'{int(layer1_offset / cluster_size)})')
-        print()
+        # Optional extra data. The version 3 format requires the first two
+        # fields, but older images may not have them.
+        self.disk_size = image.virtual_size
+        self.icount = None
+        extra_offset = offset + 40
+        if extra_data_size >= 8:
+            (self.vm_state_size, ) = image.mm.unpack_from(
+                '>Q', 8, extra_offset)
+        if extra_data_size >= 16:
+            (self.disk_size, ) = image.mm.unpack_from(
+                '>Q', 8, extra_offset + 8)
+        if extra_data_size >= 24:
+            (icount, ) = image.mm.unpack_from('>q', 8, extra_offset + 16)
+            if icount >= 0:
+                self.icount = icount
 
-        print(f'Refcount table offset: {refcount_table_offset} (cluster '
-              f'{int(refcount_table_offset / cluster_size)})')
-        print(f'Number of clusters for refcount table: {refcount_table_clusters}')
-        print()
+        strings_offset = extra_offset + extra_data_size
+        (id, name) = image.mm.unpack_from(
+            f'>{id_size}s{name_size}s', id_size + name_size, strings_offset)
+        self.id = id.decode()
+        self.name = name.decode()
 
-        print(f'Number of snapshots: {snapshots_count}')
-        print(f'Snapshots offset: {snapshots_offset} (cluster '
-              f'{int(snapshots_offset / cluster_size)})')
-        print()
+        self.entry_length = (40 + extra_data_size + id_size + name_size + 7) & ~7
+
+    @property
+    def date(self):
+        return datetime.datetime.fromtimestamp(
+            self.date_sec + self.date_nsec / 1e9, tz=datetime.timezone.utc)
+
+
+class Bitmap:
+    def __init__(self, image, offset):
+        self.entry_offset = offset
+        (
+            self.table_offset, self.table_size, self.flags, self.type,
+            self.granularity_bits, name_size, extra_data_size
+        ) = image.mm.unpack_from('>QIIBBHI', 24, offset)
+
+        (self.extra_data, name) = image.mm.unpack_from(
+            f'>{extra_data_size}s{name_size}s', extra_data_size + name_size,
+            offset + 24)
+        self.name = name.decode()
+        self.granularity = 1 << self.granularity_bits
+        self.entry_length = (24 + extra_data_size + name_size + 7) & ~7
+
+    @property
+    def in_use(self):
+        # The bitmap was in use when the image was last closed, so it may
+        # not be accurate
+        return bool(self.flags & BITMAP_FLAG_IN_USE)
+
+    @property
+    def auto(self):
+        return bool(self.flags & BITMAP_FLAG_AUTO)
+
+
+class HeaderExtension:
+    def __init__(self, type, offset, length, data):
+        self.type = type
+        self.offset = offset
+        self.length = length
+        self.data = data
 
-        if version == 2:
-            refcount_order = 4
-            header_length = 72
 
-        if version == 3:
+class Qcow2Image:
+    def __init__(self, path, header_only=False):
+        # With header_only, just the first cluster is read and only the
+        # header fields, header extensions and backing file are available.
+        # Anything else raises OutOfBounds.
+        self.path = path
+        self.header_only = header_only
+        self.file = None
+        self.mm = None
+
+    def __enter__(self):
+        self.file = open(self.path, 'rb')
+        try:
+            if self.header_only:
+                self.mm = PreadHelper(self.file.fileno()).__enter__()
+            else:
+                self.mm = MMapHelper(self.file.fileno(),
+                                     access=mmap.ACCESS_READ).__enter__()
+            self._parse_header()
+        except Exception:
+            self.close()
+            raise
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.mm:
+            self.mm.__exit__()
+            self.mm = None
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def _parse_header(self):
+        with MMapSequenceReader(self.mm, offset=0) as first_cluster:
+            magic, version = first_cluster.unpack('>4sI')
+            if magic != b'QFI\xfb':
+                raise FormatError(f'This is not a qcow2 file (magic {magic})!')
+            if version not in [2, 3]:
+                raise FormatError(f'Unknown version: {version}')
+            self.version = version
+
+            (
+                self.backing_file_offset, self.backing_file_size
+            ) = first_cluster.unpack('>QI')
+
             (
-                incompatible_features, compatible_features, autoclear_features,
-                refcount_order, header_length, compression_type
-            ) = first_cluster.unpack('>QQQIIB')
-
-            compression_type_str = compression_type_to_string.get(compression_type)
-            print(f'v3 Incompatible features bits: {incompatible_features}')
-            print(f'v3 Compatible features bits: {compatible_features}')
-            print(f'v3 Autoclear features bits: {autoclear_features}')
-            print(f'v3 Refcount order: {refcount_order}')
-            print(f'v3 Header length: {header_length}')
-            print(f'v3 Compression type: {compression_type} '
-                  f'({compression_type_str})')
-            print()
-
-            # Padding to a multiple of 8 bytes
-            first_cluster.unpack('>7B')
-
-            # Possible header extensions
-            count = 0
+                self.cluster_bits, self.virtual_size, self.crypt_method,
+                self.l1_size, self.l1_table_offset,
+                self.refcount_table_offset, self.refcount_table_clusters,
+                self.snapshots_count, self.snapshots_offset
+            ) = first_cluster.unpack('>IQIIQQIIQ')
+            self.cluster_size = 1 << self.cluster_bits
+            if self.header_only:
+                self.mm.limit = self.cluster_size
+
+            self.incompatible_features = 0
+            self.compatible_features = 0
+            self.autoclear_features = 0
+            self.refcount_order = 4
+            self.header_length = 72
+            self.compression_type = 0
+
+            if version == 3:
+                (
+                    self.incompatible_features, self.compatible_features,
+                    self.autoclear_features, self.refcount_order,
+                    self.header_length
+                ) = first_cluster.unpack('>QQQII')
+
+                # The compression type field is only present in headers
+                # longer than 104 bytes
+                if self.header_length > 104:
+                    (self.compression_type, ) = first_cluster.unpack('>B')
+
+            self.extended_l2 = bool(
+                self.incompatible_features & INCOMPATIBLE_EXTENDED_L2)
+            if self.extended_l2 and self.cluster_bits < 14:
+                raise FormatError(f'Extended L2 entries need clusters of at '
+                                  f'least 16 KiB, not {self.cluster_size} '
+                                  f'bytes')
+
+            # Header extensions start immediately after the header
+            self.extensions = []
+            self.backing_format = None
+            self.feature_names = []
+            self.bitmaps_extension = None
+            if version == 3:
+                first_cluster.offset = self.header_length
+                self._parse_extensions(first_cluster)
+
+        # The backing file name is not NUL terminated, and lives at its own
+        # offset in the first cluster (normally just after the extensions)
+        self.backing_file = None
+        if self.backing_file_offset:
+            (backing_file, ) = self.mm.unpack_from(
+                f'{self.backing_file_size}s', self.backing_file_size,
+                self.backing_file_offset)
+            self.backing_file = backing_file.decode()
+
+    def _parse_extensions(self, first_cluster):
+        (extension_type, ) = first_cluster.unpack('>I')
+        while extension_type != 0:
+            (extension_length, ) = first_cluster.unpack('>I')
+            offset = first_cluster.offset
+
+            if extension_type == EXTENSION_BACKING_FORMAT:
+                (format, ) = first_cluster.unpack(f'>{extension_length}s')
+                self.backing_format = format.decode()
+                data = self.backing_format
+
+            elif extension_type == EXTENSION_FEATURE_NAMES:
+                data = []
+                end_byte = first_cluster.offset + extension_length
+                while first_cluster.offset < end_byte:
+                    (
+                        feature_type, feature_bit, feature_name
+                    ) = first_cluster.unpack('>BB46s')
+                    data.append((feature_type, feature_bit,
+                                 feature_name.rstrip(b'\x00').decode()))
+                self.feature_names = data
+
+            elif extension_type == EXTENSION_BITMAPS:
+                (
+                    bitmap_count, _, directory_size, directory_offset
+                ) = first_cluster.unpack('>IIQQ')
+                data = {
+                    'bitmap_count': bitmap_count,
+                    'directory_size': directory_size,
+                    'directory_offset': directory_offset
+                }
+                self.bitmaps_extension = data
+
+            else:
+                (data, ) = first_cluster.unpack(f'{extension_length}s')
+
+            self.extensions.append(
+                HeaderExtension(extension_type, offset, extension_length, data))
+
+            # Extensions are padded to a multiple of 8 bytes
+            first_cluster.offset = offset + ((extension_length + 7) & ~7)
             (extension_type, ) = first_cluster.unpack('>I')
-            print(f'v3 header extension {count} type: 0x{extension_type:0x} at '
-                  f'offset {first_cluster.offset}')
-            while extension_type != 0:
-                (extension_length, ) = first_cluster.unpack('>I')
-                print(f'v3 header extension {count} length: {extension_length}')
-                print(f'v3 header extension {count} length % 8: {extension_length % 8}')
-
-                if extension_type == 0xe2792aca:
-                    (format, ) = first_cluster.unpack(f'>{extension_length}s')
-                    print(f'    ... backing file format: {format.decode()}')
-
-                elif extension_type == 0x6803f857:
-                    print('    ... feature name table:')
-                    end_byte = first_cluster.offset + extension_length
-                    while first_cluster.offset < end_byte:
-                        (
-                            feature_type, feature_bit, feature_name
-                        ) = first_cluster.unpack('>BB46s')
-
-                        feature_type_str = feature_type_to_string.get(
-                            feature_type, 'unknown')
-                        feature_name_str = feature_name.rstrip(b'\x00').decode()
-                        print(f'    ... {feature_type_str} bit '
-                              f'{feature_bit} named {feature_name_str}')
 
-                else:
-                    extension_data = first_cluster.unpack(f'{extension_length}B')
-                    print(f'v3 header extension {count} data: {extension_data}')
+    def l1_table(self, offset=None, size=None):
+        # Decode the entire L1 table in one go. By default this is the active
+        # L1 table, but snapshots have their own.
+        if offset is None:
+            offset = self.l1_table_offset
+            size = self.l1_size
+        buf = self.mm.view(offset, size * 8)
+        try:
+            return L1Table(decode_be64(buf), decode_table_offsets(buf),
+                           decode_table_copied_flags(buf))
+        finally:
+            buf.release()
 
-                if extension_length % 8 == 0:
-                    print(f'v3 header extension {count} requires no padding')
-                else:
-                    padding = 8 - (extension_length % 8)
-                    first_cluster.offset += padding
-                    print(f'v3 header extension {count} padding: {padding}')
-                print()
-
-                count += 1
-                (extension_type, ) = first_cluster.unpack('>I')
-                print(f'v3 header extension {count} type 0x{extension_type:0x} at offset '
-                    f'{first_cluster.offset}')
-            print()
-
-    # Read L1 table entries
-    with MMapSequenceReader(mm, offset=layer1_offset) as l1_table:
-        for count in range(layer1_size):
-            print(f'L1 table entry {count} of {layer1_size}')
-            (l1_table_bytes, ) = l1_table.unpack('>Q')
-
-            if l1_table_bytes & 0xFF:
-                print(f'    ... unknown value for bits 0-8! '
-                      f'({l1_table_bytes[0]:0x})')
-
-            # This is icky -- the bottom 8 bits might one day be reused, but
-            # they're also always zero in a L2 offset because clusters must be
-            # at least 512 big. So, we can just use those reserved bits to make
-            # the maths easier, in return for some theoretical future fragility
-            l2_offset = l1_table_bytes & 0xFFFFFFFFFFFF
-            print(f'    ... l2 offset: {l2_offset} (cluster '
-                  f'{int(l2_offset / cluster_size)})')
-
-            if l1_table_bytes >> 56 & 0x7f != 0:
-                print(f'    ... unknown value for bits 56-62! '
-                      f'({l1_table_bytes >> 56 & 0x7f :0x})')
-
-            use_flag = l1_table_bytes >> 63
-            if use_flag == 0:
-                print(f'    ... entry is unused or requires COW')
+    @property
+    def l2_entry_size(self):
+        return 16 if self.extended_l2 else 8
+
+    @property
+    def l2_entries(self):
+        # Number of entries in a L2 table
+        return self.cluster_size // self.l2_entry_size
+
+    @property
+    def subcluster_size(self):
+        # The granularity of allocation within a cluster
+        if self.extended_l2:
+            return self.cluster_size // SUBCLUSTERS_PER_CLUSTER
+        return self.cluster_size
+
+    @property
+    def cluster_count(self):
+        # Number of clusters in the virtual disk
+        return (self.virtual_size + self.cluster_size - 1) >> self.cluster_bits
+
+    def l2_table(self, l2_offset, count=None):
+        # Decode an entire L2 table in one go
+        if count is None:
+            count = self.l2_entries
+        buf = self.mm.view(l2_offset, self.cluster_size)
+        try:
+            return L2Table(buf, self.cluster_size, count,
+                           extended=self.extended_l2)
+        finally:
+            buf.release()
+
+    @property
+    def refcount_bits(self):
+        return 1 << self.refcount_order
+
+    @property
+    def refcount_block_entries(self):
+        # Number of clusters whose refcounts fit in one refcount block
+        return (self.cluster_size * 8) >> self.refcount_order
+
+    def refcount_table(self):
+        # Offsets of the refcount blocks, zero where a block isn't allocated
+        buf = self.mm.view(self.refcount_table_offset,
+                           self.refcount_table_clusters * self.cluster_size)
+        try:
+            return decode_refcount_table_offsets(buf)
+        finally:
+            buf.release()
+
+    def refcount_block(self, block_offset):
+        buf = self.mm.view(block_offset, self.cluster_size)
+        try:
+            return decode_refcounts(buf, self.refcount_order)
+        finally:
+            buf.release()
+
+    def refcount(self, host_offset, refcount_table=None):
+        # Look up the refcount of the cluster containing host_offset. This
+        # decodes a whole refcount block, so pass in a refcount table and
+        # use refcount_block() directly for anything more than a few lookups.
+        if refcount_table is None:
+            refcount_table = self.refcount_table()
+        cluster = host_offset >> self.cluster_bits
+        table_index, block_index = divmod(cluster, self.refcount_block_entries)
+        if table_index >= len(refcount_table):
+            return 0
+        block_offset = refcount_table[table_index]
+        if not block_offset:
+            return 0
+        return self.refcount_block(block_offset)[block_index]
+
+    def compressed_data(self, host_offset, length):
+        # The descriptor length can run past the end of the file for the
+        # last compressed cluster, so clamp it
+        length = min(length, self.mm.max_size - host_offset)
+        return self.mm.view(host_offset, length)
+
+    def decompress(self, host_offset, length):
+        data = self.compressed_data(host_offset, length)
+        try:
+            return decompress_cluster(data, self.compression_type,
+                                      self.cluster_size)
+        finally:
+            data.release()
+
+    def snapshots(self):
+        # Parse the snapshot table. Entries are variable length and padded
+        # to a multiple of 8 bytes.
+        snapshots = []
+        offset = self.snapshots_offset
+        for _ in range(self.snapshots_count):
+            snapshot = Snapshot(self, offset)
+            snapshots.append(snapshot)
+            offset += snapshot.entry_length
+        return snapshots
+
+    def find_snapshot(self, name_or_id):
+        # Like qemu-img, match on the id first and then on the name
+        snapshots = self.snapshots()
+        for snapshot in snapshots:
+            if snapshot.id == name_or_id:
+                return snapshot
+        for snapshot in snapshots:
+            if snapshot.name == name_or_id:
+                return snapshot
+        raise KeyError(f'No snapshot with id or name {name_or_id}')
+
+    def bitmaps(self):
+        # The persistent bitmaps in the bitmap directory. The directory is
+        # ignored if the autoclear bit says the image was since written by
+        # something which doesn't maintain bitmaps.
+        if (not self.bitmaps_extension or
+                not self.autoclear_features & AUTOCLEAR_BITMAPS):
+            return []
+
+        bitmaps = []
+        offset = self.bitmaps_extension['directory_offset']
+        for _ in range(self.bitmaps_extension['bitmap_count']):
+            bitmap = Bitmap(self, offset)
+            bitmaps.append(bitmap)
+            offset += bitmap.entry_length
+        return bitmaps
+
+    @property
+    def bitmaps_count(self):
+        # The number of bitmaps bitmaps() would return, without reading the
+        # bitmap directory
+        if (not self.bitmaps_extension or
+                not self.autoclear_features & AUTOCLEAR_BITMAPS):
+            return 0
+        return self.bitmaps_extension['bitmap_count']
+
+    def find_bitmap(self, name):
+        for bitmap in self.bitmaps():
+            if bitmap.name == name:
+                return bitmap
+        raise KeyError(f'No bitmap named {name}')
+
+    def bitmap_table(self, bitmap):
+        # (raw entries, data cluster offsets) for a bitmap
+        buf = self.mm.view(bitmap.table_offset, bitmap.table_size * 8)
+        try:
+            return decode_be64(buf), decode_table_offsets(buf)
+        finally:
+            buf.release()
+
+    def dirty_ranges(self, bitmap):
+        # Yield coalesced (virtual offset, length) ranges which are dirty in
+        # a bitmap. Each bitmap data cluster covers cluster_size * 8 *
+        # granularity bytes of the disk, and is decoded a cluster at a time.
+        if bitmap.in_use:
+            raise FormatError(f'Bitmap {bitmap.name} is in use and may be '
+                              f'inconsistent')
+        if bitmap.type != BITMAP_TYPE_DIRTY_TRACKING:
+            raise FormatError(f'Bitmap {bitmap.name} has unknown type '
+                              f'{bitmap.type}')
+
+        granularity = bitmap.granularity
+        bits_per_cluster = self.cluster_size * 8
+        raw, offsets = self.bitmap_table(bitmap)
+
+        def runs():
+            for index in range(len(raw)):
+                first_bit = index * bits_per_cluster
+                if not offsets[index]:
+                    if raw[index] & BITMAP_TABLE_ALL_ONES:
+                        yield first_bit, bits_per_cluster
+                    continue
+
+                data = self.mm.view(offsets[index], self.cluster_size)
+                try:
+                    for start, count in bitmap_runs(data):
+                        yield first_bit + start, count
+                finally:
+                    data.release()
+
+        current = None
+        for start, count in runs():
+            if current and current[0] + current[1] == start:
+                current = (current[0], current[1] + count)
+                continue
+            if current:
+                yield from self._clip_dirty_range(current, granularity)
+            current = (start, count)
+        if current:
+            yield from self._clip_dirty_range(current, granularity)
+
+    def _clip_dirty_range(self, bits, granularity):
+        offset = bits[0] * granularity
+        length = min(bits[1] * granularity, self.virtual_size - offset)
+        if length > 0:
+            yield offset, length
+
+    def _l2_descriptors(self, l2_offset):
+        # For extended L2 entries there are two values per entry, the
+        # descriptor and then the subcluster bitmap
+        if not l2_offset:
+            return array.array('Q', [0]) * (self.cluster_size // 8)
+        buf = self.mm.view(l2_offset, self.cluster_size)
+        try:
+            if self.extended_l2:
+                return decode_extended_table_descriptors(buf)
+            return decode_table_descriptors(buf)
+        finally:
+            buf.release()
+
+    def diff(self, old=None, new=None, stats=None):
+        # Yield (virtual offset, length) for ranges which differ between two
+        # snapshots. None means the active image. If stats (a Counter) is
+        # passed, the number of L2 tables read is counted in it. L1 tables are compared
+        # first, and only L2 tables which aren't shared are read, so the cost
+        # is proportional to the amount of change rather than the disk size.
+        # This compares metadata: a cluster rewritten with the same contents
+        # still counts as changed.
+        tables = []
+        sizes = []
+        for snapshot in (old, new):
+            if snapshot is None:
+                tables.append(self.l1_table())
+                sizes.append(self.virtual_size)
+            else:
+                tables.append(self.l1_table(snapshot.l1_table_offset,
+                                            snapshot.l1_size))
+                sizes.append(snapshot.disk_size)
+
+        # Disks may have been resized between snapshots. Missing L1 entries
+        # are unallocated.
+        count = max(len(tables[0]), len(tables[1]))
+        offsets = []
+        for table in tables:
+            table_offsets = array.array('Q', table.offsets)
+            table_offsets.extend([0] * (count - len(table_offsets)))
+            offsets.append(table_offsets)
+
+        cluster_size = self.cluster_size
+        per_l2 = self.l2_entries
+        words_per_entry = self.l2_entry_size // 8
+        disk_size = max(sizes)
+
+        def changes():
+            for l1_index in differing_indexes(offsets[0], offsets[1]):
+                old_l2 = self._l2_descriptors(offsets[0][l1_index])
+                new_l2 = self._l2_descriptors(offsets[1][l1_index])
+                if stats is not None:
+                    stats['l2_tables_read'] += 2
+                base = l1_index * per_l2 * cluster_size
+                last = None
+                for index in differing_indexes(old_l2, new_l2):
+                    l2_index = index // words_per_entry
+                    if l2_index == last:
+                        continue
+                    last = l2_index
+                    yield Extent(base + l2_index * cluster_size, cluster_size,
+                                 None, 'changed')
+
+        for extent in coalesce_extents(changes()):
+            if extent.virtual_offset >= disk_size:
+                break
+            yield (extent.virtual_offset,
+                   min(extent.length, disk_size - extent.virtual_offset))
+
+    def _table_extents(self, l1):
+        # Uncoalesced (across L2 tables) extents for the whole disk. Only one
+        # L2 table is decoded at a time, so memory use doesn't depend on the
+        # size of the image.
+        per_l2 = self.l2_entries
+        remaining = self.cluster_count
+        for l1_index in range(len(l1)):
+            if remaining <= 0:
+                break
+
+            count = min(per_l2, remaining)
+            virtual_base = l1_index * per_l2 * self.cluster_size
+            l2_offset = l1.offsets[l1_index]
+            if l2_offset:
+                yield from self.l2_table(l2_offset, count).runs(virtual_base)
             else:
-                print(f'    ... entry reference count is exactly 1')
-
-            # for b in l1_table_bytes:
-            #     print(f'{b:0x}')
-
-            # l2_offset = 0
-            # l2_offset += l2_offset_b1 << 5
-            # l2_offset += l2_offset_b2 << 4
-            # l2_offset += l2_offset_b3 << 3
-            # l2_offset += l2_offset_b4 << 2
-            # l2_offset += l2_offset_b5 << 1
-            # l2_offset += l2_offset_b6
-
-            # print(f'l1 entry {count} reserved (should be 0): {reserved}')
-            # print(f'l2 entry {count} l2 offset: {l2_offset}')
-            # print(f'l2 entry {count} reserved and refcount: {reserved_and_refcount}')
\ No newline at end of file
+                yield Extent(virtual_base, count * self.cluster_size, None,
+                             EXTENT_UNALLOCATED)
+            remaining -= count
+
+        # A L1 table too short for the virtual size shouldn't happen, but if
+        # it does the rest of the disk has nothing allocated
+        if remaining > 0:
+            virtual_base = len(l1) * per_l2 * self.cluster_size
+            yield Extent(virtual_base, remaining * self.cluster_size, None,
+                         EXTENT_UNALLOCATED)
+
+    def extents(self, l1=None):
+        # Stream a coalesced allocation map of the virtual disk. The final
+        # extent is clipped to the virtual size, which need not be a
+        # multiple of the cluster size.
+        if l1 is None:
+            l1 = self.l1_table()
+        for extent in coalesce_extents(self._table_extents(l1)):
+            end = extent.virtual_offset + extent.length
+            if end > self.virtual_size:
+                extent = extent._replace(
+                    length=self.virtual_size - extent.virtual_offset)
+            yield extent
+
+
+class RawImage:
+    # A raw backing file. Everything up to the end of the file is allocated,
+    # with host offsets equal to virtual offsets.
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.mm = None
+        self.backing_file = None
+
+    def __enter__(self):
+        self.file = open(self.path, 'rb')
+        self.virtual_size = os.fstat(self.file.fileno()).st_size
+        if self.virtual_size:
+            self.mm = MMapHelper(self.file.fileno(),
+                                 access=mmap.ACCESS_READ).__enter__()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.mm:
+            self.mm.__exit__()
+            self.mm = None
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def extents(self):
+        if self.virtual_size:
+            yield Extent(0, self.virtual_size, 0, EXTENT_NORMAL)
+
+
+# An extent in the merged map of a backing chain. layer is the index into the
+# chain of the image which provides the data, or None for ranges which aren't
+# allocated anywhere in the chain and therefore read as zeros.
+ChainExtent = collections.namedtuple(
+    'ChainExtent',
+    ['virtual_offset', 'length', 'host_offset', 'kind', 'layer'])
+
+
+def overlay_extents(upper, lower):
+    # Replace the unallocated parts of upper with whatever lower has for that
+    # range. Both are sorted sequences of ChainExtents which start at zero
+    # with no gaps, although lower may be shorter than upper.
+    lower = iter(lower)
+    pending = next(lower, None)
+    for extent in upper:
+        if extent.kind != EXTENT_UNALLOCATED:
+            yield extent
+            continue
+
+        start = extent.virtual_offset
+        end = start + extent.length
+        while start < end:
+            while (pending is not None and
+                   pending.virtual_offset + pending.length <= start):
+                pending = next(lower, None)
+
+            if pending is None or pending.virtual_offset >= end:
+                yield extent._replace(virtual_offset=start, length=end - start)
+                break
+
+            piece_end = min(pending.virtual_offset + pending.length, end)
+            host_offset = pending.host_offset
+            if host_offset is not None:
+                host_offset += start - pending.virtual_offset
+            yield pending._replace(virtual_offset=start,
+                                   length=piece_end - start,
+                                   host_offset=host_offset)
+            start = piece_end
+
+
+_KIND_CODES = [EXTENT_NORMAL, EXTENT_ZERO, EXTENT_COMPRESSED,
+               EXTENT_UNALLOCATED]
+_NO_LAYER = 255
+
+
+class ExtentMap:
+    # A compact, searchable map of a whole virtual disk, stored as parallel
+    # arrays rather than a list of tuples so that maps with millions of
+    # extents stay small.
+
+    def __init__(self, extents):
+        self.starts = array.array('Q')
+        self.lengths = array.array('Q')
+        self.hosts = array.array('Q')
+        self.kinds = array.array('B')
+        self.layers = array.array('B')
+
+        kind_codes = {kind: code for code, kind in enumerate(_KIND_CODES)}
+        for extent in extents:
+            self.starts.append(extent.virtual_offset)
+            self.lengths.append(extent.length)
+            self.hosts.append(extent.host_offset or 0)
+            self.kinds.append(kind_codes[extent.kind])
+            self.layers.append(
+                _NO_LAYER if extent.layer is None else extent.layer)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, index):
+        kind = _KIND_CODES[self.kinds[index]]
+        layer = self.layers[index]
+        return ChainExtent(
+            self.starts[index], self.lengths[index],
+            self.hosts[index] if kind == EXTENT_NORMAL else None,
+            kind, None if layer == _NO_LAYER else layer)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def find(self, virtual_offset):
+        # The index of the extent containing virtual_offset
+        index = bisect.bisect_right(self.starts, virtual_offset) - 1
+        if index < 0 or virtual_offset >= (self.starts[index] +
+                                           self.lengths[index]):
+            raise OutOfBounds()
+        return index
+
+    def lookup(self, virtual_offset):
+        return self[self.find(virtual_offset)]
+
+
+class Qcow2Chain:
+    # An image and all of its backing files. layers[0] is the image itself,
+    # and each following layer is the backing file of the one before it.
+
+    MAX_DEPTH = 64
+
+    def __init__(self, path):
+        self.path = path
+        self.layers = []
+        self._extent_map = None
+        self._extent_map_lock = threading.Lock()
+
+    def __enter__(self):
+        try:
+            self._open_layers()
+        except Exception:
+            self.close()
+            raise
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        for layer in self.layers:
+            layer.close()
+        self.layers = []
+        self._extent_map = None
+
+    def _open_layers(self):
+        layer = Qcow2Image(self.path).__enter__()
+        self.layers.append(layer)
+        seen = {os.path.realpath(self.path)}
+
+        while layer.backing_file:
+            if len(self.layers) >= self.MAX_DEPTH:
+                raise FormatError(f'Backing chain of {self.path} is more than '
+                                  f'{self.MAX_DEPTH} images deep')
+
+            # Relative backing file names are relative to the image which
+            # refers to them, not to our working directory
+            backing_path = os.path.join(os.path.dirname(layer.path),
+                                        layer.backing_file)
+            real_path = os.path.realpath(backing_path)
+            if real_path in seen:
+                raise FormatError(f'Backing chain of {self.path} loops back '
+                                  f'to {backing_path}')
+            seen.add(real_path)
+
+            format = layer.backing_format
+            if not format:
+                with open(backing_path, 'rb') as f:
+                    format = 'qcow2' if f.read(4) == b'QFI\xfb' else 'raw'
+
+            if format == 'qcow2':
+                layer = Qcow2Image(backing_path).__enter__()
+            elif format == 'raw':
+                layer = RawImage(backing_path).__enter__()
+            else:
+                raise FormatError(f'Unsupported backing file format {format} '
+                                  f'for {backing_path}')
+            self.layers.append(layer)
+
+    @property
+    def virtual_size(self):
+        return self.layers[0].virtual_size
+
+    def _layer_extents(self, index):
+        for extent in self.layers[index].extents():
+            layer = index
+            if extent.kind == EXTENT_UNALLOCATED:
+                layer = None
+            yield ChainExtent(*extent, layer)
+
+    def _merged_extents(self):
+        # Overlay from the bottom of the chain up, so each layer is only
+        # walked once however deep the chain is
+        merged = ()
+        for index in range(len(self.layers) - 1, -1, -1):
+            merged = overlay_extents(self._layer_extents(index), merged)
+
+        # The top layer defines the size of the disk
+        return merged
+
+    def extent_map(self):
+        # The merged map is built on first use and then kept. Readers in
+        # several threads can ask at once, and only one should build it.
+        with self._extent_map_lock:
+            if self._extent_map is None:
+                self._extent_map = ExtentMap(self._merged_extents())
+            return self._extent_map
+
+    def lookup(self, virtual_offset):
+        # Which layer provides the data at virtual_offset, and where
+        return self.extent_map().lookup(virtual_offset)
+
+
+# The *_summary() functions return the same information as the print_*()
+# functions below as plain dicts and lists, for --json output.
+
+def feature_names(image, feature_type, bits):
+    # Names for the set bits of a feature bitmap, from the image's feature
+    # name table where it has one
+    names = dict(known_feature_names.get(feature_type, {}))
+    names.update({bit: name for type, bit, name in image.feature_names
+                  if type == feature_type})
+    return [names.get(bit, f'bit {bit}') for bit in range(64)
+            if bits & (1 << bit)]
+
+
+def header_summary(image):
+    summary = {
+        'version': image.version,
+        'backing_file_offset': image.backing_file_offset,
+        'backing_file_size': image.backing_file_size,
+        'backing_file': image.backing_file,
+        'backing_format': image.backing_format,
+        'cluster_bits': image.cluster_bits,
+        'cluster_size': image.cluster_size,
+        'extended_l2': image.extended_l2,
+        'subcluster_size': image.subcluster_size,
+        'virtual_size': image.virtual_size,
+        'encryption': crypt_method_to_string.get(image.crypt_method,
+                                                 'unknown'),
+        'l1_size': image.l1_size,
+        'l1_table_offset': image.l1_table_offset,
+        'refcount_table_offset': image.refcount_table_offset,
+        'refcount_table_clusters': image.refcount_table_clusters,
+        'snapshots_count': image.snapshots_count,
+        'snapshots_offset': image.snapshots_offset,
+        'incompatible_features': image.incompatible_features,
+        'compatible_features': image.compatible_features,
+        'autoclear_features': image.autoclear_features,
+        'features': {
+            feature_type_to_string[feature_type]: feature_names(
+                image, feature_type, bits)
+            for feature_type, bits in enumerate([
+                image.incompatible_features, image.compatible_features,
+                image.autoclear_features])
+        },
+        'refcount_order': image.refcount_order,
+        'header_length': image.header_length,
+        'compression': compression_type_to_string.get(
+            image.compression_type, 'unknown'),
+        'bitmaps_count': image.bitmaps_count,
+        'extensions': []
+    }
+
+    for extension in image.extensions:
+        data = extension.data
+        if extension.type == EXTENSION_FEATURE_NAMES:
+            data = [
+                {'type': feature_type_to_string.get(feature_type, 'unknown'),
+                 'bit': feature_bit, 'name': feature_name}
+                for feature_type, feature_bit, feature_name in data]
+        elif isinstance(data, bytes):
+            data = data.hex()
+        summary['extensions'].append({
+            'type': f'0x{extension.type:0x}',
+            'offset': extension.offset,
+            'length': extension.length,
+            'data': data
+        })
+    return summary
+
+
+def l1_summary(image, entries=False):
+    l1 = image.l1_table()
+    allocated = l1.allocated()
+    summary = {
+        'entries': len(l1),
+        'allocated': len(allocated),
+        'copied': sum(l1.copied),
+        'reserved_bits': [{'index': index, 'value': value}
+                          for index, value in l1.reserved_bits()]
+    }
+    if entries:
+        summary['l2_tables'] = [
+            {'index': index, 'l2_offset': l1.offsets[index],
+             'copied': bool(l1.copied[index])}
+            for index in allocated]
+    return summary
+
+
+def map_summary(image, chain=None):
+    totals = collections.Counter()
+    extents = []
+    for extent in chain.extent_map() if chain else image.extents():
+        out = {
+            'virtual_offset': extent.virtual_offset,
+            'length': extent.length,
+            'host_offset': extent.host_offset,
+            'kind': extent.kind
+        }
+        if chain:
+            out['file'] = None
+            if extent.layer is not None:
+                out['file'] = chain.layers[extent.layer].path
+        extents.append(out)
+        totals[extent.kind] += extent.length
+    return {'extents': extents, 'totals': dict(totals)}
+
+
+def snapshots_summary(image):
+    return [
+        {'id': snapshot.id, 'name': snapshot.name,
+         'vm_state_size': snapshot.vm_state_size,
+         'date': snapshot.date.isoformat(),
+         'vm_clock_nsec': snapshot.vm_clock_nsec,
+         'disk_size': snapshot.disk_size, 'icount': snapshot.icount,
+         'l1_table_offset': snapshot.l1_table_offset,
+         'l1_size': snapshot.l1_size}
+        for snapshot in image.snapshots()]
+
+
+def bitmaps_summary(image, name=None):
+    if not name:
+        return [
+            {'name': bitmap.name, 'granularity': bitmap.granularity,
+             'in_use': bitmap.in_use, 'auto': bitmap.auto}
+            for bitmap in image.bitmaps()]
+
+    ranges = [[offset, length] for offset, length in
+              image.dirty_ranges(image.find_bitmap(name))]
+    return {'ranges': ranges,
+            'dirty': sum(length for _, length in ranges)}
+
+
+def diff_summary(image, old, new):
+    old_snapshot = image.find_snapshot(old)
+    new_snapshot = image.find_snapshot(new) if new else None
+    stats = collections.Counter()
+    ranges = [[offset, length] for offset, length in
+              image.diff(old_snapshot, new_snapshot, stats=stats)]
+    return {'ranges': ranges,
+            'changed': sum(length for _, length in ranges),
+            'l2_tables_read': stats['l2_tables_read']}
+
+
+def print_header(image):
+    print(f'qcow2 version: {image.version}')
+    print()
+
+    print(f'Backing path offset: {image.backing_file_offset}')
+    print(f'Backing path size: {image.backing_file_size}')
+    if image.backing_file:
+        print(f'Backing path: {image.backing_file}')
+        print(f'Backing format: {image.backing_format or "unspecified"}')
+    print()
+
+    cluster_size = image.cluster_size
+    crypt_method_str = crypt_method_to_string.get(image.crypt_method, 'unknown')
+    print(f'Cluster bits: {image.cluster_bits} ({cluster_size} bytes per cluster)')
+    if image.extended_l2:
+        print(f'Extended L2 entries: {SUBCLUSTERS_PER_CLUSTER} subclusters of '
+              f'{image.subcluster_size} bytes per cluster')
+    print(f'Virtual size: {image.virtual_size}')
+    print(f'Encryption method: {crypt_method_str}')
+    print()
+
+    print(f'Number of layer 1 entries: {image.l1_size}')
+    print(f'Layer 1 table offset: {image.l1_table_offset} (cluster '
+          f'{image.l1_table_offset // cluster_size})')
+    print()
+
+    print(f'Refcount table offset: {image.refcount_table_offset} (cluster '
+          f'{image.refcount_table_offset // cluster_size})')
+    print(f'Number of clusters for refcount table: '
+          f'{image.refcount_table_clusters}')
+    print()
+
+    print(f'Number of snapshots: {image.snapshots_count}')
+    print(f'Snapshots offset: {image.snapshots_offset} (cluster '
+          f'{image.snapshots_offset // cluster_size})')
+    print()
+
+    if image.version == 3:
+        compression_type_str = compression_type_to_string.get(
+            image.compression_type)
+        print(f'v3 Incompatible features bits: {image.incompatible_features}')
+        print(f'v3 Compatible features bits: {image.compatible_features}')
+        print(f'v3 Autoclear features bits: {image.autoclear_features}')
+        print(f'v3 Refcount order: {image.refcount_order}')
+        print(f'v3 Header length: {image.header_length}')
+        print(f'v3 Compression type: {image.compression_type} '
+              f'({compression_type_str})')
+        print()
+
+    for count, extension in enumerate(image.extensions):
+        print(f'v3 header extension {count} type: 0x{extension.type:0x} at '
+              f'offset {extension.offset}')
+        print(f'v3 header extension {count} length: {extension.length}')
+
+        if extension.type == EXTENSION_BACKING_FORMAT:
+            print(f'    ... backing file format: {extension.data}')
+
+        elif extension.type == EXTENSION_BITMAPS:
+            print(f'    ... {extension.data["bitmap_count"]} bitmaps, '
+                  f'directory at offset {extension.data["directory_offset"]} '
+                  f'({extension.data["directory_size"]} bytes)')
+
+        elif extension.type == EXTENSION_FEATURE_NAMES:
+            print('    ... feature name table:')
+            for feature_type, feature_bit, feature_name in extension.data:
+                feature_type_str = feature_type_to_string.get(
+                    feature_type, 'unknown')
+                print(f'    ... {feature_type_str} bit '
+                      f'{feature_bit} named {feature_name}')
+
+        else:
+            print(f'v3 header extension {count} data: {extension.data}')
+        print()
+
+
+def print_l1(image, entries=False):
+    l1 = image.l1_table()
+    allocated = l1.allocated()
+    print(f'L1 table: {len(l1)} entries, {len(allocated)} with L2 tables, '
+          f'{sum(l1.copied)} with refcount exactly 1')
+
+    for index, value in l1.reserved_bits():
+        print(f'    ... L1 entry {index} has reserved bits set! ({value:0x})')
+
+    if entries:
+        cluster_size = image.cluster_size
+        for index in allocated:
+            l2_offset = l1.offsets[index]
+            print(f'L1 table entry {index}: l2 offset {l2_offset} (cluster '
+                  f'{l2_offset // cluster_size}), '
+                  f'{"copied" if l1.copied[index] else "unused or requires COW"}')
+
+
+def print_map(image, chain=None):
+    print(f'{"Offset":>20} {"Length":>20} {"Host offset":>20} Kind')
+    totals = collections.Counter()
+    if chain:
+        extents = chain.extent_map()
+    else:
+        extents = image.extents()
+
+    for extent in extents:
+        host = '-' if extent.host_offset is None else extent.host_offset
+        source = ''
+        if chain and extent.layer is not None:
+            source = f' {chain.layers[extent.layer].path}'
+        print(f'{extent.virtual_offset:>20} {extent.length:>20} {host:>20} '
+              f'{extent.kind}{source}')
+        totals[extent.kind] += extent.length
+
+    print()
+    for kind, length in sorted(totals.items()):
+        print(f'{kind}: {length} bytes')
+
+
+def print_snapshots(image):
+    print(f'{"ID":<10} {"Name":<30} {"VM state size":>14} '
+          f'{"Date":<26} {"Disk size":>16}')
+    for snapshot in image.snapshots():
+        print(f'{snapshot.id:<10} {snapshot.name:<30} '
+              f'{snapshot.vm_state_size:>14} '
+              f'{snapshot.date.strftime("%Y-%m-%d %H:%M:%S %Z"):<26} '
+              f'{snapshot.disk_size:>16}')
+
+
+def print_bitmaps(image, name=None):
+    if not name:
+        print(f'{"Name":<30} {"Granularity":>12} {"Flags":<12}')
+        for bitmap in image.bitmaps():
+            flags = []
+            if bitmap.in_use:
+                flags.append('in-use')
+            if bitmap.auto:
+                flags.append('auto')
+            print(f'{bitmap.name:<30} {bitmap.granularity:>12} '
+                  f'{",".join(flags):<12}')
+        return
+
+    dirty = 0
+    print(f'{"Offset":>20} {"Length":>20}')
+    for offset, length in image.dirty_ranges(image.find_bitmap(name)):
+        print(f'{offset:>20} {length:>20}')
+        dirty += length
+
+    print()
+    print(f'{dirty} bytes dirty')
+
+
+def print_diff(image, old, new):
+    old_snapshot = image.find_snapshot(old)
+    new_snapshot = image.find_snapshot(new) if new else None
+
+    changed = 0
+    stats = collections.Counter()
+    print(f'{"Offset":>20} {"Length":>20}')
+    for offset, length in image.diff(old_snapshot, new_snapshot, stats=stats):
+        print(f'{offset:>20} {length:>20}')
+        changed += length
+
+    print()
+    print(f'{changed} bytes changed, {stats["l2_tables_read"]} L2 tables '
+          f'read')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Inspect qcow2 images.')
+    parser.add_argument('--json', action='store_true',
+                        help='Output JSON rather than text.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    info_parser = subparsers.add_parser(
+        'info', help='Show the header, header extensions and L1 summary.')
+    info_parser.add_argument('image')
+    info_parser.add_argument('--header-only', action='store_true',
+                             help='Only read the first cluster of the image, '
+                                  'and skip the L1 summary.')
+
+    l1_parser = subparsers.add_parser('l1', help='Show the L1 table.')
+    l1_parser.add_argument('image')
+    l1_parser.add_argument('--entries', action='store_true',
+                           help='List every allocated L1 entry.')
+
+    map_parser = subparsers.add_parser(
+        'map', help='Show the allocation map of the virtual disk.')
+    map_parser.add_argument('image')
+    map_parser.add_argument('--chain', action='store_true',
+                            help='Merge in the backing chain, showing which '
+                                 'file provides each extent.')
+
+    snapshots_parser = subparsers.add_parser(
+        'snapshots', help='List the internal snapshots.')
+    snapshots_parser.add_argument('image')
+
+    diff_parser = subparsers.add_parser(
+        'diff', help='Show the virtual ranges which differ between two '
+                     'snapshots.')
+    diff_parser.add_argument('image')
+    diff_parser.add_argument('old', help='Snapshot id or name.')
+    diff_parser.add_argument('new', nargs='?', default=None,
+                             help='Snapshot id or name (default: the active '
+                                  'image).')
+
+    bitmaps_parser = subparsers.add_parser(
+        'bitmaps', help='List persistent dirty bitmaps, or the dirty ranges '
+                        'of one bitmap.')
+    bitmaps_parser.add_argument('image')
+    bitmaps_parser.add_argument('--name', default=None,
+                                help='Show the dirty ranges of this bitmap.')
+
+    # This used to be run as "parser.py <image>", so if there's no command
+    # then default to info to keep old command lines working
+    argv = sys.argv[1:]
+    positional = [arg for arg in argv if not arg.startswith('-')]
+    if positional and positional[0] not in subparsers.choices:
+        argv.insert(argv.index(positional[0]), 'info')
+    args = parser.parse_args(argv)
+
+    if args.json:
+        header_only = args.command == 'info' and args.header_only
+        if args.command == 'map' and args.chain:
+            with Qcow2Chain(args.image) as chain:
+                summary = map_summary(chain.layers[0], chain=chain)
+        else:
+            with Qcow2Image(args.image, header_only=header_only) as image:
+                if args.command == 'info':
+                    summary = {'header': header_summary(image)}
+                    if not header_only:
+                        summary['l1'] = l1_summary(image)
+                elif args.command == 'l1':
+                    summary = l1_summary(image, entries=args.entries)
+                elif args.command == 'map':
+                    summary = map_summary(image)
+                elif args.command == 'snapshots':
+                    summary = snapshots_summary(image)
+                elif args.command == 'diff':
+                    summary = diff_summary(image, args.old, args.new)
+                elif args.command == 'bitmaps':
+                    summary = bitmaps_summary(image, name=args.name)
+        print(json.dumps(summary, indent=4, sort_keys=True))
+        sys.exit(0)
+
+    if args.command == 'map' and args.chain:
+        with Qcow2Chain(args.image) as chain:
+            print_map(chain.layers[0], chain=chain)
+        sys.exit(0)
+
+    if args.command == 'info' and args.header_only:
+        with Qcow2Image(args.image, header_only=True) as image:
+            print_header(image)
+        sys.exit(0)
+
+    with Qcow2Image(args.image) as image:
+        if args.command == 'info':
+            print_header(image)
+            print_l1(image)
+
+        elif args.command == 'l1':
+            print_l1(image, entries=args.entries)
+
+        elif args.command == 'map':
+            print_map(image)
+
+        elif args.command == 'snapshots':
+            print_snapshots(image)
+
+        elif args.command == 'diff':
+            print_diff(image, args.old, args.new)
+
+        elif args.command == 'bitmaps':
+            print_bitmaps(image, name=args.name)
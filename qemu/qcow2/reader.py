@@ -0,0 +1,484 @@
+#!/usr/bin/python3
+
+# A read only, file like view of the virtual disk inside a qcow2 image. This
+# lets you seek around a guest disk and read things out of it (a partition
+# table, a filesystem, a single file) without converting the whole image.
+
+import argparse
+import collections
+import concurrent.futures
+import io
+import sys
+
+from parser import (
+    Qcow2Chain, Qcow2Image, RawImage, FormatError, EXTENT_NORMAL, EXTENT_ZERO,
+    EXTENT_COMPRESSED, EXTENT_UNALLOCATED, decompress_cluster)
+
+
+# The number of decoded L2 tables to keep around. Each one covers
+# cluster_size * cluster_size / 8 bytes of virtual disk (512 MiB with the
+# default 64 KiB clusters, half that with extended L2 entries), so this
+# default covers 128 GiB of hot disk.
+DEFAULT_L2_CACHE_SIZE = 256
+
+# The number of decompressed clusters to keep around
+DEFAULT_COMPRESSED_CACHE_SIZE = 64
+
+
+class DecompressedClusterCache:
+    # A bounded LRU cache of decompressed clusters, keyed by host offset.
+    # Entries may also be futures for clusters which are being decompressed
+    # by read ahead.
+
+    def __init__(self, size):
+        self.size = size
+        self.clusters = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, host_offset):
+        return host_offset in self.clusters
+
+    def get(self, host_offset):
+        data = self.clusters.get(host_offset)
+        if data is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.clusters.move_to_end(host_offset)
+        if isinstance(data, concurrent.futures.Future):
+            data = data.result()
+            self.clusters[host_offset] = data
+        return data
+
+    def put(self, host_offset, data):
+        self.clusters[host_offset] = data
+        self.clusters.move_to_end(host_offset)
+        while len(self.clusters) > self.size:
+            self.clusters.popitem(last=False)
+
+    def clear(self):
+        self.clusters.clear()
+
+
+class _ImageMapper:
+    # Maps virtual offsets to host locations for one qcow2 image, with a
+    # bounded LRU cache of decoded L2 tables
+
+    def __init__(self, image, l2_cache_size):
+        self.image = image
+        self.l1 = image.l1_table()
+        self.l2_cache = collections.OrderedDict()
+        self.l2_cache_size = l2_cache_size
+        self.l2_cache_hits = 0
+        self.l2_cache_misses = 0
+
+    def clear(self):
+        self.l2_cache.clear()
+
+    def _l2_table(self, l1_index):
+        # Returns None if there is no L2 table for this part of the disk
+        l2 = self.l2_cache.get(l1_index)
+        if l2 is not None:
+            self.l2_cache.move_to_end(l1_index)
+            self.l2_cache_hits += 1
+            return l2
+
+        if l1_index >= len(self.l1):
+            return None
+        l2_offset = self.l1.offsets[l1_index]
+        if not l2_offset:
+            return None
+
+        self.l2_cache_misses += 1
+        l2 = self.image.l2_table(l2_offset)
+        self.l2_cache[l1_index] = l2
+        if len(self.l2_cache) > self.l2_cache_size:
+            self.l2_cache.popitem(last=False)
+        return l2
+
+    def segment(self, offset, length):
+        # Find the longest run starting at offset (and no longer than length)
+        # which can be satisfied in one go. Returns (kind, host, length),
+        # where host is the host offset for normal data and the compressed
+        # descriptor for compressed clusters.
+        image = self.image
+        cluster_bits = image.cluster_bits
+        cluster = offset >> cluster_bits
+        l1_index, l2_index = divmod(cluster, image.l2_entries)
+        limit = min(offset + length,
+                    ((l1_index + 1) * image.l2_entries) << cluster_bits)
+
+        l2 = self._l2_table(l1_index)
+        if l2 is None:
+            return EXTENT_UNALLOCATED, None, limit - offset
+        if l2.extended:
+            return self._extended_segment(l2, offset, l2_index, limit)
+
+        kind = l2.kind(l2_index)
+        host = None
+        if kind == EXTENT_NORMAL:
+            host = l2.offsets[l2_index]
+        elif kind == EXTENT_COMPRESSED:
+            end = (cluster + 1) << cluster_bits
+            return (kind, l2.compressed_descriptor(l2_index),
+                    min(end, limit) - offset)
+
+        # Extend the run over following clusters of the same kind, which for
+        # normal clusters also have to be contiguous in the host file
+        index = l2_index + 1
+        end = (cluster + 1) << cluster_bits
+        while end < limit:
+            if l2.kind(index) != kind:
+                break
+            if host is not None and (l2.offsets[index] !=
+                                     host + ((index - l2_index) <<
+                                             cluster_bits)):
+                break
+            index += 1
+            end += image.cluster_size
+
+        if host is not None:
+            host += offset & (image.cluster_size - 1)
+        return kind, host, min(end, limit) - offset
+
+    def _extended_segment(self, l2, offset, l2_index, limit):
+        # The same as segment(), but in units of subclusters. A run can
+        # carry on into the next cluster if it reaches the end of this one.
+        cluster_size = l2.cluster_size
+        subcluster_size = l2.subcluster_size
+        cluster_start = offset & ~(cluster_size - 1)
+        subcluster = (offset - cluster_start) // subcluster_size
+
+        kind, count = l2.subcluster_run(l2_index, subcluster)
+        if kind == EXTENT_COMPRESSED:
+            return (kind, l2.compressed_descriptor(l2_index),
+                    min(cluster_start + cluster_size, limit) - offset)
+
+        host = None
+        next_host = None
+        if kind == EXTENT_NORMAL:
+            host = l2.offsets[l2_index] + (offset - cluster_start)
+            next_host = l2.offsets[l2_index] + cluster_size
+
+        end = cluster_start + (subcluster + count) * subcluster_size
+        index = l2_index
+        while (end < limit and subcluster + count == l2.subclusters and
+               index + 1 < len(l2)):
+            index += 1
+            if l2.compressed[index]:
+                break
+            next_kind, next_count = l2.subcluster_run(index, 0)
+            if next_kind != kind:
+                break
+            if host is not None:
+                if l2.offsets[index] != next_host:
+                    break
+                next_host += cluster_size
+            subcluster = 0
+            count = next_count
+            end += count * subcluster_size
+
+        return kind, host, min(end, limit) - offset
+
+
+class _RawMapper:
+    # Raw backing files map straight through
+    l2_cache_hits = 0
+    l2_cache_misses = 0
+
+    def __init__(self, image):
+        self.image = image
+
+    def clear(self):
+        ...
+
+    def segment(self, offset, length):
+        return EXTENT_NORMAL, offset, length
+
+
+class Qcow2Reader(io.RawIOBase):
+    def __init__(self, source, l2_cache_size=DEFAULT_L2_CACHE_SIZE,
+                 compressed_cache_size=DEFAULT_COMPRESSED_CACHE_SIZE,
+                 readahead=0, readahead_threads=None):
+        # source is an open Qcow2Image or Qcow2Chain, which must outlive the
+        # reader. A bare Qcow2Image reads unallocated clusters as zeros even
+        # if it has a backing file; use a chain to read through to the
+        # backing files. For chains, the chain's merged extent map says
+        # which layer to read from, so reads never walk down the chain. The
+        # map is built by the first read, not here.
+        #
+        # If readahead is set, reading a compressed cluster also starts
+        # decompressing up to that many following compressed clusters in a
+        # thread pool. zlib releases the GIL while it works, so this helps
+        # sequential scans of compressed images.
+        super().__init__()
+        if isinstance(source, Qcow2Chain):
+            self.chain = source
+            self.layers = source.layers
+        else:
+            self.chain = None
+            self.layers = [source]
+
+        self.image = self.layers[0]
+        self.position = 0
+        self.zero_cluster = bytes(self.image.cluster_size)
+
+        self.mappers = []
+        for layer in self.layers:
+            if isinstance(layer, RawImage):
+                self.mappers.append(_RawMapper(layer))
+            else:
+                self.mappers.append(_ImageMapper(layer, l2_cache_size))
+
+        self.compressed_cache = DecompressedClusterCache(
+            max(compressed_cache_size, readahead + 1))
+        self.readahead = readahead
+        self.readahead_pool = None
+        if readahead:
+            self.readahead_pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=readahead_threads)
+
+    @property
+    def extent_map(self):
+        # None for a bare image, which is mapped an L2 table at a time
+        if self.chain is None:
+            return None
+        return self.chain.extent_map()
+
+    @property
+    def l2_cache_hits(self):
+        return sum(mapper.l2_cache_hits for mapper in self.mappers)
+
+    @property
+    def l2_cache_misses(self):
+        return sum(mapper.l2_cache_misses for mapper in self.mappers)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.image.virtual_size + offset
+        else:
+            raise ValueError(f'Invalid whence: {whence}')
+
+        if position < 0:
+            raise ValueError(f'Negative seek position: {position}')
+        self.position = position
+        return self.position
+
+    def close(self):
+        if self.readahead_pool:
+            self.readahead_pool.shutdown(wait=True, cancel_futures=True)
+            self.readahead_pool = None
+        self.compressed_cache.clear()
+        for mapper in self.mappers:
+            mapper.clear()
+        super().close()
+
+    def _segment(self, offset, length):
+        # Returns (layer, kind, host, length). layer is None for ranges
+        # which read as zeros because nothing in the chain has them.
+        if self.chain is None:
+            return (0, ) + self.mappers[0].segment(offset, length)
+
+        extent = self.extent_map.lookup(offset)
+        length = min(length, extent.virtual_offset + extent.length - offset)
+        if extent.layer is None:
+            return None, EXTENT_UNALLOCATED, None, length
+        return ((extent.layer, ) +
+                self.mappers[extent.layer].segment(offset, length))
+
+    def _fill_zero(self, view):
+        zero_cluster = self.zero_cluster
+        for start in range(0, len(view), len(zero_cluster)):
+            chunk = view[start:start + len(zero_cluster)]
+            chunk[:] = zero_cluster[:len(chunk)]
+
+    def _decompress_async(self, layer, host_offset, length):
+        # Copy the compressed data out of the mapping here, so the worker
+        # thread never touches the mapping itself
+        image = self.layers[layer]
+        data = bytes(image.compressed_data(host_offset, length))
+        return self.readahead_pool.submit(
+            decompress_cluster, data, image.compression_type,
+            image.cluster_size)
+
+    def _start_readahead(self, offset):
+        # Queue decompression of the compressed clusters following the one
+        # at virtual offset, stopping at the first cluster which isn't
+        # compressed
+        cluster_size = self.image.cluster_size
+        offset = (offset | (cluster_size - 1)) + 1
+        for _ in range(self.readahead):
+            if offset >= self.image.virtual_size:
+                return
+            layer, kind, descriptor, _ = self._segment(offset, cluster_size)
+            if kind != EXTENT_COMPRESSED:
+                return
+            if (layer, descriptor[0]) not in self.compressed_cache:
+                self.compressed_cache.put(
+                    (layer, descriptor[0]),
+                    self._decompress_async(layer, *descriptor))
+            offset += cluster_size
+
+    def _compressed_cluster(self, layer, descriptor, offset):
+        host_offset, length = descriptor
+        data = self.compressed_cache.get((layer, host_offset))
+        if data is None:
+            data = self.layers[layer].decompress(host_offset, length)
+            self.compressed_cache.put((layer, host_offset), data)
+        if self.readahead_pool:
+            self._start_readahead(offset)
+        return data
+
+    def _read_segment_into(self, layer, kind, host, view, offset):
+        if kind == EXTENT_NORMAL:
+            source = self.layers[layer].mm.view(host, len(view))
+            try:
+                view[:] = source
+            finally:
+                source.release()
+        elif kind in (EXTENT_ZERO, EXTENT_UNALLOCATED):
+            self._fill_zero(view)
+        elif kind == EXTENT_COMPRESSED:
+            data = self._compressed_cluster(layer, host, offset)
+            start = offset & (self.layers[layer].cluster_size - 1)
+            if len(data) < start + len(view):
+                raise FormatError(f'Compressed cluster at host offset '
+                                  f'{host[0]} is truncated')
+            view[:] = memoryview(data)[start:start + len(view)]
+        else:
+            raise FormatError(f'Reading {kind} clusters is not supported')
+
+    def _remaining(self, size):
+        remaining = max(0, self.image.virtual_size - self.position)
+        if size is None or size < 0:
+            return remaining
+        return min(size, remaining)
+
+    def readinto(self, b):
+        view = memoryview(b).cast('B')
+        length = self._remaining(len(view))
+
+        done = 0
+        while done < length:
+            layer, kind, host, count = self._segment(self.position + done,
+                                                     length - done)
+            self._read_segment_into(layer, kind, host,
+                                    view[done:done + count],
+                                    self.position + done)
+            done += count
+
+        self.position += done
+        return done
+
+    def read_view(self, size=-1):
+        # Like read(), but returns a memoryview. Where the whole read is
+        # satisfied by one run of contiguous normal clusters, or by zeros
+        # which fit in a cluster, this is a zero copy slice of the mapping
+        # (or of a shared zero buffer, or of a cached decompressed cluster).
+        # Slices of the mapping must be released before the image is closed.
+        length = self._remaining(size)
+        if length == 0:
+            return memoryview(b'')
+
+        layer, kind, host, count = self._segment(self.position, length)
+        if count == length:
+            if kind == EXTENT_NORMAL:
+                self.position += length
+                return self.layers[layer].mm.view(host, length)
+            if (kind in (EXTENT_ZERO, EXTENT_UNALLOCATED) and
+                    length <= len(self.zero_cluster)):
+                self.position += length
+                return memoryview(self.zero_cluster)[:length]
+            if kind == EXTENT_COMPRESSED:
+                data = self._compressed_cluster(layer, host, self.position)
+                start = self.position & (self.layers[layer].cluster_size - 1)
+                self.position += length
+                return memoryview(data)[start:start + length]
+
+        buf = bytearray(length)
+        self.readinto(buf)
+        return memoryview(buf)
+
+    def read_segments(self, offset, length):
+        # Yield (offset, length, view) for consecutive pieces of the given
+        # range, without copying anything. view is None for pieces which read
+        # as zeros, and otherwise a slice of the mapping or of a cached
+        # decompressed cluster, with the same rules as read_view(). This
+        # doesn't move the file position.
+        end = min(offset + length, self.image.virtual_size)
+        while offset < end:
+            layer, kind, host, count = self._segment(offset, end - offset)
+            if kind == EXTENT_NORMAL:
+                yield offset, count, self.layers[layer].mm.view(host, count)
+            elif kind in (EXTENT_ZERO, EXTENT_UNALLOCATED):
+                yield offset, count, None
+            elif kind == EXTENT_COMPRESSED:
+                data = self._compressed_cluster(layer, host, offset)
+                start = offset & (self.layers[layer].cluster_size - 1)
+                if len(data) < start + count:
+                    raise FormatError(f'Compressed cluster at host offset '
+                                      f'{host[0]} is truncated')
+                yield offset, count, memoryview(data)[start:start + count]
+            else:
+                raise FormatError(f'Reading {kind} clusters is not supported')
+            offset += count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Read a range of the virtual disk in a qcow2 image.')
+    parser.add_argument('image')
+    parser.add_argument('--offset', type=int, default=0,
+                        help='Virtual offset to start reading at.')
+    parser.add_argument('--length', type=int, default=None,
+                        help='Number of bytes to read (default: to the end '
+                             'of the disk).')
+    parser.add_argument('--output', default=None,
+                        help='File to write to (default: stdout).')
+    parser.add_argument('--readahead', type=int, default=0,
+                        help='Number of compressed clusters to decompress '
+                             'ahead of the reader.')
+    parser.add_argument('--no-backing', action='store_true',
+                        help='Do not read through to backing files.')
+    args = parser.parse_args()
+
+    if args.no_backing:
+        source = Qcow2Image(args.image)
+    else:
+        source = Qcow2Chain(args.image)
+
+    with source:
+        reader = Qcow2Reader(source, readahead=args.readahead)
+        reader.seek(args.offset)
+        remaining = reader._remaining(args.length)
+
+        if args.output:
+            out = open(args.output, 'wb')
+        else:
+            out = sys.stdout.buffer
+
+        try:
+            while remaining > 0:
+                data = reader.read_view(min(remaining, 4 * 1024 * 1024))
+                out.write(data)
+                remaining -= len(data)
+                data.release()
+        finally:
+            if args.output:
+                out.close()
+            reader.close()
@@ -0,0 +1,300 @@
+#!/usr/bin/python3
+
+# Scan directory trees full of qcow2 images (an image store, or a hypervisor's
+# instances directory) and emit a JSON summary of each image, one per line.
+# Images are parsed in a process pool. Results are kept in a sqlite index
+# keyed by (device, inode, size, mtime), so a nightly rescan only parses the
+# images which have changed since last time. Files which aren't qcow2 images
+# are remembered too, so they aren't probed again either.
+
+import argparse
+import collections
+import concurrent.futures
+import fnmatch
+import json
+import os
+import sqlite3
+import sys
+import time
+
+from parser import Qcow2Image, compression_type_to_string
+
+
+QCOW2_MAGIC = b'QFI\xfb'
+
+DEFAULT_INDEX = os.path.expanduser('~/.cache/qcow2-scan.sqlite')
+
+# The number of images handed to a worker at a time, which amortises the
+# cost of passing work between processes
+SCAN_CHUNK_SIZE = 16
+
+# Write cached results to disk every this many new results, so an
+# interrupted scan doesn't lose everything
+INDEX_COMMIT_INTERVAL = 1000
+
+
+def walk(top, pattern=None):
+    # Yield (path, stat result) for each regular file under top, without
+    # following symlinks. scandir gives us file types without an extra stat
+    # per entry.
+    if not os.path.isdir(top):
+        try:
+            top_stat = os.stat(top)
+        except OSError as e:
+            print(f'Skipping {top}: {e}', file=sys.stderr)
+            return
+        yield top, top_stat
+        return
+
+    try:
+        entries = list(os.scandir(top))
+    except OSError as e:
+        print(f'Skipping {top}: {e}', file=sys.stderr)
+        return
+
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                yield from walk(entry.path, pattern)
+            elif entry.is_file(follow_symlinks=False):
+                if pattern and not fnmatch.fnmatch(entry.name, pattern):
+                    continue
+                yield entry.path, entry.stat(follow_symlinks=False)
+        except OSError as e:
+            print(f'Skipping {entry.path}: {e}', file=sys.stderr)
+
+
+def summarize(path, allocation=True):
+    # A JSON friendly summary of one image. The allocation summary walks
+    # every L2 table, which is the expensive part.
+    with open(path, 'rb') as f:
+        if f.read(4) != QCOW2_MAGIC:
+            return {'qcow2': False}
+
+    # Without the allocation summary only the header is needed, so don't
+    # map the whole image
+    with Qcow2Image(path, header_only=not allocation) as image:
+        summary = {
+            'qcow2': True,
+            'version': image.version,
+            'virtual_size': image.virtual_size,
+            'cluster_size': image.cluster_size,
+            'backing_file': image.backing_file,
+            'backing_format': image.backing_format,
+            'compression': compression_type_to_string.get(
+                image.compression_type, 'unknown'),
+            'refcount_order': image.refcount_order,
+            'incompatible_features': image.incompatible_features,
+            'compatible_features': image.compatible_features,
+            'autoclear_features': image.autoclear_features,
+            'extended_l2': image.extended_l2,
+            'snapshots': image.snapshots_count,
+            'bitmaps': image.bitmaps_count
+        }
+
+        if allocation:
+            l1 = image.l1_table()
+            totals = collections.Counter()
+            for extent in image.extents(l1=l1):
+                totals[extent.kind] += extent.length
+            summary['l2_tables'] = len(l1.allocated())
+            summary['allocation'] = dict(totals)
+
+    return summary
+
+
+def _summarize_paths(paths, allocation):
+    # Worker: summarize a chunk of images. One broken image mustn't stop the
+    # scan, so any failure becomes part of that image's result. Failures to
+    # read the file at all might be temporary, and are marked as such so
+    # they aren't cached.
+    results = []
+    for path in paths:
+        try:
+            results.append(summarize(path, allocation=allocation))
+        except OSError as e:
+            results.append({'error': str(e), 'transient': True})
+        except Exception as e:
+            error = type(e).__name__
+            if str(e):
+                error += f': {e}'
+            results.append({'qcow2': True, 'error': error})
+    return results
+
+
+class ScanIndex:
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS images ('
+            'device INTEGER, inode INTEGER, size INTEGER, mtime_ns INTEGER, '
+            'summary TEXT, seen REAL, '
+            'PRIMARY KEY (device, inode, size, mtime_ns))')
+        self.uncommitted = 0
+
+    @staticmethod
+    def key(st):
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def lookup(self, key, seen):
+        row = self.db.execute(
+            'SELECT summary FROM images WHERE device = ? AND inode = ? AND '
+            'size = ? AND mtime_ns = ?', key).fetchone()
+        if not row:
+            return None
+        self.db.execute(
+            'UPDATE images SET seen = ? WHERE device = ? AND inode = ? AND '
+            'size = ? AND mtime_ns = ?', (seen, ) + key)
+        return json.loads(row[0])
+
+    def store(self, key, summary, seen):
+        self.db.execute(
+            'INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?)',
+            key + (json.dumps(summary), seen))
+        self.uncommitted += 1
+        if self.uncommitted >= INDEX_COMMIT_INTERVAL:
+            self.commit()
+
+    def prune(self, before):
+        # Forget images which weren't seen by a scan starting at before
+        cursor = self.db.execute('DELETE FROM images WHERE seen < ?',
+                                 (before, ))
+        return cursor.rowcount
+
+    def commit(self):
+        self.db.commit()
+        self.uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+
+class ScanStats:
+    def __init__(self):
+        self.files = 0
+        self.images = 0
+        self.cached = 0
+        self.parsed = 0
+        self.errors = 0
+
+
+def scan(paths, index=None, jobs=None, allocation=True, pattern=None,
+         stats=None):
+    # Yield (path, summary, cached) for every file under paths, in no
+    # particular order. Only files missing from the index (or changed since
+    # they were indexed) are parsed.
+    jobs = jobs or os.cpu_count()
+    seen = time.time()
+    if stats is None:
+        stats = ScanStats()
+
+    def finish(chunk, future):
+        for (path, key), summary in zip(chunk, future.result()):
+            stats.parsed += 1
+            if index and not summary.get('transient'):
+                index.store(key, summary, seen)
+            yield path, summary, False
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        in_flight = collections.deque()
+        chunk = []
+
+        def submit():
+            future = pool.submit(_summarize_paths,
+                                 [path for path, _ in chunk], allocation)
+            in_flight.append((chunk, future))
+
+        for top in paths:
+            for path, st in walk(top, pattern):
+                stats.files += 1
+                key = ScanIndex.key(st)
+                summary = index.lookup(key, seen) if index else None
+                if summary is not None:
+                    stats.cached += 1
+                    yield path, summary, True
+                    continue
+
+                chunk.append((path, key))
+                if len(chunk) >= SCAN_CHUNK_SIZE:
+                    submit()
+                    chunk = []
+
+                # Don't queue up the whole store, and hand back results
+                # as we go
+                while len(in_flight) > jobs * 2:
+                    yield from finish(*in_flight.popleft())
+
+        if chunk:
+            submit()
+        while in_flight:
+            yield from finish(*in_flight.popleft())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Summarize every qcow2 image under some directories as '
+                    'JSON lines.')
+    parser.add_argument('paths', nargs='+',
+                        help='Directories (or individual files) to scan.')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='Number of worker processes (default: one per '
+                             'CPU).')
+    parser.add_argument('--index', default=DEFAULT_INDEX,
+                        help=f'Index of previous results (default: '
+                             f'{DEFAULT_INDEX}).')
+    parser.add_argument('--no-index', action='store_true',
+                        help='Parse every image, and do not update the '
+                             'index.')
+    parser.add_argument('--prune', action='store_true',
+                        help='Remove index entries for images this scan did '
+                             'not see.')
+    parser.add_argument('--headers-only', action='store_true',
+                        help='Skip the allocation summary, which needs every '
+                             'L2 table to be read.')
+    parser.add_argument('--pattern', default=None,
+                        help='Only look at files whose names match this '
+                             'glob.')
+    parser.add_argument('--output', default=None,
+                        help='File to write to (default: stdout).')
+    args = parser.parse_args()
+
+    # Allocation summaries and header only summaries mustn't be mixed up in
+    # the index
+    index_path = args.index
+    if args.headers_only:
+        index_path += '.headers'
+    index = None if args.no_index else ScanIndex(index_path)
+
+    out = open(args.output, 'w') if args.output else sys.stdout
+    stats = ScanStats()
+    start = time.time()
+    try:
+        for path, summary, cached in scan(
+                args.paths, index=index, jobs=args.jobs,
+                allocation=not args.headers_only, pattern=args.pattern,
+                stats=stats):
+            if not summary.get('qcow2') and 'error' not in summary:
+                continue
+            stats.images += 1
+            if 'error' in summary:
+                stats.errors += 1
+            out.write(json.dumps(dict(path=path, cached=cached, **summary),
+                                 sort_keys=True) + '\n')
+
+        if index and args.prune:
+            pruned = index.prune(start)
+            print(f'Pruned {pruned} index entries', file=sys.stderr)
+    finally:
+        if index:
+            index.close()
+        if args.output:
+            out.close()
+
+    print(f'Scanned {stats.files} files in {time.time() - start:.02f} '
+          f'seconds: {stats.images} images ({stats.errors} with errors), '
+          f'{stats.cached} from the index, {stats.parsed} parsed',
+          file=sys.stderr)
@@ -0,0 +1,514 @@
+#!/usr/bin/python3
+
+# Generate synthetic qcow2 images for testing and benchmarking, so we don't
+# need real VM images (or qemu-img) to exercise the parser. The images are
+# valid (qemu-img check and check.py are both happy with them), but the data
+# is just a marker recording which virtual cluster and which write of that
+# cluster it is. By default only the marker is written and the rest of each
+# data cluster is left as a hole in the host file, so multi terabyte images
+# with lots of allocated clusters stay cheap to create.
+
+import argparse
+import array
+import collections
+import os
+import random
+import struct
+import sys
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from parser import (
+    ALL_SUBCLUSTERS, COMPRESSED_SECTOR_SIZE, COPIED_FLAG, COMPRESSED_FLAG,
+    EXTENSION_BACKING_FORMAT, INCOMPATIBLE_EXTENDED_L2, FormatError)
+
+
+HEADER_FORMAT = '>4sIQIIQIIQQIIQQQQIIB7x'
+HEADER_LENGTH = struct.calcsize(HEADER_FORMAT)
+
+INCOMPATIBLE_COMPRESSION_TYPE = 1 << 3
+
+compression_types = {
+    'deflate': 0,
+    'zstd': 1
+}
+
+
+def cluster_data(cluster, write, cluster_size, sparse=True):
+    # The contents of virtual cluster number cluster, as of its write'th
+    # write. Tests can use this to check what they read back.
+    marker = struct.pack('>QQ', cluster, write)
+    if sparse:
+        return marker + bytes(cluster_size - len(marker))
+    return marker * (cluster_size // len(marker))
+
+
+def encode_be64(values):
+    out = array.array('Q', values)
+    if sys.byteorder == 'little':
+        out.byteswap()
+    return out.tobytes()
+
+
+def encode_refcounts(values, refcount_order):
+    # The inverse of parser.decode_refcounts
+    bits = 1 << refcount_order
+    limit = (1 << bits) - 1
+    for value in values:
+        if value > limit:
+            raise FormatError(f'Refcount {value} does not fit in {bits} bits')
+
+    if refcount_order < 3:
+        per_byte = 8 >> refcount_order
+        out = bytearray((len(values) + per_byte - 1) // per_byte)
+        for index, value in enumerate(values):
+            if value:
+                out[index // per_byte] |= value << ((index % per_byte) * bits)
+        return bytes(out)
+
+    if refcount_order == 3:
+        return bytes(values)
+
+    out = array.array({4: 'H', 5: 'I', 6: 'Q'}[refcount_order], values)
+    if sys.byteorder == 'little':
+        out.byteswap()
+    return out.tobytes()
+
+
+class Qcow2Writer:
+    def __init__(self, path, virtual_size, cluster_bits=16, density=0.1,
+                 run_length=16, compressed=0.0, compression='deflate',
+                 snapshots=0, snapshot_changes=0.05, backing_file=None,
+                 backing_format='qcow2', refcount_order=4, sparse=True,
+                 extended_l2=False, partial=0.25, seed=0):
+        # density is the fraction of the disk which is allocated, in runs of
+        # run_length clusters. compressed is the fraction of written
+        # clusters which are compressed. Each snapshot is taken before
+        # rewriting (or newly allocating) snapshot_changes of the allocated
+        # clusters. With extended_l2, partial is the fraction of
+        # uncompressed clusters which only have some of their subclusters
+        # allocated, with a random mix of allocated, zero and unallocated
+        # subclusters.
+        self.path = path
+        self.virtual_size = virtual_size
+        self.cluster_bits = cluster_bits
+        self.cluster_size = 1 << cluster_bits
+        self.density = density
+        self.run_length = run_length
+        self.compressed = compressed
+        self.compression = compression
+        self.snapshots = snapshots
+        self.snapshot_changes = snapshot_changes
+        self.backing_file = backing_file
+        self.backing_format = backing_format
+        self.refcount_order = refcount_order
+        self.sparse = sparse
+        self.extended_l2 = extended_l2
+        self.partial = partial
+        self.random = random.Random(seed)
+
+        if compression not in compression_types:
+            raise FormatError(f'Unknown compression type {compression}')
+        if compressed and compression == 'zstd' and not zstandard:
+            raise FormatError('zstd compression requires the zstandard module')
+        if extended_l2 and cluster_bits < 14:
+            raise FormatError('Extended L2 entries need clusters of at least '
+                              '16 KiB')
+
+        self.l2_entry_words = 2 if extended_l2 else 1
+        self.l2_entries = self.cluster_size // (8 * self.l2_entry_words)
+        self.cluster_count = ((virtual_size + self.cluster_size - 1) >>
+                              cluster_bits)
+        self.l1_size = ((self.cluster_count + self.l2_entries - 1) //
+                        self.l2_entries)
+
+    def _compress(self, data):
+        if self.compression == 'zstd':
+            return zstandard.ZstdCompressor().compress(data)
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -12)
+        return compressor.compress(data) + compressor.flush()
+
+    def _allocate(self, count):
+        # Host clusters are handed out in order, starting after the header
+        offset = self.next_cluster << self.cluster_bits
+        self.next_cluster += count
+        return offset
+
+    def _choose_writes(self):
+        # Returns {virtual cluster: [versions it was written in]}. Version
+        # i < snapshots is what snapshot i sees, the last version is the
+        # active image.
+        slots = max(1, self.cluster_count // self.run_length)
+        chosen = self.random.sample(range(slots),
+                                    min(slots, int(slots * self.density)))
+        writes = collections.defaultdict(list)
+        for slot in chosen:
+            first = slot * self.run_length
+            for cluster in range(first, min(first + self.run_length,
+                                            self.cluster_count)):
+                writes[cluster].append(0)
+
+        for version in range(1, self.snapshots + 1):
+            allocated = list(writes)
+            changes = int(len(allocated) * self.snapshot_changes)
+            rewritten = set(self.random.sample(allocated,
+                                               min(changes, len(allocated))))
+            # Some brand new allocations too
+            for _ in range(changes // 4):
+                rewritten.add(self.random.randrange(self.cluster_count))
+            for cluster in rewritten:
+                writes[cluster].append(version)
+
+        return writes
+
+    def _subcluster_masks(self):
+        # (allocation, zero) masks for a newly written cluster
+        if not self.extended_l2 or self.random.random() >= self.partial:
+            return ALL_SUBCLUSTERS, 0
+        allocation = self.random.getrandbits(32)
+        zero = 0
+        if self.random.random() < 0.5:
+            zero = self.random.getrandbits(32) & ~allocation
+        return allocation, zero
+
+    def _write_data(self, fd, writes):
+        # Write every version of every cluster, returning
+        # {(cluster, version): descriptor} where a descriptor is
+        # ('normal', host offset, allocation mask, zero mask) or
+        # ('compressed', host offset, length)
+        descriptors = {}
+        compressed_buffer = bytearray()
+        compressed_base = None
+        pending = []
+
+        def flush_compressed():
+            if compressed_buffer:
+                os.pwrite(fd, compressed_buffer, compressed_base)
+
+        for cluster in sorted(writes):
+            for version in writes[cluster]:
+                data = cluster_data(cluster, version, self.cluster_size,
+                                    sparse=self.sparse)
+
+                compressed = None
+                if self.random.random() < self.compressed:
+                    compressed = self._compress(data)
+
+                # Like qemu, store data which doesn't compress uncompressed
+                if compressed and len(compressed) < self.cluster_size:
+                    if (compressed_base is None or
+                            len(compressed_buffer) + len(compressed) >
+                            self.cluster_size):
+                        flush_compressed()
+                        compressed_buffer = bytearray()
+                        compressed_base = self._allocate(1)
+                    host_offset = compressed_base + len(compressed_buffer)
+                    compressed_buffer += compressed
+                    descriptors[(cluster, version)] = (
+                        'compressed', host_offset, len(compressed))
+                    continue
+
+                host_offset = self._allocate(1)
+                if self.sparse:
+                    os.pwrite(fd, data[:16], host_offset)
+                else:
+                    pending.append((host_offset, data))
+                    if len(pending) >= 64:
+                        self._flush_pending(fd, pending)
+                descriptors[(cluster, version)] = (
+                    ('normal', host_offset) + self._subcluster_masks())
+
+        flush_compressed()
+        self._flush_pending(fd, pending)
+        return descriptors
+
+    def _flush_pending(self, fd, pending):
+        for host_offset, data in pending:
+            os.pwrite(fd, data, host_offset)
+        pending.clear()
+
+    def _l2_entry(self, descriptor, refcounts):
+        # Returns the list of 64 bit words making up the entry, which is the
+        # descriptor and then (for extended entries) the subcluster bitmap
+        if descriptor[0] == 'compressed':
+            _, host_offset, length = descriptor
+            offset_bits = 62 - (self.cluster_bits - 8)
+            sectors = (((host_offset + length - 1) //
+                        COMPRESSED_SECTOR_SIZE) -
+                       (host_offset // COMPRESSED_SECTOR_SIZE))
+            entry = [COMPRESSED_FLAG | (sectors << offset_bits) | host_offset]
+            return entry + [0] * (self.l2_entry_words - 1)
+
+        _, host_offset, allocation, zero = descriptor
+        if refcounts[host_offset >> self.cluster_bits] == 1:
+            host_offset |= COPIED_FLAG
+        if self.extended_l2:
+            return [host_offset, (zero << 32) | allocation]
+        return [host_offset]
+
+    def _reference_descriptor(self, descriptor, refcounts):
+        if descriptor[0] == 'compressed':
+            _, host_offset, length = descriptor
+            first = host_offset >> self.cluster_bits
+            last = (host_offset + length - 1) >> self.cluster_bits
+            for cluster in range(first, last + 1):
+                refcounts[cluster] += 1
+        else:
+            refcounts[descriptor[1] >> self.cluster_bits] += 1
+
+    def write(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            self._write(fd)
+        finally:
+            os.close(fd)
+
+    def _write(self, fd):
+        self.next_cluster = 1
+        writes = self._choose_writes()
+        descriptors = self._write_data(fd, writes)
+        versions = self.snapshots + 1
+
+        # Work out the L2 tables of each version. Tables with identical
+        # contents are shared between versions, which is what qemu's copy on
+        # write leaves behind.
+        by_l1_index = collections.defaultdict(list)
+        for cluster in sorted(writes):
+            by_l1_index[cluster // self.l2_entries].append(cluster)
+
+        tables = {}
+        version_l1 = []
+        for version in range(versions):
+            l1 = {}
+            for l1_index, clusters in by_l1_index.items():
+                entries = []
+                for cluster in clusters:
+                    written = [w for w in writes[cluster] if w <= version]
+                    if written:
+                        entries.append((cluster % self.l2_entries,
+                                        descriptors[(cluster, written[-1])]))
+                if entries:
+                    key = tuple(entries)
+                    if key not in tables:
+                        tables[key] = self._allocate(1)
+                    l1[l1_index] = key
+            version_l1.append(l1)
+
+        # L1 tables, then the snapshot table
+        l1_clusters = max(1, (self.l1_size * 8 + self.cluster_size - 1) >>
+                          self.cluster_bits)
+        l1_offsets = [self._allocate(l1_clusters) for _ in range(versions)]
+
+        snapshot_entries = []
+        for version in range(self.snapshots):
+            snapshot_id = str(version + 1).encode()
+            name = f'snapshot-{version + 1}'.encode()
+            entry = struct.pack(
+                '>QIHHIIQII', l1_offsets[version], self.l1_size,
+                len(snapshot_id), len(name), 1700000000 + version * 3600, 0,
+                version * 1000000000, 0, 16)
+            entry += struct.pack('>QQ', 0, self.virtual_size)
+            entry += snapshot_id + name
+            entry += bytes(-len(entry) % 8)
+            snapshot_entries.append(entry)
+        snapshot_table = b''.join(snapshot_entries)
+        snapshots_offset = 0
+        if snapshot_table:
+            snapshots_offset = self._allocate(
+                (len(snapshot_table) + self.cluster_size - 1) >>
+                self.cluster_bits)
+
+        # Now we know where all the data and metadata is, count references
+        # the same way check.py does
+        refcounts = collections.Counter()
+        refcounts[0] += 1
+        for offset in l1_offsets:
+            for cluster in range(l1_clusters):
+                refcounts[(offset >> self.cluster_bits) + cluster] += 1
+        if snapshot_table:
+            first = snapshots_offset >> self.cluster_bits
+            last = (snapshots_offset + len(snapshot_table) - 1) >> \
+                self.cluster_bits
+            for cluster in range(first, last + 1):
+                refcounts[cluster] += 1
+        for l1 in version_l1:
+            for key in l1.values():
+                refcounts[tables[key] >> self.cluster_bits] += 1
+                for _, descriptor in key:
+                    self._reference_descriptor(descriptor, refcounts)
+
+        # Refcount structures go at the end. They refer to themselves, so
+        # grow them until they cover everything including themselves.
+        per_block = (self.cluster_size * 8) >> self.refcount_order
+        blocks = 0
+        table_clusters = 1
+        while True:
+            total = self.next_cluster + blocks + table_clusters
+            needed_blocks = (total + per_block - 1) // per_block
+            needed_table = max(1, (needed_blocks * 8 + self.cluster_size - 1)
+                               >> self.cluster_bits)
+            if needed_blocks == blocks and needed_table == table_clusters:
+                break
+            blocks = needed_blocks
+            table_clusters = needed_table
+
+        refcount_table_offset = self._allocate(table_clusters)
+        block_offsets = [self._allocate(1) for _ in range(blocks)]
+        for cluster in range(refcount_table_offset >> self.cluster_bits,
+                             self.next_cluster):
+            refcounts[cluster] += 1
+
+        os.pwrite(fd, encode_be64(block_offsets), refcount_table_offset)
+        for index, block_offset in enumerate(block_offsets):
+            first = index * per_block
+            values = [refcounts.get(cluster, 0)
+                      for cluster in range(first, first + per_block)]
+            os.pwrite(fd, encode_refcounts(values, self.refcount_order),
+                      block_offset)
+
+        # L2 tables, with copied flags now that refcounts are known
+        words = self.l2_entry_words
+        for key, offset in tables.items():
+            entries = [0] * (self.l2_entries * words)
+            for index, descriptor in key:
+                entries[index * words:(index + 1) * words] = \
+                    self._l2_entry(descriptor, refcounts)
+            os.pwrite(fd, encode_be64(entries), offset)
+
+        for version, l1 in enumerate(version_l1):
+            entries = [0] * self.l1_size
+            for l1_index, key in l1.items():
+                offset = tables[key]
+                if refcounts[offset >> self.cluster_bits] == 1:
+                    offset |= COPIED_FLAG
+                entries[l1_index] = offset
+            os.pwrite(fd, encode_be64(entries), l1_offsets[version])
+
+        if snapshot_table:
+            os.pwrite(fd, snapshot_table, snapshots_offset)
+
+        self._write_header(fd, l1_offsets[-1], refcount_table_offset,
+                           table_clusters, snapshots_offset)
+        os.ftruncate(fd, self.next_cluster << self.cluster_bits)
+
+    def _write_header(self, fd, l1_table_offset, refcount_table_offset,
+                      refcount_table_clusters, snapshots_offset):
+        incompatible = 0
+        compression_type = 0
+        if self.compressed and self.compression != 'deflate':
+            compression_type = compression_types[self.compression]
+            incompatible |= INCOMPATIBLE_COMPRESSION_TYPE
+        if self.extended_l2:
+            incompatible |= INCOMPATIBLE_EXTENDED_L2
+
+        extensions = b''
+        if self.backing_file and self.backing_format:
+            format = self.backing_format.encode()
+            extensions += struct.pack('>II', EXTENSION_BACKING_FORMAT,
+                                      len(format))
+            extensions += format + bytes(-len(format) % 8)
+        extensions += struct.pack('>II', 0, 0)
+
+        backing_file = b''
+        backing_file_offset = 0
+        if self.backing_file:
+            backing_file = self.backing_file.encode()
+            backing_file_offset = HEADER_LENGTH + len(extensions)
+
+        header = struct.pack(
+            HEADER_FORMAT, b'QFI\xfb', 3, backing_file_offset,
+            len(backing_file), self.cluster_bits, self.virtual_size, 0,
+            self.l1_size, l1_table_offset, refcount_table_offset,
+            refcount_table_clusters, self.snapshots, snapshots_offset,
+            incompatible, 0, 0, self.refcount_order, HEADER_LENGTH,
+            compression_type)
+        header += extensions + backing_file
+        if len(header) > self.cluster_size:
+            raise FormatError('Header does not fit in the first cluster')
+        os.pwrite(fd, header, 0)
+
+
+def write_chain(directory, depth, virtual_size, density=0.1, **kwargs):
+    # Write a backing chain of depth images, base.qcow2 and then
+    # overlay-N.qcow2, each backed by the one before. Overlays are sparser
+    # than the base. Returns the path of the top image.
+    os.makedirs(directory, exist_ok=True)
+    seed = kwargs.pop('seed', 0)
+    backing_file = None
+    path = None
+    for layer in range(depth):
+        name = 'base.qcow2' if layer == 0 else f'overlay-{layer}.qcow2'
+        path = os.path.join(directory, name)
+        Qcow2Writer(path, virtual_size,
+                    density=density if layer == 0 else density / 4,
+                    backing_file=backing_file, seed=seed + layer,
+                    **kwargs).write()
+        backing_file = name
+    return path
+
+
+def parse_size(size):
+    # 10G, 512M, 4T and so on
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    size = size.strip().upper()
+    if size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic qcow2 image.')
+    parser.add_argument('path',
+                        help='Image to write, or a directory with --chain.')
+    parser.add_argument('size', type=parse_size,
+                        help='Virtual size, for example 10G or 4T.')
+    parser.add_argument('--cluster-bits', type=int, default=16)
+    parser.add_argument('--density', type=float, default=0.1,
+                        help='Fraction of the disk to allocate.')
+    parser.add_argument('--run-length', type=int, default=16,
+                        help='Clusters are allocated in runs of this many.')
+    parser.add_argument('--compressed', type=float, default=0.0,
+                        help='Fraction of data clusters to compress.')
+    parser.add_argument('--compression', choices=compression_types.keys(),
+                        default='deflate')
+    parser.add_argument('--snapshots', type=int, default=0)
+    parser.add_argument('--refcount-order', type=int, default=4)
+    parser.add_argument('--chain', type=int, default=0,
+                        help='Write a backing chain this many images deep '
+                             'into the directory given as path.')
+    parser.add_argument('--full', action='store_true',
+                        help='Fill data clusters rather than writing just a '
+                             'marker.')
+    parser.add_argument('--extended-l2', action='store_true',
+                        help='Use 128 bit L2 entries with subclusters.')
+    parser.add_argument('--partial', type=float, default=0.25,
+                        help='With --extended-l2, the fraction of clusters '
+                             'with only some subclusters allocated.')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    options = {
+        'cluster_bits': args.cluster_bits,
+        'run_length': args.run_length,
+        'compressed': args.compressed,
+        'compression': args.compression,
+        'snapshots': args.snapshots,
+        'refcount_order': args.refcount_order,
+        'sparse': not args.full,
+        'extended_l2': args.extended_l2,
+        'partial': args.partial,
+        'seed': args.seed
+    }
+
+    if args.chain:
+        print(write_chain(args.path, args.chain, args.size,
+                          density=args.density, **options))
+    else:
+        Qcow2Writer(args.path, args.size, density=args.density,
+                    **options).write()
+        print(args.path)